@@ -0,0 +1,144 @@
+"""
+Compares forwarding data from channels to backends with select on the
+channels' pipes and with the transport thread delivering it by callback.
+
+Throughput is for a bulk upload through one channel, latency is the round
+trip of small messages echoed by the backend. Both go through a stand-in
+sshd on the loopback, so SSH framing and encryption are included. The
+stand-in runs in this process, so the CPU time per MiB includes its share,
+the difference between the two is what forwarding saves.
+
+Run from the client directory: python3 -m benchmarks.callback
+"""
+import os
+import time
+import socket
+import threading
+import statistics
+import warnings
+
+from conduit_client import ssh, replay
+from conduit_client.ssh import Tunnel
+
+
+UPLOAD = 64 * 1024 * 1024
+CHUNK = 32 * 1024
+PINGS = 2000
+PING = b'x' * 64
+
+
+class Backend:
+    "Reads uploads, and echoes once told to."
+    def __init__(self):
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.bind(('127.0.0.1', 0))
+        self._socket.listen(10)
+        self.port = self._socket.getsockname()[1]
+        self.received = threading.Event()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                client, _ = self._socket.accept()
+
+            except OSError:
+                return
+            threading.Thread(
+                target=self._serve, args=(client,), daemon=True).start()
+
+    def _serve(self, client):
+        with client:
+            echo = client.recv(1) == b'e'
+            received = 0
+            while True:
+                data = client.recv(65536)
+                if not data:
+                    return
+                if echo:
+                    client.sendall(data)
+                    continue
+                received += len(data)
+                if received >= UPLOAD:
+                    self.received.set()
+
+    def close(self):
+        self._socket.close()
+
+
+def _upload(gateway, backend):
+    channel = gateway.open()
+    channel.sendall(b'u')
+    data = os.urandom(CHUNK)
+    start, cpu = time.perf_counter(), time.process_time()
+    for _ in range(UPLOAD // CHUNK):
+        channel.sendall(data)
+    backend.received.wait()
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu
+    channel.close()
+    return UPLOAD / elapsed, cpu / (UPLOAD / 1024 / 1024)
+
+
+def _ping(gateway):
+    channel = gateway.open()
+    channel.sendall(b'e')
+    latencies = []
+    for _ in range(PINGS):
+        start = time.perf_counter()
+        channel.sendall(PING)
+        received = 0
+        while received < len(PING):
+            received += len(channel.recv(len(PING)))
+        latencies.append(time.perf_counter() - start)
+    channel.close()
+    return latencies
+
+
+def _fds():
+    return len(os.listdir('/proc/self/fd'))
+
+
+def bench(name, callback):
+    gateway, backend = replay.Gateway(), Backend()
+    manager = ssh.SSHManager(
+        '127.0.0.1', gateway.port, 'bench', ssh.generate_key('ed25519')[0])
+    manager._forwarder._callback = callback
+    try:
+        manager.add_tunnel(Tunnel('bench.test', '127.0.0.1', backend.port))
+        throughput, cpu = _upload(gateway, backend)
+
+        # NOTE: let the upload's sockets close first.
+        time.sleep(0.5)
+        # NOTE: fds opened for a channel, besides both ends of its backend
+        # connection, which are in this process too.
+        fds = _fds()
+        channel = gateway.open()
+        channel.sendall(b'e')
+        time.sleep(0.2)
+        channels = _fds() - fds - 2
+        channel.close()
+
+        latencies = sorted(_ping(gateway))
+        p99 = statistics.quantiles(latencies, n=100)[98]
+        print(
+            f'{name:<9} upload={throughput / 1024 / 1024:5.1f}MiB/s '
+            f'cpu={cpu * 1000:5.1f}ms/MiB '
+            f'rtt p50={statistics.median(latencies) * 1e6:6.0f}us '
+            f'p99={p99 * 1e6:6.0f}us fds/channel={channels}')
+
+    finally:
+        manager.disconnect()
+        gateway.close()
+        backend.close()
+
+
+def main():
+    # NOTE: the stand-in server's key is new each run.
+    warnings.filterwarnings('ignore', 'Unknown .* host key')
+    bench('select', False)
+    bench('callback', True)
+
+
+if __name__ == '__main__':
+    main()
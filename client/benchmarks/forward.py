@@ -0,0 +1,82 @@
+"""
+Compares forwarding of bursts of small frames, as websockets send, with
+and without read batching and write coalescing.
+
+Each write to a channel becomes at least one SSH packet, so writes per KiB
+stand in for packets per byte. Latency is from the backend writing a frame
+to the client reading it.
+
+Run from the client directory: python3 -m benchmarks.forward
+"""
+import time
+import struct
+import socket
+import threading
+import statistics
+
+from conduit_client import ssh
+
+
+FRAME = struct.Struct('d56x')
+BURSTS = 200
+BURST_FRAMES = 50
+BURST_INTERVAL = 0.005
+# NOTE: frames of a burst trickle in, as from a busy application.
+FRAME_INTERVAL = 0.00005
+CONFIGS = (
+    ('before', dict(read_budget=ssh.BUFFER_SIZE, coalesce_delay=0)),
+    ('budget only', dict(coalesce_delay=0)),
+    ('after', dict()),
+)
+
+
+def _produce(sock):
+    for _ in range(BURSTS):
+        for _ in range(BURST_FRAMES):
+            sock.sendall(FRAME.pack(time.perf_counter()))
+            time.sleep(FRAME_INTERVAL)
+        time.sleep(BURST_INTERVAL)
+
+
+def bench(name, kwargs):
+    forwarder = ssh.Forwarder(**kwargs)
+    client, channel = socket.socketpair()
+    backend, server = socket.socketpair()
+    conn = ssh.Connection(channel, 'bench.test')
+    conn.server = server
+    forwarder._add(conn)
+    producer = threading.Thread(target=_produce, args=(backend,))
+    producer.start()
+
+    latencies, buffer = [], b''
+    total = BURSTS * BURST_FRAMES * FRAME.size
+    received = 0
+    while received < total:
+        data = client.recv(65536)
+        now = time.perf_counter()
+        received += len(data)
+        buffer += data
+        while len(buffer) >= FRAME.size:
+            sent, = FRAME.unpack_from(buffer)
+            latencies.append(now - sent)
+            buffer = buffer[FRAME.size:]
+    producer.join()
+    writes = forwarder.stats()['writes']
+    latencies.sort()
+    p99 = statistics.quantiles(latencies, n=100)[98]
+    print(
+        f'{name:<12} writes={writes:6d} '
+        f'writes/KiB={writes / (total / 1024):6.3f} '
+        f'p50={statistics.median(latencies) * 1000:6.3f}ms '
+        f'p99={p99 * 1000:6.3f}ms')
+    client.close()
+    backend.close()
+
+
+def main():
+    for name, kwargs in CONFIGS:
+        bench(name, kwargs)
+
+
+if __name__ == '__main__':
+    main()
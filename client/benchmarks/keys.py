@@ -0,0 +1,86 @@
+"""
+Compares client key types: key generation and SSH handshake time.
+
+Run from the client directory: python3 -m benchmarks.keys
+"""
+import time
+import socket
+import threading
+import statistics
+
+import paramiko
+
+from conduit_client import ssh
+
+
+ROUNDS = 10
+HOST_KEY = ssh.generate_key('ed25519')[0]
+
+
+class _Server(paramiko.ServerInterface):
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+
+class HandshakeServer:
+    "Accepts connections and completes the SSH handshake and auth."
+    def __init__(self):
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.bind(('127.0.0.1', 0))
+        self._socket.listen(100)
+        self.port = self._socket.getsockname()[1]
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            client, _ = self._socket.accept()
+            t = paramiko.Transport(client)
+            t.add_server_key(HOST_KEY)
+            t.start_server(server=_Server())
+
+
+def _report(name, samples):
+    print(
+        f'{name:<24} median={statistics.median(samples) * 1000:8.1f}ms '
+        f'min={min(samples) * 1000:8.1f}ms max={max(samples) * 1000:8.1f}ms')
+
+
+def bench_keygen(key_type):
+    samples = []
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        ssh.generate_key(key_type)
+        samples.append(time.perf_counter() - start)
+    _report(f'keygen {key_type}', samples)
+
+
+def bench_handshake(server, key_type):
+    key, _ = ssh.generate_key(key_type)
+    samples = []
+    for _ in range(ROUNDS):
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        start = time.perf_counter()
+        client.connect(
+            '127.0.0.1', port=server.port, username='bench', pkey=key,
+            look_for_keys=False, allow_agent=False,
+            disabled_algorithms=ssh.DISABLED_ALGORITHMS
+            if isinstance(key, paramiko.RSAKey) else None)
+        samples.append(time.perf_counter() - start)
+        client.close()
+    _report(f'handshake {key_type}', samples)
+
+
+def main():
+    for key_type in ssh.KEY_TYPES:
+        bench_keygen(key_type)
+    server = HandshakeServer()
+    for key_type in ssh.KEY_TYPES:
+        bench_handshake(server, key_type)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""
+Measures manager subprocess startup.
+
+Run from the client directory: python3 -m benchmarks.startup
+"""
+import sys
+import time
+import subprocess
+import statistics
+
+from conduit_client.server import SSHManagerClient
+
+
+ROUNDS = 5
+
+
+def _report(name, samples):
+    print(
+        f'{name:<24} median={statistics.median(samples) * 1000:8.1f}ms '
+        f'min={min(samples) * 1000:8.1f}ms max={max(samples) * 1000:8.1f}ms')
+
+
+def bench_import():
+    samples = []
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        subprocess.check_call([sys.executable, '-c', 'import conduit_client'])
+        samples.append(time.perf_counter() - start)
+    _report('import', samples)
+
+
+def bench_cold():
+    samples = []
+    for _ in range(ROUNDS):
+        client = SSHManagerClient()
+        start = time.perf_counter()
+        client.ping()
+        samples.append(time.perf_counter() - start)
+        client.disconnect()
+    _report('cold start', samples)
+
+
+def bench_eager():
+    samples = []
+    for _ in range(ROUNDS):
+        client = SSHManagerClient(eager=True)
+        # Simulate the application doing other work during startup.
+        time.sleep(1.0)
+        start = time.perf_counter()
+        client.ping()
+        samples.append(time.perf_counter() - start)
+        client.disconnect()
+    _report('eager start', samples)
+
+
+def bench_spare():
+    samples = []
+    client = SSHManagerClient(spare=True)
+    client.ping()
+    for _ in range(ROUNDS):
+        # Give the spare time to become ready.
+        time.sleep(1.0)
+        client._server.popen.kill()
+        client._server.popen.wait()
+        start = time.perf_counter()
+        client.ping()
+        samples.append(time.perf_counter() - start)
+    client.disconnect()
+    _report('restart with spare', samples)
+
+
+def main():
+    bench_import()
+    bench_cold()
+    bench_eager()
+    bench_spare()
+
+
+if __name__ == '__main__':
+    main()
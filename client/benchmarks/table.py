@@ -0,0 +1,92 @@
+"""
+Memory and bookkeeping cost per connection of the forwarder's connection
+table, compared to the per-socket dicts it replaced.
+
+Run from the client directory: python3 -m benchmarks.table
+"""
+import time
+import tracemalloc
+from collections import defaultdict
+
+from conduit_client import ssh
+
+
+CONNECTIONS = 10000
+
+
+class _Socket:
+    "Stands in for a socket, only its identity matters here."
+    __slots__ = ()
+
+
+def _dicts(pairs):
+    # NOTE: the layout before the connection table.
+    handles, domains, backends = {}, {}, {}
+    bytes_recv, bytes_sent = defaultdict(int), defaultdict(int)
+    for channel, server in pairs:
+        domains[channel] = 'foo.com'
+        backends[server] = None
+        handles[server] = channel
+        handles[channel] = server
+        bytes_recv[channel] += 100
+        bytes_sent[server] += 100
+        bytes_recv[server] += 100
+        bytes_sent[channel] += 100
+    return handles, domains, backends, bytes_recv, bytes_sent
+
+
+def _close_dicts(state, pairs):
+    handles, domains, backends, bytes_recv, bytes_sent = state
+    for channel, server in pairs:
+        for s in (channel, server):
+            bytes_recv.pop(s, 0)
+            bytes_sent.pop(s, 0)
+            handles.pop(s, None)
+            domains.pop(s, None)
+            backends.pop(s, None)
+
+
+def _table(pairs):
+    table = {}
+    for channel, server in pairs:
+        conn = ssh.Connection(channel, 'foo.com')
+        conn.server = server
+        conn.state = conn.STATE_OPEN
+        table[server] = table[channel] = conn
+        conn.bytes_in += 100
+        conn.bytes_out += 100
+        conn.written += 200
+    return table
+
+
+def _close_table(table, pairs):
+    for channel, server in pairs:
+        conn = table.pop(channel)
+        table.pop(server)
+        conn.state = conn.STATE_CLOSED
+
+
+def bench(name, build, close):
+    pairs = [(_Socket(), _Socket()) for _ in range(CONNECTIONS)]
+    tracemalloc.start()
+    start = time.perf_counter()
+    state = build(pairs)
+    opened = time.perf_counter() - start
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    start = time.perf_counter()
+    close(state, pairs)
+    closed = time.perf_counter() - start
+    print(
+        f'{name:<8} {size / CONNECTIONS:7.1f}B/connection '
+        f'open={opened / CONNECTIONS * 1e6:5.2f}us '
+        f'close={closed / CONNECTIONS * 1e6:5.2f}us')
+
+
+def main():
+    bench('dicts', _dicts, _close_dicts)
+    bench('table', _table, _close_table)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""
+Tunnel setup time and throughput over emulated WAN links.
+
+Run from the client directory: python3 -m benchmarks.wan
+"""
+import time
+import socket
+import threading
+import warnings
+
+from conduit_client import ssh, replay
+from conduit_client.ssh import Tunnel
+from tests.wan import Link, WanProxy
+
+
+PROFILES = ('lan', 'cable', 'dsl', 'lte')
+PAYLOAD = 2 * 1024 * 1024
+# NOTE: the slow profiles would take minutes to send the full payload.
+DEADLINE = 10.0
+
+
+class Source:
+    "A backend that sends PAYLOAD bytes to each connection."
+    def __init__(self):
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.bind(('127.0.0.1', 0))
+        self._socket.listen(10)
+        self.port = self._socket.getsockname()[1]
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                client, _ = self._socket.accept()
+
+            except OSError:
+                return
+            threading.Thread(
+                target=self._send, args=(client,), daemon=True).start()
+
+    def _send(self, client):
+        with client:
+            try:
+                client.sendall(bytes(PAYLOAD))
+
+            except OSError:
+                pass
+
+    def close(self):
+        self._socket.close()
+
+
+def bench(name):
+    gateway, source = replay.Gateway(), Source()
+    proxy = WanProxy(('127.0.0.1', gateway.port), Link.profile(name))
+    manager = ssh.SSHManager(
+        '127.0.0.1', proxy.port, 'bench', ssh.generate_key('ed25519')[0])
+    try:
+        start = time.perf_counter()
+        manager.add_tunnel(Tunnel('bench.test', '127.0.0.1', source.port))
+        setup = time.perf_counter() - start
+
+        start = time.perf_counter()
+        channel = gateway.open()
+        received = 0
+        channel.settimeout(1.0)
+        while received < PAYLOAD and \
+                time.perf_counter() - start < DEADLINE:
+            try:
+                data = channel.recv(65536)
+
+            except socket.timeout:
+                continue
+            if not data:
+                break
+            received += len(data)
+        elapsed = time.perf_counter() - start
+        channel.close()
+        print(
+            f'{name:<10} setup={setup * 1000:8.1f}ms '
+            f'throughput={received / elapsed / 1024:9.1f}KiB/s '
+            f'({received // 1024}KiB in {elapsed:.1f}s)')
+
+    finally:
+        manager.disconnect()
+        proxy.close()
+        gateway.close()
+        source.close()
+
+
+def main():
+    # NOTE: the stand-in server's key is new each run.
+    warnings.filterwarnings('ignore', 'Unknown .* host key')
+    for name in PROFILES:
+        bench(name)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,33 @@
-from conduit_client import dns, ssh
-from conduit_client.server import SSHManagerClient, SSHManagerServer
+import importlib
 
 
-__all__ = ['dns', 'ssh', 'SSHManagerClient', 'SSHManagerServer']
+__all__ = [
+    'dns', 'ssh', 'SSHManagerClient', 'SSHManagerServer',
+    'ShardedSSHManagerClient', 'ControlClient',
+]
+
+# NOTE: attributes are imported on first access so that the manager
+# subprocess (python -m conduit_client) does not pay for modules it does not
+# use.
+_LAZY = {
+    'dns': ('conduit_client.dns', None),
+    'ssh': ('conduit_client.ssh', None),
+    'SSHManagerClient': ('conduit_client.server', 'SSHManagerClient'),
+    'SSHManagerServer': ('conduit_client.server', 'SSHManagerServer'),
+    'ShardedSSHManagerClient': (
+        'conduit_client.shard', 'ShardedSSHManagerClient'),
+    'ControlClient': ('conduit_client.server', 'ControlClient'),
+}
+
+
+def __getattr__(name):
+    try:
+        module_name, attr = _LAZY[name]
+    except KeyError:
+        raise AttributeError(
+            f'module {__name__!r} has no attribute {name!r}') from None
+    value = importlib.import_module(module_name)
+    if attr is not None:
+        value = getattr(value, attr)
+    globals()[name] = value
+    return value
@@ -0,0 +1,167 @@
+import os
+import time
+import random
+import threading
+import logging
+
+
+BALANCE_STRATEGY = os.getenv('BALANCE_STRATEGY', 'least_conn')
+BACKEND_CONNECT_TIMEOUT = float(os.getenv('BACKEND_CONNECT_TIMEOUT', 5))
+BACKEND_EJECT_FAILURES = int(os.getenv('BACKEND_EJECT_FAILURES', 3))
+BACKEND_EJECT_TIME = float(os.getenv('BACKEND_EJECT_TIME', 30))
+BACKEND_CHECK_INTERVAL = float(os.getenv('BACKEND_CHECK_INTERVAL', 10))
+BACKEND_CHECK_TIMEOUT = float(os.getenv('BACKEND_CHECK_TIMEOUT', 2))
+BACKEND_CHECK_PATH = os.getenv('BACKEND_CHECK_PATH', '/')
+STRATEGIES = ('least_conn', 'p2c')
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+
+class Backend:
+    """
+    One backend of a tunnel.
+
+    Tracks active connections, consecutive connect failures and the result
+    of the last health check.
+    """
+    def __init__(self, addr, port, weight=1):
+        self.addr = addr
+        self.port = port
+        self.weight = weight
+        self.active = 0
+        self.failures = 0
+        self.healthy = True
+        self.ejected_until = 0
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f'Backend({self.addr}:{self.port}, weight={self.weight})'
+
+    @property
+    def key(self):
+        return (self.addr, self.port)
+
+    @property
+    def ejected(self):
+        return time.monotonic() < self.ejected_until
+
+    @property
+    def available(self):
+        return self.healthy and not self.ejected
+
+    @property
+    def load(self):
+        return (self.active + 1) / self.weight
+
+    def acquire(self):
+        with self._lock:
+            self.active += 1
+
+    def release(self):
+        with self._lock:
+            self.active -= 1
+
+    def succeeded(self):
+        self.failures = 0
+
+    def failed(self, failures=BACKEND_EJECT_FAILURES,
+               eject_time=BACKEND_EJECT_TIME):
+        "Record a connect failure, eject after too many in a row."
+        self.failures += 1
+        if self.failures < failures:
+            return
+        LOGGER.warning(
+            'Ejecting %s for %.0fs after %i failures',
+            self, eject_time, self.failures)
+        self.failures = 0
+        self.ejected_until = time.monotonic() + eject_time
+
+
+def _parse_target(target):
+    addr, port, *weight = target
+    return addr, port, weight[0] if weight else 1
+
+
+class Balancer:
+    "Chooses among the backends of a tunnel."
+    def __init__(self, domain, targets=(), strategy=BALANCE_STRATEGY,
+                 http=False):
+        if strategy not in STRATEGIES:
+            raise ValueError(f'Invalid strategy: {strategy}')
+        self.domain = domain
+        self.strategy = strategy
+        self.http = http
+        self.backends = []
+        self.update(targets)
+
+    def update(self, targets, http=None):
+        """
+        Set the backends from (addr, port[, weight]) tuples.
+
+        Backends that remain keep their connection counts and health.
+        """
+        if http is not None:
+            self.http = http
+        existing = {backend.key: backend for backend in self.backends}
+        backends = []
+        for target in targets:
+            addr, port, weight = _parse_target(target)
+            backend = existing.get((addr, port)) or Backend(addr, port)
+            backend.weight = weight
+            backends.append(backend)
+        self.backends = backends
+
+    def choose(self, exclude=()):
+        "Pick a backend, or None."
+        candidates = [
+            b for b in self.backends if b.weight > 0 and b not in exclude]
+        # NOTE: if every backend is down try them anyway, failing is worse.
+        candidates = [b for b in candidates if b.available] or candidates
+        if not candidates:
+            return None
+        if self.strategy == 'p2c' and len(candidates) > 2:
+            candidates = random.choices(
+                candidates, [b.weight for b in candidates], k=2)
+        best = min(b.load for b in candidates)
+        ties = [b for b in candidates if b.load == best]
+        return random.choices(ties, [b.weight for b in ties])[0]
+
+    def _probe(self, backend, connect, timeout):
+        sock = connect(backend, timeout)
+        try:
+            sock.settimeout(timeout)
+            if not self.http:
+                return True
+            sock.sendall((
+                f'GET {BACKEND_CHECK_PATH} HTTP/1.1\r\n'
+                f'Host: {self.domain}\r\n'
+                'Connection: close\r\n\r\n').encode())
+            parts = sock.recv(64).split(b' ', 2)
+            return len(parts) > 1 and parts[0].startswith(b'HTTP/') and \
+                int(parts[1]) < 500
+
+        finally:
+            sock.close()
+
+    def check(self, connect, timeout=BACKEND_CHECK_TIMEOUT):
+        """
+        Health check every backend.
+
+        connect(backend, timeout) must return a connected socket.
+        """
+        for backend in list(self.backends):
+            try:
+                healthy = self._probe(backend, connect, timeout)
+
+            except (OSError, ValueError):
+                healthy = False
+
+            except Exception:
+                LOGGER.exception('Error checking %s', backend)
+                healthy = False
+            if healthy != backend.healthy:
+                LOGGER.warning(
+                    '%s for %s is now %s', backend, self.domain,
+                    'healthy' if healthy else 'unhealthy')
+            backend.healthy = healthy
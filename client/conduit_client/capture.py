@@ -0,0 +1,137 @@
+"""
+Records the traffic passing through the forwarder.
+
+A capture is a binary file: a header followed by one record per chunk of
+data forwarded and one per connection closed. Payloads are only recorded
+when asked for, otherwise just their size.
+"""
+import os
+import time
+import struct
+import threading
+import logging
+from collections import namedtuple
+
+
+CAPTURE_FILE = os.getenv('CAPTURE_FILE', None)
+CAPTURE_PAYLOAD = os.getenv('CAPTURE_PAYLOAD', '').lower() in (
+    '1', 'true', 'yes')
+CAPTURE_LIMIT = int(os.getenv('CAPTURE_LIMIT', 64 * 1024 * 1024))
+
+MAGIC = b'CCAP'
+VERSION = 1
+# NOTE: magic, version and the wall clock time capture started.
+HEADER = struct.Struct('<4sBd')
+# NOTE: microseconds since start, connection, kind and size.
+RECORD = struct.Struct('<QIBI')
+
+# Data from the client to the backend.
+KIND_IN = 0
+# Data from the backend to the client.
+KIND_OUT = 1
+KIND_CLOSE = 2
+# NOTE: set on the kind when size bytes of payload follow the record.
+FLAG_PAYLOAD = 0x80
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+Record = namedtuple('Record', ('time', 'conn', 'kind', 'size', 'payload'))
+
+
+class Capture:
+    """
+    Writes a capture file.
+
+    Connections are identified by the channel they arrived on. Capturing
+    stops once the file would grow beyond limit bytes.
+    """
+    def __init__(self, path, payload=CAPTURE_PAYLOAD, limit=CAPTURE_LIMIT):
+        self.path = path
+        self.payload = payload
+        self.limit = limit
+        self.size = HEADER.size
+        self.full = False
+        self._conns = {}
+        self._next = 0
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+        self._file = open(path, 'wb')
+        self._file.write(HEADER.pack(MAGIC, VERSION, time.time()))
+
+    def _conn(self, channel):
+        conn = self._conns.get(channel)
+        if conn is None:
+            conn = self._conns[channel] = self._next
+            self._next += 1
+        return conn
+
+    def _write(self, channel, kind, size, payload=b''):
+        with self._lock:
+            if self.full or self._file.closed:
+                return
+            length = RECORD.size + len(payload)
+            if self.size + length > self.limit:
+                LOGGER.warning(
+                    'Capture %s reached %i bytes, stopping', self.path,
+                    self.size)
+                self.full = True
+                return
+            if payload:
+                kind |= FLAG_PAYLOAD
+            micros = int((time.monotonic() - self._start) * 1000000)
+            self._file.write(
+                RECORD.pack(micros, self._conn(channel), kind, size))
+            self._file.write(payload)
+            # NOTE: the manager subprocess is killed rather than shut down,
+            # so nothing may be left in the buffer.
+            self._file.flush()
+            self.size += length
+
+    def data(self, channel, kind, data):
+        "Record data forwarded for channel in direction kind."
+        self._write(
+            channel, kind, len(data), bytes(data) if self.payload else b'')
+
+    def closed(self, channel):
+        if channel not in self._conns:
+            return
+        self._write(channel, KIND_CLOSE, 0)
+        with self._lock:
+            self._conns.pop(channel, None)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def from_env():
+    "A Capture if CAPTURE_FILE is set, otherwise None."
+    if not CAPTURE_FILE:
+        return None
+    LOGGER.info('Capturing traffic to %s', CAPTURE_FILE)
+    return Capture(CAPTURE_FILE)
+
+
+def read(path):
+    """
+    Read a capture, returns the time it started and a list of Records.
+
+    Record times are in seconds since the capture started.
+    """
+    with open(path, 'rb') as f:
+        magic, version, started = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f'Not a capture file: {path}')
+        records = []
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                break
+            micros, conn, kind, size = RECORD.unpack(header)
+            payload = None
+            if kind & FLAG_PAYLOAD:
+                kind &= ~FLAG_PAYLOAD
+                payload = f.read(size)
+            records.append(Record(micros / 1000000, conn, kind, size, payload))
+    return started, records
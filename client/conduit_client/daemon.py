@@ -0,0 +1,285 @@
+"""
+Keeps tunnels in line with a config file.
+
+The file is YAML or JSON, with a list of tunnels:
+
+    tunnels:
+      - domain: foo.com
+        addr: 127.0.0.1
+        port: 8080
+      - domain: bar.com
+        mode: http
+        backends: [[10.0.0.1, 80], [10.0.0.2, 80, 2]]
+
+The file is watched, when it changes only the tunnels that differ from
+those running are added, changed or removed. The running tunnels are also
+compared every RECONCILE_INTERVAL seconds, so failed changes are retried.
+
+Usage: python3 -m conduit_client.daemon [tunnels.yml]
+"""
+import os
+import sys
+import json
+import time
+import struct
+import ctypes
+import ctypes.util
+import logging
+from select import select
+from os.path import abspath, basename, dirname
+
+from conduit_client.ssh import Tunnel
+from conduit_client.server import SSHManagerClient
+from conduit_client.shard import SSH_SHARDS, ShardedSSHManagerClient
+
+
+TUNNELS_FILE = os.getenv('TUNNELS_FILE', '/etc/conduit/tunnels.yml')
+# NOTE: editors write files in several steps, wait for them to finish.
+WATCH_SETTLE = float(os.getenv('WATCH_SETTLE', 0.2))
+WATCH_POLL_INTERVAL = float(os.getenv('WATCH_POLL_INTERVAL', 5.0))
+RECONCILE_INTERVAL = float(os.getenv('RECONCILE_INTERVAL', 60.0))
+
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | \
+    IN_CREATE | IN_DELETE
+# NOTE: wd, mask, cookie and name length, the name follows.
+EVENT = struct.Struct('iIII')
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+
+def _parse(text, path):
+    if path.endswith(('.yml', '.yaml')):
+        # NOTE: only needed for YAML files.
+        import yaml
+
+        return yaml.safe_load(text)
+    return json.loads(text)
+
+
+def _tunnel(item):
+    if not isinstance(item, dict) or 'domain' not in item:
+        raise ValueError(f'Invalid tunnel: {item}')
+    unknown = set(item) - {'domain', 'addr', 'port', 'mode', 'backends'}
+    if unknown:
+        raise ValueError(f'Unknown tunnel options: {", ".join(unknown)}')
+    backends = item.get('backends')
+    if not backends and not ('addr' in item and 'port' in item):
+        raise ValueError(f'Tunnel needs addr and port: {item["domain"]}')
+    mode = item.get('mode', Tunnel.MODE_TCP)
+    if mode not in (Tunnel.MODE_TCP, Tunnel.MODE_HTTP):
+        raise ValueError(f'Invalid mode: {mode}')
+    port = item.get('port')
+    return Tunnel(
+        item['domain'].lower(), item.get('addr'),
+        int(port) if port is not None else None, mode=mode,
+        backends=backends)
+
+
+def parse(text, path=''):
+    "Parse the tunnels in a config file, returns a dict of domain to Tunnel."
+    config = _parse(text, path) or {}
+    items = config.get('tunnels', []) if isinstance(config, dict) \
+        else config
+    if not isinstance(items, list):
+        raise ValueError('Expected a list of tunnels')
+    tunnels = {}
+    for item in items:
+        tunnel = _tunnel(item)
+        if tunnel.domain in tunnels:
+            raise ValueError(f'Duplicate tunnel: {tunnel.domain}')
+        tunnels[tunnel.domain] = tunnel
+    return tunnels
+
+
+def load(path):
+    with open(path) as f:
+        return parse(f.read(), path)
+
+
+def diff(desired, live):
+    """
+    Compare desired and live tunnels, both dicts of domain to Tunnel.
+
+    Returns the tunnels to add, which includes changed ones, and those to
+    remove.
+    """
+    add = [
+        tunnel for domain, tunnel in desired.items()
+        if domain not in live or live[domain] != tunnel
+    ]
+    remove = [
+        tunnel for domain, tunnel in live.items() if domain not in desired
+    ]
+    return add, remove
+
+
+def _inotify():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        return libc.inotify_init1, libc.inotify_add_watch
+
+    except (OSError, AttributeError):
+        return None
+
+
+class Watcher:
+    """
+    Waits for a file to change.
+
+    The directory is watched with inotify, so files replaced by rename (as
+    editors and Kubernetes config maps do) are noticed. Where inotify is
+    not available the file is polled instead.
+    """
+    def __init__(self, path, poll_interval=WATCH_POLL_INTERVAL):
+        self.path = abspath(path)
+        self._poll_interval = poll_interval
+        self._fd = None
+        inotify = _inotify()
+        if inotify is None:
+            LOGGER.warning('inotify not available, polling %s', path)
+            return
+        init, add_watch = inotify
+        fd = init(IN_NONBLOCK | IN_CLOEXEC)
+        if fd == -1:
+            LOGGER.warning(
+                'inotify_init1 failed: %s', os.strerror(ctypes.get_errno()))
+            return
+        wd = add_watch(fd, dirname(self.path).encode(), WATCH_MASK)
+        if wd == -1:
+            LOGGER.warning(
+                'inotify_add_watch failed: %s',
+                os.strerror(ctypes.get_errno()))
+            os.close(fd)
+            return
+        self._fd = fd
+
+    def _events(self):
+        try:
+            data = os.read(self._fd, 4096)
+
+        except BlockingIOError:
+            return []
+        names, p = [], 0
+        while p + EVENT.size <= len(data):
+            _, _, _, length = EVENT.unpack_from(data, p)
+            p += EVENT.size
+            names.append(data[p:p + length].rstrip(b'\0').decode())
+            p += length
+        return names
+
+    def _relevant(self, names):
+        # NOTE: config maps swap a ..data symlink rather than the file.
+        return any(
+            name == basename(self.path) or name.startswith('..')
+            for name in names)
+
+    def wait(self, timeout=None):
+        "Wait for the file to change, returns False on timeout."
+        if self._fd is None:
+            time.sleep(self._poll_interval if timeout is None
+                       else min(timeout, self._poll_interval))
+            return True
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None \
+                else max(0, deadline - time.monotonic())
+            if not select([self._fd], [], [], remaining)[0]:
+                return False
+            if not self._relevant(self._events()):
+                continue
+            # NOTE: collect the rest of this change.
+            while select([self._fd], [], [], WATCH_SETTLE)[0]:
+                self._events()
+            return True
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class Daemon:
+    "Applies the tunnels in a config file to a manager client."
+    def __init__(self, path, manager, interval=RECONCILE_INTERVAL):
+        self.path = path
+        self.manager = manager
+        self._interval = interval
+
+    def _read(self):
+        with open(self.path) as f:
+            return f.read()
+
+    def reconcile(self):
+        """
+        Apply the config file where the running tunnels differ from it.
+
+        Returns the number of tunnels added or removed. An invalid file is
+        logged and left unapplied, a tunnel that fails is logged and tried
+        again next time.
+        """
+        try:
+            desired = parse(self._read(), self.path)
+
+        except (OSError, ValueError) as e:
+            LOGGER.error('Not applying %s: %s', self.path, e)
+            return 0
+
+        except Exception:
+            # NOTE: YAML errors are not ValueErrors.
+            LOGGER.exception('Not applying %s', self.path)
+            return 0
+
+        live = {t.domain: t for t in self.manager.list_tunnels()}
+        add, remove = diff(desired, live)
+        if not add and not remove:
+            return 0
+        LOGGER.info(
+            'Applying %s: %i to add or change, %i to remove', self.path,
+            len(add), len(remove))
+        # NOTE: the client sends one command at a time, so there is nothing
+        # to gain from applying tunnels concurrently.
+        changes = [(self.manager.del_tunnel, t) for t in remove]
+        changes.extend((self.manager.add_tunnel, t) for t in add)
+        applied = 0
+        for apply, tunnel in changes:
+            try:
+                apply(tunnel)
+                applied += 1
+
+            except Exception:
+                LOGGER.exception('Error applying tunnel %s', tunnel.domain)
+        return applied
+
+    def run_forever(self, watcher=None):
+        watcher = watcher or Watcher(self.path)
+        try:
+            while True:
+                self.reconcile()
+                watcher.wait(self._interval)
+
+        finally:
+            watcher.close()
+
+
+def create_manager():
+    if SSH_SHARDS:
+        return ShardedSSHManagerClient(eager=True)
+    return SSHManagerClient(eager=True)
+
+
+def main(path=TUNNELS_FILE):
+    Daemon(path, create_manager()).run_forever()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO').upper())
+    main(*sys.argv[1:2])
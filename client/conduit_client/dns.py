@@ -5,19 +5,71 @@ import logging
 import json
 import time
 import signal
+import socket
+import heapq
+import random
+import itertools
+import threading
+import ipaddress
+from select import select
 from pprint import pformat
+from collections import defaultdict
+from concurrent.futures import (
+    ThreadPoolExecutor, wait, FIRST_COMPLETED,
+)
 from http import client
 from urllib.parse import urlparse
+from urllib.request import urlopen
 
+import requests
 from pddns import providers
-from pddns.pddns import get_ip
 
 
 CACHE_PATH = os.getenv('CACHE_PATH', '/var/lib/dyndns.cache')
+CACHE_TTL = int(os.getenv('CACHE_TTL', '0'))
 CONSOLE_AUTH_TOKEN = os.getenv('CONSOLE_AUTH_TOKEN')
 CONSOLE_URL = os.getenv('CONSOLE_URL')
 INTERVAL = int(os.getenv('INTERVAL', '300'))
+# Seconds between fetches of the domain list, unchanged lists cost a 304.
+FETCH_INTERVAL = float(os.getenv('FETCH_INTERVAL', '30'))
 LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+MAX_WORKERS = int(os.getenv('MAX_WORKERS', '8'))
+PROVIDER_CONCURRENCY = int(os.getenv('PROVIDER_CONCURRENCY', '2'))
+UPDATE_TIMEOUT = float(os.getenv('UPDATE_TIMEOUT', '30'))
+IP_SOURCES = os.getenv(
+    'IP_SOURCES',
+    'https://checkip.amazonaws.com,https://api.ipify.org,'
+    'https://icanhazip.com'
+).split(',')
+IP_TIMEOUT = float(os.getenv('IP_TIMEOUT', '10'))
+PRECHECK = os.getenv('PRECHECK', '').lower() in ('1', 'true', 'yes')
+PRECHECK_RESOLVER = [
+    ns for ns in os.getenv('PRECHECK_RESOLVER', '').split(',') if ns
+]
+PRECHECK_TIMEOUT = float(os.getenv('PRECHECK_TIMEOUT', '5'))
+# Seconds to wait for a burst of netlink messages to end.
+NETLINK_SETTLE = float(os.getenv('NETLINK_SETTLE', '1.0'))
+# After a network change the public ip may lag, so check again quickly.
+RECHECK_DELAYS = (5, 15, 30)
+RETRY_DELAY = float(os.getenv('RETRY_DELAY', '30'))
+MAX_RETRY_DELAY = float(os.getenv('MAX_RETRY_DELAY', '3600'))
+# Initial updates are spread over this many seconds.
+STARTUP_SPREAD = float(os.getenv('STARTUP_SPREAD', '10'))
+# Minimum seconds between updates of a record, per provider, format:
+# provider=seconds,provider=seconds
+PROVIDER_INTERVALS = {
+    name: float(seconds) for name, seconds in (
+        item.split('=') for item in
+        os.getenv('PROVIDER_INTERVALS', '').split(',') if item
+    )
+}
+
+# rtnetlink multicast groups, see linux/rtnetlink.h.
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV4_ROUTE = 0x40
+RTMGRP_IPV6_IFADDR = 0x100
+RTMGRP_IPV6_ROUTE = 0x400
 
 LOGGER = logging.getLogger(__name__)
 LOGGER.addHandler(logging.StreamHandler())
@@ -34,59 +86,632 @@ PROVIDERS = {
 PDDNS_VERSION = "v2.1.0"
 
 
-def _load_cache():
-    if os.path.getsize(CACHE_PATH) == 0:
-        return {}
+class IpCache:
+    """
+    Persistent record of the ip last published for each domain.
 
-    LOGGER.info('Loading cache')
-    try:
-        with open(CACHE_PATH, 'r') as f:
-            cache = json.load(f)
-        LOGGER.debug('Loaded %i items from cache', len(cache))
-        return cache
+    The file is replaced atomically after every change so that a crash can
+    not corrupt it. Each record has a timestamp so stale entries can be
+    ignored.
+    """
+    def __init__(self, path=CACHE_PATH):
+        self._path = path
+        self._records = {}
+        self._lock = threading.Lock()
+        self.load()
+
+    def __len__(self):
+        return len(self._records)
+
+    def __contains__(self, name):
+        return name in self._records
+
+    def load(self):
+        try:
+            with open(self._path, 'r') as f:
+                records = json.load(f)
+
+        except FileNotFoundError:
+            return
+
+        except Exception:
+            LOGGER.exception('Error loading cache')
+            return
+
+        for name, record in records.items():
+            # NOTE: older versions stored only the ip.
+            if isinstance(record, str):
+                record = {'ip': record, 'updated': 0}
+            self._records[name] = record
+        LOGGER.info('Loaded %i items from cache', len(self._records))
+
+    def save(self):
+        tmp = f'{self._path}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self._records, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._path)
+
+    def get(self, name, max_age=None):
+        "Returns the cached ip, or None if missing or older than max_age."
+        record = self._records.get(name)
+        if record is None:
+            return None
+        if max_age and time.time() - record['updated'] > max_age:
+            return None
+        return record['ip']
+
+    def age(self, name):
+        record = self._records.get(name)
+        if record is None:
+            return None
+        return time.time() - record['updated']
+
+    def set(self, name, ip):
+        self.update([name], ip)
+
+    def discard(self, names):
+        "Forget the ip of each of names and save the file once."
+        with self._lock:
+            removed = [
+                name for name in names
+                if self._records.pop(name, None) is not None
+            ]
+            if not removed:
+                return
+            try:
+                self.save()
+
+            except Exception:
+                LOGGER.exception('Error saving cache')
+
+    def update(self, names, ip):
+        "Record ip for each of names and save the file once."
+        if not names:
+            return
+        with self._lock:
+            now = time.time()
+            for name in names:
+                self._records[name] = {'ip': ip, 'updated': now}
+            try:
+                self.save()
+
+            except Exception:
+                LOGGER.exception('Error saving cache')
+
+
+def _shutdown(*args):
+    LOGGER.info('Exiting')
+    exit(0)
+
+
+IP_CACHE = None
+
+
+class ConsoleClient:
+    """
+    Fetches object lists from the console.
+
+    A single connection is kept open and re-established if it fails. Each
+    response is cached along with its validators (ETag, Last-Modified) so
+    unchanged lists are answered with 304 and not transferred again.
+    """
+    def __init__(self, url=CONSOLE_URL, token=CONSOLE_AUTH_TOKEN,
+                 timeout=UPDATE_TIMEOUT):
+        self._url = urlparse(url)
+        self._token = token
+        self._timeout = timeout
+        self._conn = None
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _connection(self):
+        if self._conn is None:
+            klass = client.HTTPSConnection if self._url.scheme == 'https' \
+                else client.HTTPConnection
+            self._conn = klass(
+                self._url.hostname, self._url.port, timeout=self._timeout)
+        return self._conn
+
+    def _request(self, path, headers):
+        # NOTE: the server may have closed an idle connection, in which case
+        # the request is retried once on a new connection.
+        for retry in (True, False):
+            c = self._connection()
+            try:
+                c.request('GET', path, headers=headers)
+                r = c.getresponse()
+                body = r.read()
+
+            except (client.HTTPException, OSError):
+                self.close()
+                if not retry:
+                    raise
+                LOGGER.debug('Connection failed, reconnecting')
+                continue
+
+            if r.will_close:
+                self.close()
+            return r, body
+
+    def get(self, path, headers=None):
+        """
+        Get the list of objects at path.
+
+        Returns an (objects, changed) tuple, changed is False if the console
+        indicated the list is unchanged since the last call.
+        """
+        headers = headers.copy() if headers else {}
+        headers.update({
+            'Authorization': f'Bearer {self._token}',
+        })
+        with self._lock:
+            cached = self._cache.get(path)
+            if cached:
+                etag, modified, objects = cached
+                if etag:
+                    headers['If-None-Match'] = etag
+                if modified:
+                    headers['If-Modified-Since'] = modified
+            r, body = self._request(path, headers)
+
+            if r.status == 304 and cached:
+                LOGGER.debug('Not modified: %s', path)
+                return objects, False
+
+            assert r.status == 200, f'Invalid HTTP status {r.status}'
+            objects = json.loads(body.decode())['objects']
+            self._cache[path] = (
+                r.getheader('ETag'), r.getheader('Last-Modified'), objects)
+            return objects, True
+
+
+_CONSOLE = None
+
+
+def _console():
+    global _CONSOLE
+
+    if _CONSOLE is None:
+        _CONSOLE = ConsoleClient()
+    return _CONSOLE
 
-    except Exception:
-        LOGGER.exception('Error loading cache')
-        return {}
+
+def request(path, headers=None):
+    return _console().get(path, headers)[0]
+
+
+def fetch_domains():
+    "Returns the domain list and whether it changed since last fetch."
+    return _console().get('/api/domains/')
+
+
+def _fetch_ip(url, timeout):
+    with urlopen(url, timeout=timeout) as r:
+        ip = r.read().decode().strip()
+    # NOTE: raises ValueError for anything that is not an ipv4 address.
+    ipaddress.IPv4Address(ip)
+    return ip
 
 
-def _save_cache(*args):
-    LOGGER.info('Saving cache')
+def get_ip(sources=None, timeout=None):
+    """
+    Get the public ip by racing several sources.
+
+    The first valid answer is returned, slow or failing sources are ignored.
+    """
+    sources = sources or IP_SOURCES
+    timeout = timeout or IP_TIMEOUT
+    executor = ThreadPoolExecutor(max_workers=len(sources))
     try:
-        with open(CACHE_PATH, 'w') as f:
-            json.dump(IP_CACHE, f)
+        futures = {
+            executor.submit(_fetch_ip, url, timeout): url for url in sources
+        }
+        pending = set(futures)
+        while pending:
+            done, pending = wait(
+                pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                try:
+                    return future.result()
 
-    except Exception:
-        LOGGER.exception('Error saving cache')
+                except Exception as e:
+                    LOGGER.debug(
+                        'Error getting ip from %s: %s', futures[future], e)
+        raise ValueError('Could not determine ip')
 
     finally:
-        exit(0)
+        executor.shutdown(wait=False)
 
 
-IP_CACHE = None  # _load_cache()
+class NetlinkWatcher:
+    """
+    Waits for link, address or route changes using rtnetlink.
 
+    Where netlink is not available it degrades to a plain sleep.
+    """
+    GROUPS = RTMGRP_LINK | RTMGRP_IPV4_IFADDR | RTMGRP_IPV4_ROUTE | \
+        RTMGRP_IPV6_IFADDR | RTMGRP_IPV6_ROUTE
+
+    def __init__(self, sock=None, settle=NETLINK_SETTLE):
+        self._settle = settle
+        self._sock = sock
+        if self._sock is None:
+            try:
+                self._sock = socket.socket(
+                    socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+                self._sock.bind((0, self.GROUPS))
+
+            except (AttributeError, OSError):
+                LOGGER.warning('Netlink unavailable, polling only')
+                self._sock = None
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def _drain(self):
+        while select([self._sock], [], [], 0)[0]:
+            if not self._sock.recv(65536):
+                break
+
+    def wait(self, timeout):
+        "Returns True if a change occurred before timeout."
+        if self._sock is None:
+            time.sleep(timeout)
+            return False
+        if not select([self._sock], [], [], timeout)[0]:
+            return False
+        # NOTE: changes arrive in bursts (dhcp, ppp), wait for it to end.
+        deadline = time.monotonic() + self._settle * 5
+        while True:
+            self._drain()
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if not select(
+                    [self._sock], [], [], min(self._settle, remaining))[0]:
+                break
+        return True
+
+
+class IpDetector:
+    """
+    Detects public ip changes.
+
+    Local network changes trigger an immediate check, otherwise the ip is
+    polled every `interval` seconds.
+    """
+    def __init__(self, interval=INTERVAL, sources=None, watcher=None,
+                 rechecks=RECHECK_DELAYS):
+        self._interval = interval
+        self._sources = sources
+        self._watcher = watcher or NetlinkWatcher()
+        self._rechecks = rechecks
+        self._pending = []
+        self.ip = None
+
+    def refresh(self):
+        try:
+            self.ip = get_ip(self._sources)
+
+        except ValueError:
+            LOGGER.exception('Error getting ip')
+        return self.ip
+
+    def wait(self):
+        "Block until the ip changes or interval elapses, returns the ip."
+        last = self.ip
+        while True:
+            timeout = self._pending.pop(0) if self._pending \
+                else self._interval
+            changed = self._watcher.wait(timeout)
+            if changed:
+                LOGGER.info('Network change detected')
+                self._pending = list(self._rechecks)
+            if self.refresh() != last:
+                LOGGER.info('Ip changed: %s -> %s', last, self.ip)
+                self._pending = []
+                return self.ip
+            if not changed and not self._pending:
+                # Interval elapsed without change.
+                return self.ip
+
+
+RESULT_UPDATED = 'updated'
+RESULT_SKIPPED = 'skipped'
+RESULT_CURRENT = 'current'
+RESULT_FAILED = 'failed'
+RESULT_TIMEOUT = 'timeout'
+RESULTS_OK = (RESULT_UPDATED, RESULT_SKIPPED, RESULT_CURRENT)
+
+_EXECUTOR = None
+_LAST_ROUND = None
+_LIMITS = defaultdict(lambda: threading.BoundedSemaphore(PROVIDER_CONCURRENCY))
+_LIMITS_LOCK = threading.Lock()
+
+
+def _executor():
+    global _EXECUTOR
+
+    if _EXECUTOR is None:
+        _EXECUTOR = ThreadPoolExecutor(
+            max_workers=MAX_WORKERS, thread_name_prefix='dyndns')
+    return _EXECUTOR
+
+
+def _limit(provider):
+    "Semaphore limiting concurrent calls to a single provider."
+    with _LIMITS_LOCK:
+        return _LIMITS[provider]
+
+
+class CloudflareClient:
+    """
+    Updates the A records of one Cloudflare zone.
+
+    A single HTTP session is kept for the life of the client, record ids are
+    listed once per zone rather than once per record, and all changes are
+    sent as one batch request.
+    """
+    API_URL = 'https://api.cloudflare.com/client/v4'
+
+    def __init__(self, options, version=PDDNS_VERSION, api_url=API_URL,
+                 timeout=UPDATE_TIMEOUT):
+        self._zone_url = f'{api_url}/zones/{options["Zone"]}/dns_records'
+        self._proxied = str(options.get('Proxied', '')).lower() in (
+            '1', 'true', 'yes')
+        self._timeout = timeout
+        self._records = None
+        self._lock = threading.Lock()
+        self._session = requests.Session()
+        self._session.headers.update({
+            'Authorization': f'Bearer {options["API_Token"]}',
+            'User-Agent': f'PDDNS v{version}',
+        })
+        if options.get('Email'):
+            self._session.headers['X-Auth-Email'] = options['Email']
+
+    def close(self):
+        self._session.close()
+
+    def _send(self, method, url, **kwargs):
+        r = self._session.request(method, url, timeout=self._timeout, **kwargs)
+        output = r.json()
+        if not output.get('success'):
+            raise ValueError(f'Cloudflare error: {output.get("errors")}')
+        return output
+
+    def _load_records(self):
+        records, page = {}, 1
+        while True:
+            output = self._send('GET', self._zone_url, params={
+                'type': 'A', 'page': page, 'per_page': 1000,
+            })
+            for record in output['result']:
+                records[record['name']] = record['id']
+            if page >= output.get('result_info', {}).get('total_pages', 1):
+                break
+            page += 1
+        LOGGER.debug('Loaded %i records from zone', len(records))
+        return records
+
+    def update(self, records):
+        "Set the A record of each name to the given ip, in one request."
+        with self._lock:
+            if self._records is None:
+                self._records = self._load_records()
+            patches, posts = [], []
+            for name, ip in records.items():
+                record_id = self._records.get(name)
+                if record_id:
+                    patches.append({'id': record_id, 'content': ip})
+                else:
+                    posts.append({
+                        'type': 'A', 'name': name, 'content': ip,
+                        'proxied': self._proxied,
+                    })
+            try:
+                output = self._send(
+                    'POST', f'{self._zone_url}/batch',
+                    json={'patches': patches, 'posts': posts})
+
+            except Exception:
+                # NOTE: records may have changed outside of our control.
+                self._records = None
+                raise
+
+            for record in output['result'].get('posts') or []:
+                self._records[record['name']] = record['id']
+
+
+# Providers with a batch capable client, and the options that identify the
+# account (and zone) rather than a record.
+BATCH_PROVIDERS = {
+    'cloudflare': CloudflareClient,
+}
+RECORD_OPTIONS = ('Name', 'ip address')
+
+_CLIENTS = {}
+_CLIENTS_LOCK = threading.Lock()
+
+
+def _client(key, factory):
+    "Get or create a cached provider client."
+    with _CLIENTS_LOCK:
+        try:
+            return _CLIENTS[key]
+
+        except KeyError:
+            client = _CLIENTS[key] = factory()
+            return client
+
+
+def _account(options):
+    return json.dumps({
+        k: v for k, v in options.items() if k not in RECORD_OPTIONS
+    }, sort_keys=True, default=str)
+
+
+def _record_key(klass, config):
+    # NOTE: pddns clients are bound to a single record and hold no session,
+    # so they are cached per record. Sharing one per account would serialize
+    # its updates.
+    return (klass, json.dumps(config, sort_keys=True, default=str))
+
+
+def prune_clients(domains):
+    "Drop cached clients that no domain in the list uses anymore."
+    keys = set()
+    for domain in domains:
+        provider = domain.get('provider')
+        options = dict(domain.get('options') or {}, Name=domain.get('name'))
+        if provider in BATCH_PROVIDERS:
+            keys.add((BATCH_PROVIDERS[provider], _account(options)))
+        elif provider in PROVIDERS:
+            config_name, klass = PROVIDERS[provider]
+            keys.add(_record_key(klass, {config_name: options}))
+
+    with _CLIENTS_LOCK:
+        stale = [
+            _CLIENTS.pop(key) for key in list(_CLIENTS) if key not in keys
+        ]
+
+    for cached in stale:
+        close = getattr(cached, 'close', None)
+        if close:
+            close()
+
+
+def _update(names, provider, klass, config, ip, started):
+    with _limit(provider):
+        started[names] = time.monotonic()
+        LOGGER.info(
+            'Updating: %s, provider=%s', names[0], provider)
+        key = _record_key(klass, config)
+        _client(key, lambda: klass(config, PDDNS_VERSION)).main(ip, None)
+
+
+def _update_batch(names, provider, options, records, started):
+    with _limit(provider):
+        started[names] = time.monotonic()
+        LOGGER.info(
+            'Updating: %i records, provider=%s', len(records), provider)
+        klass = BATCH_PROVIDERS[provider]
+        key = (klass, _account(options))
+        _client(key, lambda: klass(options)).update(records)
+
+
+def _cached(cache, ip, update, names, *args):
+    "Run update, then cache ip for names, also when the round gave up."
+    update(names, *args)
+    cache.update(list(names), ip)
+
+
+def _collect(futures, started, results):
+    "Wait for updates to complete, abandoning any that exceed timeout."
+    pending = set(futures)
+    while pending:
+        done, pending = wait(
+            pending, timeout=min(1.0, UPDATE_TIMEOUT),
+            return_when=FIRST_COMPLETED)
+
+        for future in done:
+            names = futures[future]
+            try:
+                future.result()
+
+            except Exception as e:
+                LOGGER.error(
+                    'Error updating ip: %s', ', '.join(names), exc_info=e)
+                for domain_name in names:
+                    results[domain_name] = (RESULT_FAILED, e)
+                continue
+
+            for domain_name in names:
+                results[domain_name] = (RESULT_UPDATED, None)
+
+        now = time.monotonic()
+        for future in list(pending):
+            names = futures[future]
+            start = started.get(names)
+            if start is None or now - start < UPDATE_TIMEOUT:
+                continue
+            # NOTE: the call can not be interrupted, it is left to finish
+            # in the background and its result is ignored.
+            LOGGER.error('Timed out updating: %s', ', '.join(names))
+            pending.discard(future)
+            for domain_name in names:
+                results[domain_name] = (
+                    RESULT_TIMEOUT, TimeoutError(f'{domain_name} timed out'))
+
+
+def _resolver(nameservers=None, timeout=None):
+    # NOTE: dnspython is slow to import, defer it until needed.
+    import dns.resolver
+
+    nameservers = nameservers or PRECHECK_RESOLVER
+    resolver = dns.resolver.Resolver(configure=not nameservers)
+    if nameservers:
+        resolver.nameservers = nameservers
+    resolver.lifetime = timeout or PRECHECK_TIMEOUT
+    return resolver
+
+
+def _lookup(resolver, name):
+    import dns.resolver
 
-def request(path, headers=None):
-    urlp = urlparse(CONSOLE_URL)
-    headers = headers.copy() if headers else {}
-    headers.update({
-        'Authorization': f'Bearer {CONSOLE_AUTH_TOKEN}',
-    })
-    c = client.HTTPConnection(urlp.hostname, urlp.port)
-    c.request('GET', path, headers=headers)
-    r = c.getresponse()
-    assert r.status == 200, f'Invalid HTTP status {r.status}'
-    return json.loads(r.read().decode())['objects']
-
-
-def update_dns(ip):
     try:
-        domains = request('/api/domains/')
+        answers = resolver.resolve(name, 'A')
 
-    except Exception:
-        LOGGER.exception('Error getting domain list')
-        return
+    except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+        return []
+
+    return sorted(answer.to_text() for answer in answers)
+
+
+def precheck(names, resolver=None):
+    """
+    Look up the published A records of names concurrently.
+
+    Returns a dict mapping name to a list of addresses. Names that could not
+    be looked up are omitted.
+    """
+    resolver = resolver or _resolver()
+    futures = {
+        _executor().submit(_lookup, resolver, name): name for name in names
+    }
+    published = {}
+    done, _ = wait(futures, timeout=resolver.lifetime + 1.0)
+    for future in done:
+        try:
+            published[futures[future]] = future.result()
+
+        except Exception as e:
+            LOGGER.debug('Error looking up %s: %s', futures[future], e)
+    return published
+
+
+def update_domains(domains, ip, resolver=None):
+    """
+    Update the given domains concurrently.
 
+    When PRECHECK is enabled, domains that are not in the cache are first
+    looked up in DNS and only updated if the published record differs.
+
+    Returns a dict mapping domain name to a (result, error) tuple.
+    """
+    results = {}
+    jobs = []
     for domain in domains:
         config = {}
         try:
@@ -97,39 +722,279 @@ def update_dns(ip):
 #            if 'nameservers' in domain:
 #                options['Nameservers'] = domain['Nameservers']
 
-        except Exception:
+        except Exception as e:
             LOGGER.exception('Error initializing client: %s', pformat(domain))
+            results[domain.get('name')] = (RESULT_FAILED, e)
             continue
 
-        if ip == IP_CACHE.get(domain_name):
+        if ip == IP_CACHE.get(domain_name, max_age=CACHE_TTL):
             # If the ip has not changed since last run, don't update it.
             LOGGER.debug(
                 'Skipping: %s, provider=%s, no ip change',
                 domain_name, provider)
+            results[domain_name] = (RESULT_SKIPPED, None)
             continue
 
-        LOGGER.info(
-            'Updating: %s, provider=%s', domain_name, provider)
+        # NOTE: if ip address is defined, it is a static record, use that
+        # ip rather than the detected one.
+        client_ip = options.get('ip address') or ip
+        jobs.append((domain_name, provider, klass, config, client_ip))
+
+    if jobs and (PRECHECK or resolver):
+        published = precheck([job[0] for job in jobs], resolver)
+        remaining = []
+        for job in jobs:
+            domain_name, client_ip = job[0], job[4]
+            if published.get(domain_name) != [client_ip]:
+                remaining.append(job)
+                continue
+            LOGGER.debug('Skipping: %s, record is current', domain_name)
+            results[domain_name] = (RESULT_CURRENT, None)
+        jobs = remaining
+        IP_CACHE.update([
+            name for name, (result, _) in results.items()
+            if result == RESULT_CURRENT
+        ], ip)
+
+    futures, started, batches = {}, {}, defaultdict(dict)
+    for domain_name, provider, klass, config, client_ip in jobs:
+        if provider in BATCH_PROVIDERS:
+            # NOTE: records sharing an account are sent together.
+            options = next(iter(config.values()))
+            batch = batches[(provider, _account(options))]
+            batch.setdefault('options', options)
+            batch.setdefault('records', {})[domain_name] = client_ip
+            continue
+        future = _executor().submit(
+            _cached, IP_CACHE, ip, _update, (domain_name, ), provider, klass,
+            config, client_ip, started)
+        futures[future] = (domain_name, )
+
+    for (provider, _), batch in batches.items():
+        names = tuple(batch['records'])
+        future = _executor().submit(
+            _cached, IP_CACHE, ip, _update_batch, names, provider,
+            batch['options'], batch['records'], started)
+        futures[future] = names
+
+    # NOTE: each update is cached as it completes, so a crash mid-round
+    # does not have them all sent again.
+    _collect(futures, started, results)
+    return results
+
+
+def update_dns(ip, resolver=None):
+    "Update all domains, skipping the round if nothing changed."
+    global _LAST_ROUND
+
+    try:
+        domains, changed = fetch_domains()
+
+    except Exception:
+        LOGGER.exception('Error getting domain list')
+        return {}
+
+    if changed:
+        prune_clients(domains)
+
+    if not changed and _LAST_ROUND == (ip, True):
+        # Neither the domain list nor the ip changed and every domain was
+        # up to date after the last round.
+        LOGGER.debug('Skipping round, nothing changed')
+        return {}
+
+    results = update_domains(domains, ip, resolver)
+    clean = all(
+        result in RESULTS_OK for result, _ in results.values())
+    _LAST_ROUND = (ip, clean)
+    return results
+
+
+class Scheduler:
+    """
+    Tracks when each domain is next due for an update.
+
+    Domains are kept in a heap ordered by due time. Each is rechecked every
+    `interval` seconds (with jitter so they do not line up), failures are
+    retried with jittered exponential backoff and no record is updated more
+    often than its provider allows.
+    """
+    def __init__(self, interval=INTERVAL, provider_intervals=None,
+                 retry=RETRY_DELAY, max_retry=MAX_RETRY_DELAY,
+                 spread=STARTUP_SPREAD):
+        self._interval = interval
+        self._provider_intervals = PROVIDER_INTERVALS \
+            if provider_intervals is None else provider_intervals
+        self._retry = retry
+        self._max_retry = max_retry
+        self._spread = spread
+        self._heap = []
+        self._entries = {}
+        self._domains = {}
+        self._updated = {}
+        self._failures = defaultdict(int)
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        return len(self._domains)
+
+    def _earliest(self, name):
+        "Earliest time the provider allows this record to be updated."
+        last = self._updated.get(name)
+        if last is None:
+            return 0
+        provider = self._domains[name].get('provider')
+        return last + self._provider_intervals.get(provider, 0)
+
+    def _push(self, name, due):
+        due = max(due, self._earliest(name))
+        # NOTE: replaced entries are left in the heap and skipped when popped.
+        entry = self._entries[name] = (due, next(self._counter), name)
+        heapq.heappush(self._heap, entry)
+
+    def due(self, name):
+        return self._entries[name][0]
+
+    def set_domains(self, domains):
+        """
+        Replace the domain list.
+
+        New and changed domains are scheduled right away, the names of the
+        changed ones are returned.
+        """
+        now = time.monotonic()
+        changed = []
+        with self._cond:
+            domains = {domain.get('name'): domain for domain in domains}
+            for name in set(self._domains).difference(domains):
+                self._domains.pop(name)
+                self._entries.pop(name, None)
+                self._updated.pop(name, None)
+                self._failures.pop(name, None)
+            for name, domain in domains.items():
+                old = self._domains.get(name)
+                self._domains[name] = domain
+                if old is None:
+                    self._push(name, now + random.uniform(0, self._spread))
+                    continue
+                if old == domain:
+                    continue
+                # NOTE: failures of the old settings do not count, nor does
+                # the last update when the record moved to another provider.
+                self._failures.pop(name, None)
+                if old.get('provider') != domain.get('provider'):
+                    self._updated.pop(name, None)
+                self._push(name, now)
+                changed.append(name)
+            self._cond.notify_all()
+        return changed
+
+    def wake(self, names=None):
+        "Make domains (default all) due now, within provider limits."
+        now = time.monotonic()
+        with self._cond:
+            for name in names or list(self._domains):
+                if name in self._domains:
+                    self._push(name, now)
+            self._cond.notify_all()
+
+    def wait(self, timeout=None):
+        "Wait for and return the domains that are due."
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                due = []
+                while self._heap and self._heap[0][0] <= now:
+                    entry = heapq.heappop(self._heap)
+                    if self._entries.get(entry[2]) is not entry:
+                        continue
+                    del self._entries[entry[2]]
+                    due.append(self._domains[entry[2]])
+                if due:
+                    return due
+                wait = None if deadline is None else deadline - now
+                if self._heap:
+                    until = self._heap[0][0] - now
+                    wait = until if wait is None else min(wait, until)
+                if wait is not None and wait <= 0:
+                    return []
+                self._cond.wait(wait)
+
+    def done(self, results):
+        "Reschedule domains based on their update results."
+        now = time.monotonic()
+        with self._cond:
+            for name, (result, _) in results.items():
+                if name not in self._domains:
+                    continue
+                if result in RESULTS_OK:
+                    if result == RESULT_UPDATED:
+                        self._updated[name] = now
+                    self._failures.pop(name, None)
+                    delay = self._interval * random.uniform(0.9, 1.1)
+                else:
+                    failures = self._failures[name] = \
+                        self._failures[name] + 1
+                    delay = min(
+                        self._retry * 2 ** (failures - 1), self._max_retry)
+                    delay *= random.uniform(0.5, 1.0)
+                entry = self._entries.get(name)
+                if entry and entry[0] <= now + delay:
+                    # Woken while updating, keep the earlier time.
+                    continue
+                self._push(name, now + delay)
+            self._cond.notify_all()
+
+
+def _watch_ip(detector, scheduler):
+    while True:
+        last = detector.ip
+        if detector.wait() != last:
+            scheduler.wake()
+
+
+def _watch_domains(scheduler, interval=FETCH_INTERVAL):
+    while True:
         try:
-            # NOTE: if ip address is defined, it is a static record, use that
-            # ip rather than the detected one.
-            client_ip = options.get('ip address') or ip
-            klass(config, PDDNS_VERSION).main(client_ip, None)
-            IP_CACHE[domain_name] = ip
+            domains, changed = fetch_domains()
+            if changed:
+                # NOTE: the ip cached for a changed domain was published
+                # with its old settings.
+                IP_CACHE.discard(scheduler.set_domains(domains))
+                prune_clients(domains)
 
         except Exception:
-            LOGGER.exception('Error updating ip.')
-            continue
+            LOGGER.exception('Error getting domain list')
+        time.sleep(interval)
 
 
 def main():
-    signal.signal(signal.SIGTERM, _save_cache)
+    global IP_CACHE
+
+    signal.signal(signal.SIGTERM, _shutdown)
+    IP_CACHE = IpCache(CACHE_PATH)
+    # NOTE: provider libraries do not set a timeout on their requests.
+    socket.setdefaulttimeout(UPDATE_TIMEOUT)
     LOGGER.info('Starting dyndns client.')
-    while True:
-        update_dns(get_ip())
+    detector = IpDetector()
+    detector.refresh()
+    scheduler = Scheduler()
+    threading.Thread(
+        target=_watch_ip, args=(detector, scheduler), daemon=True).start()
+    threading.Thread(
+        target=_watch_domains, args=(scheduler, ), daemon=True).start()
 
-        LOGGER.info('Slumbering for %i seconds...', INTERVAL)
-        time.sleep(INTERVAL)
+    while True:
+        due = scheduler.wait()
+        if not due:
+            continue
+        LOGGER.debug('%i domains due', len(due))
+        results = update_domains(due, detector.ip) if detector.ip else {}
+        for domain in due:
+            results.setdefault(domain.get('name'), (RESULT_FAILED, None))
+        scheduler.done(results)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,572 @@
+import os
+import time
+import threading
+import logging
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+
+
+HTTP_CACHE_SIZE = int(os.getenv('HTTP_CACHE_SIZE', 64 * 1024 * 1024))
+HTTP_CACHE_ITEM_SIZE = int(os.getenv('HTTP_CACHE_ITEM_SIZE', 4 * 1024 * 1024))
+BUFFER_SIZE = 1024 * 8
+MAX_LINE = 65536
+MAX_HEADERS = 100
+CACHEABLE_METHODS = ('GET', 'HEAD')
+CACHEABLE_STATUS = (200, 203, 301, 404, 410)
+# NOTE: cached bodies are stored decoded and sent with a Content-Length.
+UNSTORED_HEADERS = ('connection', 'keep-alive', 'transfer-encoding', 'age')
+NOT_MODIFIED_HEADERS = (
+    'cache-control', 'content-location', 'date', 'etag', 'expires', 'vary',
+    'last-modified',
+)
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+
+class HttpError(Exception):
+    pass
+
+
+class Reader:
+    "Buffered reads from a socket or channel."
+    def __init__(self, sock, data=b''):
+        self._sock = sock
+        self._buffer = bytearray(data)
+
+    def _fill(self):
+        data = self._sock.recv(BUFFER_SIZE)
+        if not data:
+            raise EOFError()
+        self._buffer += data
+
+    def readline(self):
+        start = 0
+        while True:
+            i = self._buffer.find(b'\n', start)
+            if i != -1:
+                line = bytes(self._buffer[:i + 1])
+                del self._buffer[:i + 1]
+                return line
+            if len(self._buffer) > MAX_LINE:
+                raise HttpError('Line too long')
+            start = len(self._buffer)
+            self._fill()
+
+    def read(self, size):
+        "Read up to size bytes, at least one."
+        if not self._buffer:
+            self._fill()
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def read_exactly(self, size):
+        chunks = []
+        while size:
+            data = self.read(size)
+            chunks.append(data)
+            size -= len(data)
+        return b''.join(chunks)
+
+    def drain(self):
+        "Returns and clears any buffered data."
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        return data
+
+
+class Message:
+    "An HTTP/1.x request or response head."
+    def __init__(self, start, headers):
+        self.start = start
+        self.headers = headers
+
+    @classmethod
+    def read(cls, reader):
+        line = reader.readline()
+        # Ignore empty lines before a request, see RFC 7230 3.5.
+        while line in (b'\r\n', b'\n'):
+            line = reader.readline()
+        start = line.decode('latin-1').rstrip('\r\n').split(' ', 2)
+        if len(start) < 2:
+            raise HttpError(f'Invalid start line: {line}')
+        headers = []
+        while True:
+            line = reader.readline()
+            if line in (b'\r\n', b'\n'):
+                break
+            if len(headers) == MAX_HEADERS:
+                raise HttpError('Too many headers')
+            name, sep, value = line.decode('latin-1').partition(':')
+            if not sep:
+                raise HttpError(f'Invalid header: {line}')
+            headers.append((name.strip(), value.strip()))
+        return cls(start, headers)
+
+    @property
+    def method(self):
+        return self.start[0].upper()
+
+    @property
+    def target(self):
+        return self.start[1]
+
+    @property
+    def status(self):
+        return int(self.start[1])
+
+    def get(self, name, default=None):
+        name = name.lower()
+        values = [v for k, v in self.headers if k.lower() == name]
+        return ', '.join(values) if values else default
+
+    def remove(self, *names):
+        self.headers = [
+            (k, v) for k, v in self.headers if k.lower() not in names]
+
+    def set(self, name, value):
+        self.remove(name.lower())
+        self.headers.append((name, value))
+
+    def copy(self):
+        return Message(list(self.start), list(self.headers))
+
+    def tokens(self, name):
+        "Lower case, comma separated values of a header."
+        return [
+            t.strip().lower() for t in self.get(name, '').split(',')
+            if t.strip()
+        ]
+
+    @property
+    def chunked(self):
+        return 'chunked' in self.tokens('transfer-encoding')
+
+    @property
+    def keep_alive(self):
+        tokens = self.tokens('connection')
+        version = self.start[0] if self.start[0].startswith('HTTP/') \
+            else self.start[-1]
+        if version == 'HTTP/1.0':
+            return 'keep-alive' in tokens
+        return 'close' not in tokens
+
+    def encode(self):
+        lines = [' '.join(self.start)]
+        lines.extend(f'{k}: {v}' for k, v in self.headers)
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+
+def cache_control(message):
+    "Parse Cache-Control into a dict."
+    directives = {}
+    for token in message.tokens('cache-control'):
+        name, _, value = token.partition('=')
+        directives[name.strip()] = value.strip().strip('"')
+    return directives
+
+
+def _seconds(value):
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return 0
+
+
+def _date(value):
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def freshness(response):
+    "How many seconds a response is fresh for."
+    cc = cache_control(response)
+    for directive in ('s-maxage', 'max-age'):
+        if directive in cc:
+            return _seconds(cc[directive])
+    expires = _date(response.get('expires'))
+    if expires is None:
+        return 0
+    date = _date(response.get('date')) or time.time()
+    return max(0, expires - date)
+
+
+def cacheable(request, response):
+    "Whether a shared cache may store response."
+    if request.method != 'GET' or response.status not in CACHEABLE_STATUS:
+        return False
+    if 'no-store' in cache_control(request) or request.get('authorization'):
+        return False
+    cc = cache_control(response)
+    if 'no-store' in cc or 'private' in cc:
+        return False
+    if response.get('set-cookie') or response.get('vary') == '*':
+        return False
+    return bool(
+        freshness(response) or response.get('etag') or
+        response.get('last-modified'))
+
+
+def _etags(value):
+    return [t.strip().removeprefix('W/') for t in value.split(',')]
+
+
+class Entry:
+    def __init__(self, request, response, body):
+        self.response = response
+        self.body = body
+        self.stored = time.monotonic()
+        self.ttl = freshness(response)
+        self.vary = {
+            name: request.get(name) for name in response.tokens('vary')}
+
+    @property
+    def size(self):
+        return len(self.body) + len(self.response.encode())
+
+    @property
+    def age(self):
+        return time.monotonic() - self.stored
+
+    @property
+    def validators(self):
+        return self.response.get('etag') or \
+            self.response.get('last-modified')
+
+    def matches(self, request):
+        return all(request.get(k) == v for k, v in self.vary.items())
+
+    def fresh(self, request):
+        if 'no-cache' in cache_control(self.response):
+            return False
+        cc = cache_control(request)
+        if 'no-cache' in cc:
+            return False
+        if 'max-age' in cc and self.age > _seconds(cc['max-age']):
+            return False
+        return self.age < self.ttl
+
+    def refresh(self, response):
+        "Update from a 304 response."
+        for name, value in response.headers:
+            if name.lower() in NOT_MODIFIED_HEADERS:
+                self.response.set(name, value)
+        self.stored = time.monotonic()
+        self.ttl = freshness(self.response)
+
+    def not_modified(self, request):
+        "Whether request's own validators match this entry."
+        inm = request.get('if-none-match')
+        if inm is not None:
+            etag = self.response.get('etag')
+            return inm.strip() == '*' or (
+                etag is not None and
+                etag.removeprefix('W/') in _etags(inm))
+        ims = _date(request.get('if-modified-since'))
+        lm = _date(self.response.get('last-modified'))
+        return ims is not None and lm is not None and lm <= ims
+
+    def conditional(self, request):
+        "A copy of request that revalidates this entry."
+        request = request.copy()
+        request.remove('if-none-match', 'if-modified-since')
+        if self.response.get('etag'):
+            request.set('If-None-Match', self.response.get('etag'))
+        if self.response.get('last-modified'):
+            request.set(
+                'If-Modified-Since', self.response.get('last-modified'))
+        return request
+
+    def head(self, request, status='HIT'):
+        "Response head for request, a 304 if request is conditional."
+        if self.not_modified(request):
+            response = Message(
+                [self.response.start[0], '304', 'Not Modified'], [
+                    (k, v) for k, v in self.response.headers
+                    if k.lower() in NOT_MODIFIED_HEADERS
+                ])
+        else:
+            response = self.response.copy()
+            response.set('Content-Length', str(len(self.body)))
+        response.set('Age', str(int(self.age)))
+        response.set('X-Cache', status)
+        return response
+
+
+class HttpCache:
+    """
+    A size bounded LRU cache of HTTP responses, held in memory.
+
+    Entries are keyed by domain and request target, and matched against the
+    request headers named in Vary.
+    """
+    def __init__(self, size=HTTP_CACHE_SIZE, item_size=HTTP_CACHE_ITEM_SIZE):
+        self.max_size = size
+        self.item_size = item_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, request):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or not entry.matches(request):
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, request, response, body):
+        response = response.copy()
+        response.remove(*UNSTORED_HEADERS)
+        entry = Entry(request, response, body)
+        if entry.size > self.item_size:
+            return
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = entry
+            self.size += entry.size
+            while self.size > self.max_size:
+                self._discard(next(iter(self._entries)))
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry.size
+
+    def discard(self, key):
+        with self._lock:
+            self._discard(key)
+
+    def stats(self):
+        return {
+            'cache_hits': self.hits,
+            'cache_misses': self.misses,
+            'cache_revalidated': self.revalidated,
+            'cache_entries': len(self._entries),
+            'cache_bytes': self.size,
+        }
+
+
+def hit_ratio(stats):
+    "Fraction of cacheable requests answered without the backend's body."
+    hits = stats.get('cache_hits', 0) + stats.get('cache_revalidated', 0)
+    total = hits + stats.get('cache_misses', 0)
+    return hits / total if total else 0.0
+
+
+def _no_body(response, request):
+    return request.method == 'HEAD' or response.status in (204, 304) or \
+        response.status < 200
+
+
+def _delimited(response, request):
+    "Whether the end of response can be found without closing."
+    return _no_body(response, request) or response.chunked or \
+        response.get('content-length') is not None
+
+
+def _body(reader, message, request=None):
+    """
+    Yields (raw, data) pieces of a message body.
+
+    Pass the request when reading a response.
+    """
+    if request is not None and _no_body(message, request):
+        return
+    if message.chunked:
+        while True:
+            line = reader.readline()
+            try:
+                size = int(line.split(b';')[0].strip(), 16)
+
+            except ValueError:
+                raise HttpError(f'Invalid chunk size: {line}')
+            if size == 0:
+                trailer = line
+                while True:
+                    line = reader.readline()
+                    trailer += line
+                    if line in (b'\r\n', b'\n'):
+                        break
+                yield trailer, b''
+                return
+            data = reader.read_exactly(size)
+            yield line + data + reader.read_exactly(2), data
+        return
+    length = message.get('content-length')
+    if length is not None:
+        remaining = _seconds(length)
+        while remaining:
+            data = reader.read(min(remaining, BUFFER_SIZE))
+            remaining -= len(data)
+            yield data, data
+        return
+    if request is None:
+        # A request without a length has no body.
+        return
+    # Response delimited by the connection closing.
+    while True:
+        try:
+            data = reader.read(BUFFER_SIZE)
+
+        except EOFError:
+            return
+        yield data, data
+
+
+class HttpProxy:
+    """
+    Serves the HTTP/1.1 requests arriving on a channel.
+
+    Requests go to the backend over a persistent connection, unless a fresh
+    response is cached. Stale responses are revalidated with the backend.
+    Upgraded connections (websockets) are handed off as plain byte pipes.
+    """
+    def __init__(self, channel, domain, connect, cache, handoff=None,
+                 data=b'', disconnect=None):
+        self._channel = channel
+        self._client = Reader(channel, data)
+        self._domain = domain
+        self._connect = connect
+        self._cache = cache
+        self._handoff = handoff
+        self._disconnect = disconnect or (lambda sock: sock.close())
+        self._backend = None
+        self._backend_reader = None
+
+    def run(self):
+        handed_off = False
+        try:
+            while True:
+                try:
+                    request = Message.read(self._client)
+
+                except EOFError:
+                    break
+                if request.get('upgrade') and self._handoff:
+                    self._upgrade(request)
+                    handed_off = True
+                    break
+                if not self._serve(request):
+                    break
+
+        except (EOFError, OSError, HttpError) as e:
+            LOGGER.debug('HTTP connection for %s closed: %s', self._domain, e)
+
+        except Exception:
+            LOGGER.exception('Error proxying HTTP for %s', self._domain)
+
+        finally:
+            if not handed_off:
+                self._close_backend()
+                self._channel.close()
+
+    def _close_backend(self):
+        if self._backend is not None:
+            self._disconnect(self._backend)
+        self._backend = self._backend_reader = None
+
+    def _open_backend(self):
+        if self._backend is None:
+            self._backend = self._connect()
+            if self._backend is None:
+                raise OSError(f'Could not connect to backend: {self._domain}')
+            self._backend_reader = Reader(self._backend)
+        return self._backend
+
+    def _upgrade(self, request):
+        backend = self._open_backend()
+        backend.sendall(request.encode() + self._client.drain())
+        self._backend = None
+        self._handoff(self._channel, backend)
+
+    def _exchange(self, request):
+        "Send request to the backend, returns the (final) response head."
+        reused = self._backend is not None
+        try:
+            backend = self._open_backend()
+            backend.sendall(request.encode())
+            for raw, _ in _body(self._client, request):
+                backend.sendall(raw)
+            response = Message.read(self._backend_reader)
+
+        except (EOFError, OSError):
+            self._close_backend()
+            # NOTE: an idle persistent connection may have been closed by the
+            # backend, retry once if nothing was lost.
+            if not reused or request.chunked or \
+               request.get('content-length', '0') != '0':
+                raise
+            return self._exchange(request)
+        while 100 <= response.status < 200 and response.status != 101:
+            self._channel.sendall(response.encode())
+            response = Message.read(self._backend_reader)
+        return response
+
+    def _send_entry(self, request, entry, status):
+        head = entry.head(request, status)
+        self._channel.sendall(head.encode())
+        if request.method != 'HEAD' and head.status != 304:
+            self._channel.sendall(entry.body)
+
+    def _serve(self, request):
+        "Answer one request, returns whether to keep the connection."
+        key = (self._domain, request.target)
+        cache = self._cache
+        entry = None
+        if request.method in CACHEABLE_METHODS and \
+           'no-store' not in cache_control(request):
+            entry = cache.get(key, request)
+            if entry is not None and entry.fresh(request):
+                cache.hits += 1
+                self._send_entry(request, entry, 'HIT')
+                return request.keep_alive
+
+        upstream = request
+        if entry is not None and entry.validators:
+            upstream = entry.conditional(request)
+        response = self._exchange(upstream)
+
+        if entry is not None and response.status == 304 and \
+           upstream is not request:
+            cache.revalidated += 1
+            entry.refresh(response)
+            self._drain(response, upstream)
+            self._send_entry(request, entry, 'REVALIDATED')
+            return request.keep_alive and response.keep_alive
+
+        if request.method in CACHEABLE_METHODS:
+            cache.misses += 1
+        store = request.method == 'GET' and cacheable(request, response)
+        if entry is not None:
+            cache.discard(key)
+        response.set('X-Cache', 'MISS')
+        self._channel.sendall(response.encode())
+        body, size = [], 0
+        for raw, data in _body(self._backend_reader, response, upstream):
+            self._channel.sendall(raw)
+            if store:
+                body.append(data)
+                size += len(data)
+                store = size <= cache.item_size
+        if store:
+            cache.put(key, request, response, b''.join(body))
+        if not response.keep_alive or not _delimited(response, upstream):
+            self._close_backend()
+            return request.keep_alive and _delimited(response, upstream)
+        return request.keep_alive
+
+    def _drain(self, response, request):
+        for _ in _body(self._backend_reader, response, request):
+            pass
+        if not response.keep_alive:
+            self._close_backend()
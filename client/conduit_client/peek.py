@@ -0,0 +1,78 @@
+"Find which domain a connection is for from its first bytes."
+
+# NOTE: a TLS record is at most 16K, headers larger than this are refused.
+PEEK_LIMIT = 16384 + 5
+
+TLS_HANDSHAKE = 0x16
+TLS_CLIENT_HELLO = 0x01
+TLS_EXT_SERVER_NAME = 0x0000
+
+
+def _normalize(name):
+    return name.lower().rstrip('.') or None
+
+
+def _tls_server_name(data):
+    if len(data) < 5:
+        return None, False
+    length = int.from_bytes(data[3:5], 'big')
+    if len(data) < 5 + length:
+        return None, len(data) >= PEEK_LIMIT
+    if data[5] != TLS_CLIENT_HELLO:
+        return None, True
+    # Skip handshake header, version and random.
+    p = 5 + 4 + 2 + 32
+    try:
+        # Session id, cipher suites and compression methods.
+        p += 1 + data[p]
+        p += 2 + int.from_bytes(data[p:p + 2], 'big')
+        p += 1 + data[p]
+        end = p + 2 + int.from_bytes(data[p:p + 2], 'big')
+        p += 2
+        while p + 4 <= end:
+            ext = int.from_bytes(data[p:p + 2], 'big')
+            size = int.from_bytes(data[p + 2:p + 4], 'big')
+            p += 4
+            if ext == TLS_EXT_SERVER_NAME:
+                # List length, name type and name length.
+                if data[p + 2] != 0:
+                    break
+                size = int.from_bytes(data[p + 3:p + 5], 'big')
+                name = data[p + 5:p + 5 + size].decode('ascii')
+                return _normalize(name), True
+            p += size
+
+    except (IndexError, UnicodeDecodeError):
+        pass
+    return None, True
+
+
+def _http_host(data):
+    end = data.find(b'\r\n\r\n')
+    if end == -1:
+        return None, len(data) >= PEEK_LIMIT
+    for line in data[:end].split(b'\r\n')[1:]:
+        name, _, value = line.partition(b':')
+        if name.strip().lower() != b'host':
+            continue
+        host = value.strip().decode('latin-1')
+        if host.startswith('['):
+            host = host[1:].partition(']')[0]
+        else:
+            host = host.partition(':')[0]
+        return _normalize(host), True
+    return None, True
+
+
+def server_name(data):
+    """
+    Find the TLS SNI or HTTP Host header in data.
+
+    Returns the name, or None, and whether the peek is complete. When it is
+    not, more data is needed.
+    """
+    if not data:
+        return None, False
+    if data[0] == TLS_HANDSHAKE:
+        return _tls_server_name(data)
+    return _http_host(data)
@@ -0,0 +1,142 @@
+import sys
+import time
+import threading
+import tracemalloc
+import logging
+from collections import Counter
+
+
+PROFILE_INTERVAL = 0.005
+# NOTE: reports are sent over the control socket, which limits message size
+# to 65535 bytes. The pickled command around the report needs room too.
+REPORT_LIMIT = 32768
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+
+def _truncate(text, limit=REPORT_LIMIT):
+    "Truncate text to limit bytes of UTF-8."
+    data = text.encode('utf-8', 'surrogatepass')
+    if len(data) <= limit:
+        return text
+    # NOTE: a character cut in half is dropped.
+    return data[:limit].decode('utf-8', 'ignore') + '\n... truncated'
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f'{code.co_filename}:{code.co_name}:{frame.f_lineno}'
+
+
+class Sampler:
+    """
+    Statistical CPU profiler.
+
+    Samples the stacks of all threads at a fixed interval. Nothing is
+    installed in the profiled threads, so it costs nothing when not running
+    and little while running.
+    """
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self._interval = interval
+        self.samples = 0
+        self.stacks = Counter()
+
+    def run(self, seconds):
+        "Sample for the given number of seconds."
+        me = threading.get_ident()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame))
+                    frame = frame.f_back
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+            time.sleep(self._interval)
+
+    def collapsed(self):
+        "Stacks in collapsed format, suitable for flamegraph tools."
+        return '\n'.join(
+            f'{stack} {count}' for stack, count in self.stacks.most_common())
+
+    def report(self, limit=25):
+        own, total = Counter(), Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(';')
+            own[frames[-1]] += count
+            for name in set(frames):
+                total[name] += count
+        n = sum(self.stacks.values()) or 1
+        lines = [f'{self.samples} samples, {n} thread stacks', '', 'own:']
+        for name, count in own.most_common(limit):
+            lines.append(f'{count / n * 100:6.2f}% {name}')
+        lines.extend(['', 'total:'])
+        for name, count in total.most_common(limit):
+            lines.append(f'{count / n * 100:6.2f}% {name}')
+        return '\n'.join(lines)
+
+
+def profile(seconds, path=None, limit=25):
+    """
+    Profile all threads for a number of seconds.
+
+    If path is given the collapsed stacks are written there. Returns a text
+    report.
+    """
+    sampler = Sampler()
+    sampler.run(seconds)
+    if path:
+        with open(path, 'w') as f:
+            f.write(sampler.collapsed())
+    return _truncate(sampler.report(limit))
+
+
+class MemoryTracker:
+    """
+    Wraps tracemalloc, snapshots are compared to the previous one.
+
+    Allocation tracing is only enabled between start() and stop().
+    """
+    def __init__(self):
+        self._last = None
+
+    @property
+    def tracing(self):
+        return tracemalloc.is_tracing()
+
+    def start(self, frames=1):
+        if not self.tracing:
+            tracemalloc.start(frames)
+        self._last = None
+        return 'Tracing started'
+
+    def stop(self):
+        tracemalloc.stop()
+        self._last = None
+        return 'Tracing stopped'
+
+    def snapshot(self, path=None, limit=25):
+        if not self.tracing:
+            raise RuntimeError('Tracing is not started')
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+        ))
+        if path:
+            snapshot.dump(path)
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [f'current={current} peak={peak}', '']
+        if self._last is None:
+            stats = snapshot.statistics('lineno')
+        else:
+            lines.append('change since last snapshot:')
+            stats = snapshot.compare_to(self._last, 'lineno')
+        self._last = snapshot
+        lines.extend(str(stat) for stat in stats[:limit])
+        return _truncate('\n'.join(lines))
+
+
+MEMORY = MemoryTracker()
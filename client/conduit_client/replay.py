@@ -0,0 +1,329 @@
+"""
+Replays a capture through an SSHManager.
+
+A stand-in SSH server and backend are started locally, each captured
+connection is opened through the tunnel between them and its data sent in
+both directions at the captured times, or faster. Reports throughput and
+how long data took to cross the forwarder.
+
+Usage: python3 -m conduit_client.replay [--speed N] capture.bin
+"""
+import sys
+import time
+import queue
+import socket
+import argparse
+import warnings
+import threading
+import statistics
+import logging
+from collections import defaultdict, deque
+
+import paramiko
+
+from conduit_client import ssh, capture
+from conduit_client.ssh import Tunnel
+
+
+DOMAIN = 'replay.test'
+REMOTE_PORT = 1234
+ACCEPT_TIMEOUT = 5.0
+# NOTE: how long to wait for data still in flight when a connection ends.
+DRAIN_TIMEOUT = 5.0
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+
+class _Server(paramiko.ServerInterface):
+    def __init__(self, forwarded):
+        self._forwarded = forwarded
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_channel_request(self, kind, channel_id):
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_port_forward_request(self, address, port):
+        self._forwarded.set()
+        return REMOTE_PORT
+
+    def _control(self, channel):
+        buffer = b''
+        while True:
+            data = channel.recv(1024)
+            if not data:
+                return
+            *lines, buffer = (buffer + data).split(b'\n')
+            for line in lines:
+                seq = line.partition(b' ')[0]
+                channel.sendall(seq + b' ok\n')
+
+    def check_channel_exec_request(self, channel, command):
+        if command == b'control':
+            threading.Thread(
+                target=self._control, args=(channel,), daemon=True).start()
+        return True
+
+
+class Gateway:
+    "Stands in for sshd, accepts one client and opens channels to it."
+    def __init__(self):
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.bind(('127.0.0.1', 0))
+        self._socket.listen(1)
+        self.port = self._socket.getsockname()[1]
+        self.forwarded = threading.Event()
+        self._transport = None
+        self._key = ssh.generate_key('ed25519')[0]
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        client, _ = self._socket.accept()
+        self._transport = paramiko.Transport(client)
+        self._transport.add_server_key(self._key)
+        self._transport.start_server(server=_Server(self.forwarded))
+        # NOTE: hold a reference, an unreferenced channel is closed.
+        self._session = self._transport.accept()
+
+    def open(self):
+        return self._transport.open_forwarded_tcpip_channel(
+            ('127.0.0.1', 0), ('127.0.0.1', REMOTE_PORT))
+
+    def close(self):
+        if self._transport:
+            self._transport.close()
+        self._socket.close()
+
+
+class Backend:
+    "Stands in for the service behind the tunnel."
+    def __init__(self):
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.bind(('127.0.0.1', 0))
+        self._socket.listen(128)
+        self.port = self._socket.getsockname()[1]
+        self.accepted = queue.Queue()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                client, _ = self._socket.accept()
+
+            except OSError:
+                return
+            self.accepted.put(client)
+
+    def close(self):
+        self._socket.close()
+
+
+class Stream:
+    "One direction of a connection, measures how long bytes take to cross."
+    def __init__(self, latencies):
+        self._latencies = latencies
+        self._pending = deque()
+        self._lock = threading.Lock()
+        self._done = threading.Condition(self._lock)
+        self.sent = 0
+        self.received = 0
+
+    def send(self, sock, data):
+        with self._lock:
+            self.sent += len(data)
+            self._pending.append((self.sent, time.perf_counter()))
+        sock.sendall(data)
+
+    def receive(self, sock):
+        "Read from sock until it closes."
+        while True:
+            try:
+                data = sock.recv(ssh.BUFFER_SIZE)
+
+            except OSError:
+                data = b''
+            now = time.perf_counter()
+            with self._lock:
+                self.received += len(data)
+                while self._pending and self._pending[0][0] <= self.received:
+                    self._latencies.append(now - self._pending.popleft()[1])
+                if not data:
+                    self._pending.clear()
+                self._done.notify_all()
+            if not data:
+                return
+
+    def wait(self, timeout=DRAIN_TIMEOUT):
+        "Wait until everything sent is received."
+        with self._lock:
+            self._done.wait_for(
+                lambda: not self._pending, timeout=timeout)
+
+
+class Replay:
+    "Plays records at speed times the captured rate."
+    def __init__(self, records, speed=1.0):
+        self.speed = speed
+        self.connections = defaultdict(list)
+        for record in records:
+            self.connections[record.conn].append(record)
+        self._first = min((r.time for r in records), default=0.0)
+        self._last = max((r.time for r in records), default=0.0)
+        self._start = None
+        self._lock = threading.Lock()
+        self._count_lock = threading.Lock()
+        self.latencies = {capture.KIND_IN: [], capture.KIND_OUT: []}
+        self.bytes = {capture.KIND_IN: 0, capture.KIND_OUT: 0}
+        self.failed = 0
+
+    def _sleep_until(self, t):
+        delay = self._start + (t - self._first) / self.speed - \
+            time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+    def _count(self, name):
+        with self._count_lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def _open(self, gateway, backend):
+        # NOTE: channels are opened one at a time so each can be paired with
+        # the backend connection the forwarder makes for it.
+        with self._lock:
+            channel = gateway.open()
+            try:
+                server = backend.accepted.get(timeout=ACCEPT_TIMEOUT)
+
+            except queue.Empty:
+                channel.close()
+                raise
+        return channel, server
+
+    def _connection(self, records, gateway, backend):
+        self._sleep_until(records[0].time)
+        try:
+            channel, server = self._open(gateway, backend)
+
+        except Exception:
+            LOGGER.exception('Could not open connection')
+            self._count('failed')
+            return
+        streams = {
+            capture.KIND_IN: (Stream(self.latencies[capture.KIND_IN]),
+                              channel, server),
+            capture.KIND_OUT: (Stream(self.latencies[capture.KIND_OUT]),
+                               server, channel),
+        }
+        readers = [
+            threading.Thread(target=stream.receive, args=(r,), daemon=True)
+            for stream, _, r in streams.values()
+        ]
+        for reader in readers:
+            reader.start()
+        try:
+            for record in records:
+                self._sleep_until(record.time)
+                if record.kind == capture.KIND_CLOSE:
+                    break
+                stream, w, _ = streams[record.kind]
+                stream.send(w, record.payload or bytes(record.size))
+                with self._count_lock:
+                    self.bytes[record.kind] += record.size
+
+        except OSError:
+            LOGGER.exception('Error replaying connection')
+            self._count('failed')
+        for stream, _, _ in streams.values():
+            stream.wait()
+        channel.close()
+        server.close()
+        for reader in readers:
+            reader.join(DRAIN_TIMEOUT)
+
+    def run(self):
+        "Replay through a new SSHManager, returns a report dict."
+        gateway, backend = Gateway(), Backend()
+        manager = ssh.SSHManager(
+            '127.0.0.1', gateway.port, 'replay',
+            ssh.generate_key('ed25519')[0])
+        try:
+            manager.add_tunnel(Tunnel(DOMAIN, '127.0.0.1', backend.port))
+            if not gateway.forwarded.wait(ACCEPT_TIMEOUT):
+                raise RuntimeError('Port forward not requested')
+            self._start = time.perf_counter()
+            threads = [
+                threading.Thread(
+                    target=self._connection, args=(records, gateway, backend),
+                    daemon=True)
+                for records in self.connections.values()
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            return self.report(time.perf_counter() - self._start)
+
+        finally:
+            manager.disconnect()
+            gateway.close()
+            backend.close()
+
+    def report(self, elapsed):
+        total = sum(self.bytes.values())
+        report = {
+            'connections': len(self.connections),
+            'failed': self.failed,
+            'bytes_in': self.bytes[capture.KIND_IN],
+            'bytes_out': self.bytes[capture.KIND_OUT],
+            'captured_seconds': self._last - self._first,
+            'replay_seconds': elapsed,
+            'throughput': total / elapsed if elapsed else 0.0,
+        }
+        for kind, name in ((capture.KIND_IN, 'in'),
+                           (capture.KIND_OUT, 'out')):
+            latencies = sorted(self.latencies[kind])
+            for p in (50, 95, 99):
+                report[f'latency_{name}_p{p}'] = \
+                    _percentile(latencies, p) * 1000
+        return report
+
+
+def _percentile(values, p):
+    if not values:
+        return 0.0
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100)[p - 1]
+
+
+def replay(path, speed=1.0):
+    "Replay the capture at path, returns a report dict."
+    _, records = capture.read(path)
+    return Replay(records, speed).run()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Replay a traffic capture through the forwarder.')
+    parser.add_argument('path', help='capture file')
+    parser.add_argument(
+        '--speed', type=float, default=1.0,
+        help='replay this many times faster than captured')
+    args = parser.parse_args(argv)
+    # NOTE: the stand-in server's key is new each run.
+    warnings.filterwarnings('ignore', 'Unknown .* host key')
+    report = replay(args.path, args.speed)
+    for name, value in report.items():
+        if isinstance(value, float):
+            value = f'{value:.3f}'
+        print(f'{name:<24} {value}')
+    return 1 if report['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,4 +1,5 @@
 import os
+import collections
 import subprocess
 import shutil
 import queue
@@ -7,16 +8,34 @@ import struct
 import pickle
 import tempfile
 import threading
+import time
 import logging
 from select import select
 from os.path import dirname, basename
 
-from conduit_client import ssh
-
 
 PYTHON = shutil.which('python3')
 MODULE_PATH = dirname(dirname(__file__))
 MODULE_NAME = basename(dirname(__file__))
+SSH_CONNECT = os.getenv('SSH_CONNECT', '').lower() in ('1', 'true', 'yes')
+START_TIMEOUT = float(os.getenv('SSH_START_TIMEOUT', 30.0))
+# NOTE: a unix socket more clients may control the manager over.
+SSH_CONTROL_SOCKET = os.getenv('SSH_CONTROL_SOCKET', None)
+# NOTE: events queued for a subscriber, one that falls further behind is
+# disconnected and has to subscribe again.
+SSH_EVENT_QUEUE = int(os.getenv('SSH_EVENT_QUEUE', 1024))
+# NOTE: settings read by the manager subprocess, passed on from this
+# process' environment. Its environment holds nothing else.
+MANAGER_ENV = (
+    'SSH_KEY_TYPE', 'SSH_KEEPALIVE_INTERVAL', 'SSH_DEAD_PEER_TIMEOUT',
+    'SSH_CONNECT_TIMEOUT', 'SSH_CONNECT_STAGGER', 'SSH_REEVALUATE_INTERVAL',
+    'SSH_PEEK_TIMEOUT', 'SSH_CONTROL_TIMEOUT', 'SSH_DRAIN_TIMEOUT',
+    'FORWARD_READ_BUDGET', 'FORWARD_COALESCE_DELAY',
+    'HTTP_CACHE_SIZE', 'HTTP_CACHE_ITEM_SIZE',
+    'BALANCE_STRATEGY', 'BACKEND_CONNECT_TIMEOUT', 'BACKEND_EJECT_FAILURES',
+    'BACKEND_EJECT_TIME', 'BACKEND_CHECK_INTERVAL', 'BACKEND_CHECK_TIMEOUT',
+    'BACKEND_CHECK_PATH', 'CAPTURE_PAYLOAD', 'CAPTURE_LIMIT',
+)
 
 LOGGER = logging.getLogger()
 LOGGER.addHandler(logging.NullHandler())
@@ -35,6 +54,13 @@ class Command:
     COMMAND_ADD = 2
     COMMAND_STOP = 3
     COMMAND_LIST = 4
+    COMMAND_STATS = 5
+    COMMAND_READY = 6
+    COMMAND_PROFILE = 7
+    COMMAND_MEMORY = 8
+    COMMAND_LISTEN = 9
+    COMMAND_SUBSCRIBE = 10
+    COMMAND_EVENT = 11
 
     COMMANDS = {
         COMMAND_NOOP: 'noop',
@@ -42,6 +68,13 @@ class Command:
         COMMAND_ADD: 'add',
         COMMAND_STOP: 'stop',
         COMMAND_LIST: 'list',
+        COMMAND_STATS: 'stats',
+        COMMAND_READY: 'ready',
+        COMMAND_PROFILE: 'profile',
+        COMMAND_MEMORY: 'memory',
+        COMMAND_LISTEN: 'listen',
+        COMMAND_SUBSCRIBE: 'subscribe',
+        COMMAND_EVENT: 'event',
     }
 
     def __init__(self, command):
@@ -64,7 +97,14 @@ class Command:
         if not data:
             raise EOFError()
         size = struct.unpack('H', data)[0]
-        return pickle.loads(s.recv(size))
+        data = s.recv(size)
+        # NOTE: large messages may arrive in pieces.
+        while len(data) < size:
+            chunk = s.recv(size - len(data))
+            if not chunk:
+                raise EOFError()
+            data += chunk
+        return pickle.loads(data)
 
     def pack(self):
         data = pickle.dumps(self)
@@ -90,68 +130,399 @@ class ListCommand(Command):
             TunnelCommand(Command.COMMAND_ADD, tunnel).send(socket)
 
 
+class ReadyCommand(Command):
+    def __init__(self, command, connected=False):
+        super().__init__(command)
+        self.connected = connected
+
+
+class StatsCommand(Command):
+    def __init__(self, command, stats=None):
+        super().__init__(command)
+        self.stats = stats
+
+    def apply(self, manager, socket):
+        StatsCommand(Command.COMMAND_STATS, manager.stats()).send(socket)
+
+
+class ProfileCommand(Command):
+    def __init__(self, command, seconds=10.0, path=None, result=None):
+        super().__init__(command)
+        self.seconds = seconds
+        self.path = path
+        self.result = result
+
+    def apply(self, manager, socket):
+        from conduit_client import profiler
+
+        result = profiler.profile(self.seconds, self.path)
+        ProfileCommand(Command.COMMAND_PROFILE, result=result).send(socket)
+
+
+class MemoryCommand(Command):
+    ACTIONS = ('start', 'snapshot', 'stop')
+
+    def __init__(self, command, action='snapshot', path=None, result=None):
+        super().__init__(command)
+        self.action = action
+        self.path = path
+        self.result = result
+
+    def apply(self, manager, socket):
+        from conduit_client import profiler
+
+        if self.action == 'snapshot':
+            result = profiler.MEMORY.snapshot(self.path)
+        elif self.action in self.ACTIONS:
+            result = getattr(profiler.MEMORY, self.action)()
+        else:
+            raise ValueError(f'Invalid action: {self.action}')
+        MemoryCommand(Command.COMMAND_MEMORY, result=result).send(socket)
+
+
+class ListenCommand(Command):
+    "Asks the manager to accept control clients on path."
+    def __init__(self, command, path):
+        super().__init__(command)
+        self.path = path
+
+
+class EventCommand(Command):
+    """
+    Something that changed in the manager.
+
+    event is one of tunnel_added, tunnel_changed, tunnel_removed,
+    port_assigned, transport_up, transport_down, channel_opened or
+    channel_closed, data holds its details.
+    """
+    def __init__(self, command, event, data=None):
+        super().__init__(command)
+        self.event = event
+        self.data = data or {}
+        self.time = time.time()
+
+    def __str__(self):
+        return f'{self.__class__.__name__}: {self.event} {self.data}'
+
+
 class TunnelCommand(Command):
-    def __init__(self, command, tunnel):
+    # NOTE: class default, so commands without a drain pickle as before.
+    drain = None
+
+    def __init__(self, command, tunnel, drain=None):
         super().__init__(command)
         self.tunnel = tunnel
+        if drain is not None:
+            self.drain = drain
 
     def apply(self, manager, socket):
         if self.command == Command.COMMAND_ADD:
             manager.add_tunnel(self.tunnel)
         elif self.command == Command.COMMAND_DEL:
-            manager.del_tunnel(self.tunnel)
+            if self.drain is None:
+                manager.del_tunnel(self.tunnel)
+            else:
+                manager.del_tunnel(self.tunnel, drain=self.drain)
+
+
+class Peer:
+    """
+    A connection to a control client.
+
+    Replies and events are written by different threads, so writes are
+    serialized. Events are queued and written by a thread of their own, so
+    a slow subscriber does not hold up the manager.
+    """
+    def __init__(self, sock):
+        self.socket = sock
+        self._lock = threading.Lock()
+        self._events = None
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def recv(self, size):
+        return self.socket.recv(size)
+
+    def send(self, data):
+        with self._lock:
+            self.socket.sendall(data)
+
+    @property
+    def subscribed(self):
+        return self._events is not None
+
+    def subscribe(self, size=SSH_EVENT_QUEUE):
+        self._events = queue.Queue(size)
+
+    def start(self):
+        "Start writing queued events."
+        threading.Thread(target=self._write_events, daemon=True).start()
+
+    def publish(self, data):
+        "Queue a packed event."
+        try:
+            self._events.put_nowait(data)
+
+        except queue.Full:
+            LOGGER.warning('Subscriber fell behind, disconnecting')
+            self.shutdown()
+
+    def _write_events(self):
+        while True:
+            data = self._events.get()
+            if data is None:
+                return
+            try:
+                self.send(data)
+
+            except OSError:
+                return
+
+    def shutdown(self):
+        "Wake the thread reading from the client, it closes the peer."
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+
+        except OSError:
+            pass
+
+    def close(self):
+        if self._events is not None:
+            # NOTE: make room for the sentinel, nothing is published to a
+            # closed peer.
+            while True:
+                try:
+                    self._events.get_nowait()
+                except queue.Empty:
+                    break
+            self._events.put_nowait(None)
+        self.socket.close()
 
 
 class SSHManagerServer:
-    def __init__(self, sock_name):
+    """
+    Runs an SSHManager for the process that started it.
+
+    The parent is connected to over sock_name. If asked to listen, other
+    control clients can connect too, any client can subscribe to events.
+    """
+    def __init__(self, sock_name, connect=SSH_CONNECT):
         self._sock_name = sock_name
+        self._connect = connect
         self._queue = queue.Queue()
-        self._manager = ssh.create_manager()
+        self._manager = None
+        self._ready = threading.Event()
         self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._listen = None
+        self._subscribers = set()
+        self._lock = threading.Lock()
         self._reader = threading.Thread(target=self._read, daemon=True)
         self._reader.start()
 
+    def _start(self):
+        # NOTE: paramiko is imported here rather than at module level so the
+        # parent process does not need it.
+        from conduit_client import ssh
+
+        self._manager = ssh.create_manager()
+        self._manager.listener = self._publish
+        if self._connect:
+            try:
+                self._manager.connect()
+
+            except Exception:
+                LOGGER.exception('Error connecting')
+
+        self._ready.set()
+        ReadyCommand(
+            Command.COMMAND_READY, connected=self._manager.connected
+        ).send(self._socket)
+
     def _read(self):
-        noop = Command(Command.COMMAND_NOOP)
         try:
             self._socket.connect(self._sock_name)
+            self._start()
+            self._serve(Peer(self._socket), parent=True)
 
-            while True:
-                try:
-                    cmd = Command.unpack(self._socket)
+        finally:
+            self._socket.close()
+            if self._listen:
+                self._listen.close()
+            # NOTE: without the parent nothing can be done, stop so that it
+            # starts a new process.
+            self._queue.put(None)
+            self._ready.set()
+
+    def listen(self, path):
+        "Accept control clients on path."
+        if self._listen is not None:
+            return
+        # NOTE: a manager that died may have left its socket behind.
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        self._listen = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._listen.bind(path)
+        # NOTE: control clients can add tunnels, only the owner may connect.
+        os.chmod(path, 0o600)
+        self._listen.listen()
+        threading.Thread(target=self._accept, daemon=True).start()
+        LOGGER.info('Accepting control clients on %s', path)
+
+    def _accept(self):
+        while True:
+            try:
+                sock, _ = self._listen.accept()
+
+            except OSError:
+                return
+            threading.Thread(
+                target=self._client, args=(Peer(sock),), daemon=True
+            ).start()
+
+    def _client(self, peer):
+        LOGGER.debug('Control client connected')
+        try:
+            self._serve(peer)
+
+        finally:
+            with self._lock:
+                self._subscribers.discard(peer)
+            peer.close()
+            LOGGER.debug('Control client disconnected')
+
+    def _subscribe(self, peer):
+        "Send peer the tunnels, then the events from now on."
+        peer.subscribe()
+        # NOTE: subscribed before the snapshot, so no event is missed in
+        # between. The events are written only after the snapshot.
+        with self._lock:
+            self._subscribers.add(peer)
+        ListCommand(Command.COMMAND_LIST).apply(self._manager, peer)
+        Command(Command.COMMAND_NOOP).send(peer)
+        peer.start()
+
+    def _publish(self, event, data):
+        "Send an event from the manager to the subscribers."
+        if not self._subscribers:
+            return
+        with self._lock:
+            subscribers = list(self._subscribers)
+        packed = EventCommand(Command.COMMAND_EVENT, event, data).pack()
+        for peer in subscribers:
+            peer.publish(packed)
+
+    def _reply(self, cmd, peer):
+        "Send the reply to cmd followed by a noop that ends it."
+        try:
+            cmd.apply(self._manager, peer)
 
-                except EOFError:
+        except Exception:
+            LOGGER.exception('Error handling command')
+        try:
+            Command(Command.COMMAND_NOOP).send(peer)
+
+        except OSError:
+            LOGGER.debug('Peer disconnected before the reply')
+
+    def _serve(self, peer, parent=False):
+        "Handle commands from peer until it disconnects or stops."
+        noop = Command(Command.COMMAND_NOOP)
+        while True:
+            try:
+                cmd = Command.unpack(peer)
+
+            except (EOFError, OSError):
+                if parent:
                     LOGGER.error('EOF encountered, exiting')
-                    return
+                return
 
-                except Exception:
-                    LOGGER.exception('Error reading command.')
-                    continue
+            except Exception:
+                LOGGER.exception('Error reading command.')
+                continue
+
+            LOGGER.debug('Received command: %s, acking', cmd)
 
-                LOGGER.debug('Received command: %s, acking', cmd)
+            if cmd.command in (Command.COMMAND_LIST,
+                               Command.COMMAND_STATS):
+                self._reply(cmd, peer)
+                continue
+
+            elif cmd.command in (Command.COMMAND_PROFILE,
+                                 Command.COMMAND_MEMORY):
+                # NOTE: profiling takes seconds, commands from peer are
+                # served meanwhile and the reply is sent once it is done.
+                threading.Thread(
+                    target=self._reply, args=(cmd, peer), daemon=True
+                ).start()
+                continue
 
-                if cmd.command == Command.COMMAND_LIST:
-                    cmd.apply(self._manager, self._socket)
-                    noop.send(self._socket)
+            elif cmd.command == Command.COMMAND_SUBSCRIBE:
+                if peer.subscribed:
+                    noop.send(peer)
                     continue
+                self._subscribe(peer)
+                continue
 
-                elif cmd.command == Command.COMMAND_STOP:
-                    LOGGER.info('Exiting')
-                    return
+            elif cmd.command == Command.COMMAND_LISTEN and parent:
+                try:
+                    self.listen(cmd.path)
 
-                noop.send(self._socket)
-                self._queue.put(cmd)
+                except OSError:
+                    LOGGER.exception('Could not listen on %s', cmd.path)
+                noop.send(peer)
+                continue
 
-        finally:
-            self._socket.close()
+            elif cmd.command == Command.COMMAND_STOP:
+                # NOTE: only the parent stops the manager, other clients
+                # just disconnect.
+                if parent:
+                    LOGGER.info('Exiting')
+                return
+
+            noop.send(peer)
+            self._queue.put(cmd)
 
     def run_forever(self):
+        "Run the manager until the parent disconnects."
+        self._ready.wait()
+        if self._manager is None:
+            return
         while True:
             self._manager.poll()
             try:
-                command = self._queue.get(timeout=10.0)
+                commands = [self._queue.get(timeout=10.0)]
             except queue.Empty:
                 continue
+            # NOTE: drain the queue so bursts of adds are registered at once.
+            while True:
+                try:
+                    commands.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in commands:
+                self._apply(commands[:commands.index(None)])
+                LOGGER.info('Parent disconnected, exiting')
+                return
+            self._apply(commands)
+
+    def _apply(self, commands):
+        "Apply commands in order, consecutive adds are applied as a batch."
+        adds = []
+        for command in commands + [None]:
+            if isinstance(command, TunnelCommand) and \
+               command.command == Command.COMMAND_ADD:
+                adds.append(command.tunnel)
+                continue
+            try:
+                if adds:
+                    self._manager.add_tunnels(adds)
+
+            except Exception:
+                LOGGER.exception('Error adding tunnels')
+            adds = []
             if not isinstance(command, TunnelCommand):
                 continue
             try:
@@ -160,73 +531,95 @@ class SSHManagerServer:
                 LOGGER.exception('Error handling command')
 
 
-class SSHManagerClient:
-    def __init__(self, host=None, port=None, user=None, key=None,
-                 host_keys=None):
-        self._env = {}
-        _set_if_not_none(self._env, 'SSH_HOST', host)
-        _set_if_not_none(self._env, 'SSH_PORT', port)
-        _set_if_not_none(self._env, 'SSH_USER', user)
-        _set_if_not_none(self._env, 'SSH_KEY_FILE', key)
-        _set_if_not_none(self._env, 'SSH_HOST_KEYS_FILE', host_keys)
-        self._sock_name = None
-        self._listen = None
-        self._socket = None
-        self._server = None
-        self._lock = threading.Lock()
+class ManagerProcess:
+    "A manager subprocess and the socket used to talk to it."
+    def __init__(self, env):
+        self.sock_name = tempfile.mktemp()
+        self.socket = None
+        self.connected = False
+        self._listen = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._listen.bind(self.sock_name)
+        self._listen.listen()
+        self.popen = subprocess.Popen(
+            [PYTHON, '-m', MODULE_NAME, self.sock_name],
+            cwd=MODULE_PATH,
+            env=env
+        )
 
-    def __del__(self):
-        self.close()
+    @property
+    def alive(self):
+        return self.popen.poll() is None
+
+    @property
+    def ready(self):
+        return self.socket is not None
+
+    def wait_ready(self, timeout=START_TIMEOUT):
+        "Wait for the subprocess to connect and report ready."
+        if self.ready:
+            return
+        self._listen.settimeout(timeout)
+        try:
+            sock, _ = self._listen.accept()
+
+        except socket.timeout:
+            raise TimeoutError('Manager process did not connect')
+
+        cmd = Command.unpack(sock, timeout=timeout)
+        if cmd.command != Command.COMMAND_READY:
+            sock.close()
+            raise ValueError(f'Expected ready, received: {cmd}')
+        self.connected = cmd.connected
+        self.socket = sock
+        self._listen.close()
+        self._listen = None
 
     def close(self):
-        if self._socket:
-            self._socket.close()
-            self._socket = None
+        if self.socket:
+            self.socket.close()
+            self.socket = None
         if self._listen:
             self._listen.close()
             self._listen = None
-
-    def _start_server(self):
-        if self._server is not None and self._server.poll() is None:
-            return
-        self._sock_name = tempfile.mktemp()
-        self._listen = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        self._listen.bind(self._sock_name)
-        self._listen.listen()
-        self._server = subprocess.Popen(
-            [PYTHON, '-m', MODULE_NAME, self._sock_name],
-            cwd=MODULE_PATH,
-            env=self._env
-        )
-        self._socket, _ = self._listen.accept()
-
-    def disconnect(self, timeout=None):
         try:
-            self._send_command(Command(Command.COMMAND_STOP))
-        except EOFError:
+            os.remove(self.sock_name)
+        except FileNotFoundError:
             pass
-        self.close()
-        os.remove(self._sock_name)
-        self._server.kill()
-        self._server = None
+        self.popen.kill()
+        self.popen.wait()
+
+
+class _CommandClient:
+    "Commands common to the clients of an SSHManagerServer."
+    def __init__(self):
+        # NOTE: tunnels added through this client, SSHManagerClient replays
+        # them to a replacement server.
+        self._tunnels = {}
+        # NOTE: events received while waiting for a reply.
+        self._events = collections.deque()
+        self.subscribed = False
+        self._lock = threading.Lock()
 
-    def _send_command(self, cmd):
+    def _exchange(self, cmd, timeout=1.0):
         reply = []
-        self._lock.acquire(timeout=1.0)
-        try:
-            self._start_server()
-            cmd.send(self._socket)
+        cmd.send(self._socket)
 
-            while True:
-                cmd = Command.unpack(self._socket, timeout=1.0)
-                if cmd.command == Command.COMMAND_NOOP:
-                    break
-                reply.append(cmd)
+        while True:
+            cmd = Command.unpack(self._socket, timeout=timeout)
+            if cmd.command == Command.COMMAND_NOOP:
+                break
+            if cmd.command == Command.COMMAND_EVENT:
+                # NOTE: events of a subscription arrive between replies.
+                self._events.append(cmd)
+                continue
+            reply.append(cmd)
 
-            return reply
+        return reply
 
-        finally:
-            self._lock.release()
+    def _send_command(self, cmd, timeout=1.0):
+        with self._lock:
+            self._start_server()
+            return self._exchange(cmd, timeout)
 
     def ping(self):
         self._send_command(Command(Command.COMMAND_NOOP))
@@ -236,14 +629,234 @@ class SSHManagerClient:
             TunnelCommand(
                 Command.COMMAND_ADD, tunnel)
         )
+        self._tunnels[tunnel.domain] = tunnel
+
+    def del_tunnel(self, tunnel, drain=None):
+        """
+        Remove a tunnel.
 
-    def del_tunnel(self, tunnel):
+        Open channels are closed after drain seconds, SSH_DRAIN_TIMEOUT by
+        default.
+        """
         self._send_command(
-            TunnelCommand(Command.COMMAND_DEL, tunnel)
+            TunnelCommand(Command.COMMAND_DEL, tunnel, drain)
         )
+        self._tunnels.pop(tunnel.domain, None)
 
     def list_tunnels(self):
         reply = self._send_command(
             ListCommand(Command.COMMAND_LIST)
         )
         return [r.tunnel for r in reply]
+
+    def stats(self):
+        reply = self._send_command(
+            StatsCommand(Command.COMMAND_STATS)
+        )
+        return reply[0].stats
+
+    def profile(self, seconds=10.0, path=None):
+        """
+        Sample the CPU usage of the manager process for some seconds.
+
+        Returns a text report, if path is given the collapsed stacks are
+        also written to that file (by the manager process).
+        """
+        reply = self._send_command(
+            ProfileCommand(Command.COMMAND_PROFILE, seconds, path),
+            timeout=seconds + 5.0
+        )
+        if not reply:
+            raise RuntimeError('Profiling failed')
+        return reply[0].result
+
+    def memory(self, action='snapshot', path=None):
+        """
+        Control memory tracing in the manager process.
+
+        action is one of start, snapshot or stop. Each snapshot is reported
+        as a difference from the previous one.
+        """
+        reply = self._send_command(
+            MemoryCommand(Command.COMMAND_MEMORY, action, path),
+            timeout=30.0
+        )
+        if not reply:
+            raise RuntimeError(f'Memory {action} failed')
+        return reply[0].result
+
+    def subscribe(self):
+        """
+        Subscribe to events, read them with events().
+
+        Returns the tunnels at the time, events describe the changes since.
+        """
+        reply = self._send_command(Command(Command.COMMAND_SUBSCRIBE))
+        self.subscribed = True
+        return [r.tunnel for r in reply]
+
+    def events(self, timeout=None):
+        """
+        Yield an EventCommand for each event, stops after timeout seconds
+        without one.
+
+        Commands wait while this blocks, a client used for both is best
+        read with a timeout.
+        """
+        while True:
+            with self._lock:
+                if self._events:
+                    cmd = self._events.popleft()
+                else:
+                    try:
+                        cmd = Command.unpack(self._socket, timeout=timeout)
+
+                    except TimeoutError:
+                        return
+            if cmd.command == Command.COMMAND_EVENT:
+                yield cmd
+
+
+class SSHManagerClient(_CommandClient):
+    """
+    Runs an SSHManagerServer in a subprocess and controls it via a socket.
+
+    The subprocess is started on first use. Pass eager=True to start it in
+    the background right away, and spare=True to keep a second, idle
+    subprocess that takes over immediately if the current one dies. If
+    control is a path, other processes can connect a ControlClient there.
+    If capture is a path, the subprocess records forwarded traffic to it,
+    callback=True has it forward channel data by callback.
+    """
+    def __init__(self, host=None, port=None, user=None, key=None,
+                 host_keys=None, eager=False, spare=False, connect=None,
+                 multiplex=None, start_timeout=START_TIMEOUT,
+                 control=SSH_CONTROL_SOCKET, capture=None,
+                 callback=None):
+        super().__init__()
+        self._env = {}
+        _set_if_not_none(self._env, 'SSH_HOST', host)
+        _set_if_not_none(self._env, 'SSH_PORT', port)
+        _set_if_not_none(self._env, 'SSH_USER', user)
+        _set_if_not_none(self._env, 'SSH_KEY_FILE', key)
+        _set_if_not_none(self._env, 'SSH_HOST_KEYS_FILE', host_keys)
+        _set_if_not_none(self._env, 'SSH_CONNECT', connect)
+        _set_if_not_none(self._env, 'SSH_MULTIPLEX', multiplex)
+        _set_if_not_none(self._env, 'CAPTURE_FILE', capture)
+        _set_if_not_none(self._env, 'FORWARD_CALLBACK', callback)
+        for key in MANAGER_ENV:
+            _set_if_not_none(self._env, key, None)
+        self._start_timeout = start_timeout
+        self._server = None
+        self._spare = None
+        self._keep_spare = spare
+        # NOTE: passed once the subprocess takes over rather than in its
+        # environment, a spare must not take the path.
+        self._control = control
+        self.restarts = 0
+        if eager:
+            threading.Thread(target=self.start, daemon=True).start()
+
+    def __del__(self):
+        self.close()
+
+    @property
+    def started(self):
+        return self._server is not None
+
+    @property
+    def alive(self):
+        return self._server is not None and self._server.alive
+
+    @property
+    def _socket(self):
+        return self._server.socket
+
+    def close(self):
+        if self._server:
+            self._server.close()
+            self._server = None
+        if self._spare:
+            self._spare.close()
+            self._spare = None
+
+    def start(self):
+        "Start the subprocess if it is not running."
+        with self._lock:
+            self._start_server()
+
+    def _start_server(self):
+        if self._server is not None:
+            if self._server.alive:
+                return
+            LOGGER.warning(
+                'Manager process %i exited with %i, restarting',
+                self._server.popen.pid, self._server.popen.returncode)
+            self._server.close()
+            self._server = None
+            self.restarts += 1
+        server, self._spare = self._spare, None
+        if server is None or not server.alive:
+            server = ManagerProcess(self._env)
+        try:
+            server.wait_ready(self._start_timeout)
+
+        except Exception:
+            server.close()
+            raise
+
+        self._server = server
+        if self._keep_spare:
+            self._spare = ManagerProcess(self._env)
+        if self._control:
+            self._exchange(
+                ListenCommand(Command.COMMAND_LISTEN, self._control))
+        for tunnel in self._tunnels.values():
+            LOGGER.debug('Restoring tunnel: %s', tunnel)
+            self._exchange(TunnelCommand(Command.COMMAND_ADD, tunnel))
+        if self.subscribed:
+            self._exchange(Command(Command.COMMAND_SUBSCRIBE))
+
+    def disconnect(self, timeout=None):
+        try:
+            self._send_command(Command(Command.COMMAND_STOP))
+        except EOFError:
+            pass
+        self.close()
+
+
+class ControlClient(_CommandClient):
+    """
+    Controls the manager of an SSHManagerClient from another process.
+
+    Connects to the control socket at path on first use. Any number of
+    clients may be connected at once, to observe the manager or to add and
+    remove tunnels.
+    """
+    def __init__(self, path=SSH_CONTROL_SOCKET):
+        super().__init__()
+        self.path = path
+        self._socket = None
+
+    def _start_server(self):
+        if self._socket is None:
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._socket.connect(self.path)
+
+    def _exchange(self, cmd, timeout=1.0):
+        try:
+            return super()._exchange(cmd, timeout)
+
+        except (EOFError, OSError):
+            # NOTE: connect again on next use, the manager may be back.
+            self.close()
+            raise
+
+    def close(self):
+        if self._socket:
+            self._socket.close()
+            self._socket = None
+        self.subscribed = False
+
+    def disconnect(self, timeout=None):
+        self.close()
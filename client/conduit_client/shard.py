@@ -0,0 +1,140 @@
+import os
+import bisect
+import hashlib
+import threading
+import logging
+
+from conduit_client.server import SSHManagerClient
+from conduit_client.httpcache import hit_ratio
+
+
+SSH_SHARDS = os.getenv('SSH_SHARDS', None)
+SHARD_REPLICAS = 64
+SHARD_CHECK_INTERVAL = 5.0
+
+LOGGER = logging.getLogger()
+LOGGER.addHandler(logging.NullHandler())
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    "Consistent hash ring, maps keys to nodes."
+    def __init__(self, nodes, replicas=SHARD_REPLICAS):
+        self._replicas = replicas
+        self._keys = []
+        self._nodes = {}
+        for node in nodes:
+            self.add(node)
+
+    def __len__(self):
+        return len(set(self._nodes.values()))
+
+    def add(self, node):
+        for i in range(self._replicas):
+            key = _hash(f'{node}:{i}')
+            self._nodes[key] = node
+            bisect.insort(self._keys, key)
+
+    def remove(self, node):
+        for i in range(self._replicas):
+            key = _hash(f'{node}:{i}')
+            del self._nodes[key]
+            self._keys.remove(key)
+
+    def get(self, key):
+        if not self._keys:
+            raise KeyError(key)
+        i = bisect.bisect(self._keys, _hash(key)) % len(self._keys)
+        return self._nodes[self._keys[i]]
+
+
+class ShardedSSHManagerClient:
+    """
+    Spreads tunnels over several manager processes.
+
+    Each shard is an SSHManagerClient with its own subprocess and SSH
+    connection. Tunnels are assigned to shards by hashing the domain.
+    """
+    def __init__(self, host=None, port=None, user=None, key=None,
+                 host_keys=None, shards=None, eager=False, spare=False,
+                 check_interval=SHARD_CHECK_INTERVAL):
+        if shards is None:
+            shards = int(SSH_SHARDS or os.cpu_count() or 1)
+        self._shards = [
+            SSHManagerClient(
+                host, port, user, key, host_keys, eager=eager, spare=spare)
+            for _ in range(shards)
+        ]
+        self._ring = HashRing(range(shards))
+        self._check_interval = check_interval
+        self._stop = threading.Event()
+        self._monitor = threading.Thread(target=self._run, daemon=True)
+        self._monitor.start()
+
+    def __len__(self):
+        return len(self._shards)
+
+    def _run(self):
+        while not self._stop.wait(self._check_interval):
+            self.check()
+
+    def check(self):
+        "Restart any shard whose process has exited."
+        for i, shard in enumerate(self._shards):
+            if not shard.started or shard.alive:
+                continue
+            LOGGER.warning('Shard %i died, restarting', i)
+            try:
+                shard.ping()
+
+            except Exception:
+                LOGGER.exception('Error restarting shard %i', i)
+
+    def shard(self, domain):
+        return self._shards[self._ring.get(domain)]
+
+    def close(self):
+        self._stop.set()
+        for shard in self._shards:
+            shard.close()
+
+    def disconnect(self, timeout=None):
+        self._stop.set()
+        for shard in self._shards:
+            if not shard.started:
+                continue
+            shard.disconnect(timeout=timeout)
+
+    def ping(self):
+        for shard in self._shards:
+            shard.ping()
+
+    def add_tunnel(self, tunnel):
+        self.shard(tunnel.domain).add_tunnel(tunnel)
+
+    def del_tunnel(self, tunnel, drain=None):
+        self.shard(tunnel.domain).del_tunnel(tunnel, drain)
+
+    def list_tunnels(self):
+        tunnels = []
+        for shard in self._shards:
+            if not shard.started:
+                continue
+            tunnels.extend(shard.list_tunnels())
+        return tunnels
+
+    def stats(self):
+        merged = {'shards': len(self._shards), 'restarts': 0}
+        for shard in self._shards:
+            merged['restarts'] += shard.restarts
+            if not shard.started:
+                continue
+            for key, value in shard.stats().items():
+                merged[key] = merged.get(key, 0) + value
+        # NOTE: ratios do not sum, recompute from the merged counts.
+        if 'cache_hit_ratio' in merged:
+            merged['cache_hit_ratio'] = hit_ratio(merged)
+        return merged
@@ -1,14 +1,21 @@
 import os
+import time
 import threading
 import logging
 import socket
 import ipaddress
+import queue
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
 from select import select
+from io import StringIO
 from os.path import isfile
-from collections import defaultdict
 
 import paramiko
-import dns.resolver
+from paramiko.buffered_pipe import BufferedPipe
+from paramiko.common import cMSG_CHANNEL_WINDOW_ADJUST
+
+from conduit_client import peek, httpcache, balancer, capture
 
 
 LOGGER = logging.getLogger(__name__)
@@ -19,11 +26,49 @@ SSH_HOST_KEYS_FILE = os.getenv('SSH_HOST_KEYS_FILES', None)
 SSH_HOST = os.getenv('SSH_HOST', 'ssh.homeland-social.com')
 SSH_PORT = int(os.getenv('SSH_PORT', 2222))
 SSH_USER = os.getenv('SSH_USER', 'default')
+SSH_KEY_TYPE = os.getenv('SSH_KEY_TYPE', 'ed25519').lower()
+SSH_KEEPALIVE_INTERVAL = float(os.getenv('SSH_KEEPALIVE_INTERVAL', 30))
+SSH_DEAD_PEER_TIMEOUT = float(os.getenv('SSH_DEAD_PEER_TIMEOUT', 90))
+SSH_CONNECT_TIMEOUT = float(os.getenv('SSH_CONNECT_TIMEOUT', 10))
+SSH_CONNECT_STAGGER = float(os.getenv('SSH_CONNECT_STAGGER', 0.25))
+SSH_REEVALUATE_INTERVAL = float(os.getenv('SSH_REEVALUATE_INTERVAL', 300))
+# NOTE: only move to another endpoint if it connects at least this much
+# faster, otherwise tunnels would flap between similar endpoints.
+SSH_SWITCH_RATIO = 0.5
+SSH_MULTIPLEX = os.getenv('SSH_MULTIPLEX', '').lower() in ('1', 'true', 'yes')
+SSH_PEEK_TIMEOUT = float(os.getenv('SSH_PEEK_TIMEOUT', 10))
+SSH_CONTROL_TIMEOUT = float(os.getenv('SSH_CONTROL_TIMEOUT', 10))
+SSH_DRAIN_TIMEOUT = float(os.getenv('SSH_DRAIN_TIMEOUT', 30))
 BUFFER_SIZE = 1024 * 8
+# NOTE: most read from one handle before moving on to the next.
+FORWARD_READ_BUDGET = int(os.getenv('FORWARD_READ_BUDGET', 64 * 1024))
+# NOTE: small writes to a channel wait this long for more data, so they
+# share SSH packets. 0 sends every write at once.
+FORWARD_COALESCE_DELAY = float(os.getenv('FORWARD_COALESCE_DELAY', 0.001))
+# NOTE: paramiko's maximum packet size, a full buffer is sent at once.
+FORWARD_COALESCE_SIZE = 32768
+# NOTE: the transport thread writes data from channels to backends itself,
+# rather than waking the forwarder through a pipe per channel. A backend
+# that stops reading then stalls every channel, so it is off by default.
+FORWARD_CALLBACK = \
+    os.getenv('FORWARD_CALLBACK', '').lower() in ('1', 'true', 'yes')
+# NOTE: domains are registered in batches to keep exec requests well under
+# the maximum ssh packet size.
+EXEC_LIMIT = 16384
+# NOTE: only applied to RSA keys.
 DISABLED_ALGORITHMS = dict(pubkeys=["rsa-sha2-512", "rsa-sha2-256"])
+KEY_TYPES = ('ed25519', 'ecdsa', 'rsa')
 MANAGER = None
 
 
+def _readable(sock):
+    "Whether sock can be read from without blocking."
+    recv_ready = getattr(sock, 'recv_ready', None)
+    if recv_ready is not None:
+        return recv_ready()
+    return bool(select([sock], [], [], 0)[0])
+
+
 def resolve_addr(addr):
     "Do dns lookup if necessary."
     try:
@@ -34,84 +79,361 @@ def resolve_addr(addr):
         # Already an ip address.
         return addr
 
+    # NOTE: dnspython is slow to import, defer it until needed.
+    import dns.resolver
+
     # NOTE: resolver should randomize A records if there are multiple.
     return dns.resolver.query(addr, 'A')[0].to_text()
 
 
 class Tunnel:
-    def __init__(self, domain, addr=None, port=None, remote_port=None):
+    MODE_TCP = 'tcp'
+    MODE_HTTP = 'http'
+
+    # NOTE: defaults come from the class, so simple tcp tunnels pickle
+    # exactly as they did before modes and backends existed.
+    mode = MODE_TCP
+    backends = None
+
+    def __init__(self, domain, addr=None, port=None, remote_port=None,
+                 mode=MODE_TCP, backends=None):
+        """
+        Tunnel domain to addr:port.
+
+        Pass backends, a list of (addr, port[, weight]), to balance
+        connections over several backends instead.
+        """
         self.domain = domain
         self.addr = addr
         self.port = port
         self.remote_port = remote_port
+        if mode != self.MODE_TCP:
+            self.mode = mode
+        if backends:
+            self.backends = [tuple(b) for b in backends]
 
     def __str__(self):
         remote_port = f', remote_port={self.remote_port}' \
             if self.remote_port else ''
         return (f'Tunnel, domain: {self.domain}, addr: {self.addr}:{self.port}'
-                f'{remote_port}')
+                f'{remote_port}, mode: {self.mode}')
 
     def __eq__(self, other):
         return self.domain == other.domain and \
                self.addr == other.addr and \
-               self.port == other.port
+               self.port == other.port and \
+               self.mode == other.mode and \
+               self.targets == other.targets
+
+    @property
+    def targets(self):
+        "The (addr, port[, weight]) of every backend."
+        return self.backends or [(self.addr, self.port)]
+
+
+class Connection:
+    """
+    A channel and the backend socket it is forwarded to.
+
+    Holds everything the forwarder knows about the pair, it is found in the
+    connection table from either socket.
+    """
+    # NOTE: slots, there may be many thousands of these.
+    __slots__ = (
+        'channel', 'server', 'domain', 'backend', 'state', 'opened',
+        'active', 'bytes_in', 'bytes_out', 'written', 'buffer', 'deadline',
+    )
+
+    # HTTP requests are being proxied, the channel is not polled.
+    STATE_PROXYING = 'proxying'
+    STATE_OPEN = 'open'
+    STATE_DRAINING = 'draining'
+    STATE_CLOSED = 'closed'
+
+    def __init__(self, channel, domain):
+        self.channel = channel
+        self.server = None
+        self.domain = domain
+        self.backend = None
+        self.state = self.STATE_PROXYING
+        self.opened = self.active = time.monotonic()
+        # NOTE: bytes read from the channel and from the server.
+        self.bytes_in = self.bytes_out = 0
+        self.written = 0
+        # NOTE: data waiting to be written to the channel, and until when.
+        self.buffer = None
+        self.deadline = None
+
+    def __repr__(self):
+        return (f'Connection({self.domain}, {self.state}, '
+                f'in={self.bytes_in}, out={self.bytes_out})')
+
+
+class ChannelSink(BufferedPipe):
+    """
+    Takes the place of a channel's in_buffer, to be handed its data.
+
+    It buffers like the pipe it replaces until started, so a channel can
+    be read as usual first. Once started, data is passed to on_data as the
+    transport thread receives it, and on_close is called when the channel
+    reaches EOF or closes.
+    """
+    def __init__(self):
+        super().__init__()
+        self._on_data = self._on_close = None
+
+    def start(self, on_data, on_close):
+        # NOTE: callbacks are made without the lock, on_data may close the
+        # channel, which closes this. What was buffered is passed on first,
+        # data fed meanwhile is buffered behind it.
+        while True:
+            with self._lock:
+                data = self._buffer_tobytes()
+                del self._buffer[:]
+                if not data:
+                    self._on_data, self._on_close = on_data, on_close
+                    closed = self._closed
+                    break
+            on_data(data)
+        if closed:
+            on_close()
+
+    def feed(self, data):
+        with self._lock:
+            on_data = self._on_data
+            if on_data is None:
+                if self._event is not None:
+                    self._event.set()
+                self._buffer_frombytes(data)
+                self._cv.notify_all()
+                return
+        on_data(data)
+
+    def close(self):
+        super().close()
+        if self._on_close is not None:
+            self._on_close()
+
+
+def _adjust_window(channel, size):
+    "Let the peer send size more bytes over channel."
+    m = paramiko.Message()
+    m.add_byte(cMSG_CHANNEL_WINDOW_ADJUST)
+    m.add_int(channel.remote_chanid)
+    m.add_int(size)
+    channel.transport._send_user_message(m)
 
 
 class Forwarder:
     "Uses select to forward data over tunnels."
-    def __init__(self):
-        self._handles = {}
-        self._bytes_recv = defaultdict(int)
-        self._bytes_sent = defaultdict(int)
+    def __init__(self, capture=None, read_budget=FORWARD_READ_BUDGET,
+                 coalesce_delay=FORWARD_COALESCE_DELAY,
+                 callback=FORWARD_CALLBACK):
+        # NOTE: the connection table, both sockets of each polled connection
+        # map to its record. Channels that deliver by callback are not
+        # polled, only their server is in the table.
+        self._table = {}
+        # NOTE: connections whose HTTP requests are being proxied.
+        self._proxying = set()
+        # NOTE: connections with data buffered for their channel.
+        self._buffered = set()
+        self._read_budget = read_budget
+        self._coalesce_delay = coalesce_delay
+        self._callback = callback
+        # NOTE: window adjustments the transport thread could not send.
+        self._windows = deque()
+        self._writes = 0
+        # NOTE: a capture.Capture, records forwarded traffic when given.
+        self._capture = capture
+        # NOTE: called with (event, data) as channels open and close.
+        self.listener = None
+        self.cache = httpcache.HttpCache()
+        self._balancers = {}
         self._event = threading.Event()
         self._thread = threading.Thread(target=self._run, daemon=True)
         self._thread.start()
+        self._checker = threading.Thread(target=self._check, daemon=True)
+        self._checker.start()
 
-    def _close(self, *socks):
-        for s in socks:
-            LOGGER.debug(
-                'Closing %s, recv=%i, sent=%i',
-                s,
-                self._bytes_recv.pop(s, 0),
-                self._bytes_sent.pop(s, 0)
-            )
-            try:
-                s.close()
-            except socket.error:
-                pass
-            self._handles.pop(s, None)
+    def _emit(self, event, **data):
+        if self.listener is not None:
+            self.listener(event, data)
 
-    def _recv(self, r, s):
+    def _disconnect(self, conn, server=None):
+        "Close the server side of conn, or server if it is another socket."
+        server = server or conn.server
+        if server is None:
+            return
         try:
-            data = r.recv(BUFFER_SIZE)
+            server.close()
         except socket.error:
-            LOGGER.exception('Error receiving')
-            self._close(r, s)
+            pass
+        if server is not conn.server:
             return
-        if len(data) == 0:
-            self._close(r, s)
+        self._table.pop(server, None)
+        if conn.backend is not None:
+            conn.backend.release()
+        conn.server = conn.backend = None
+
+    def _close(self, conn):
+        if conn.state == Connection.STATE_CLOSED:
             return
-        self._bytes_recv[r] += len(data)
-        self._send(r, s, data)
+        opened = conn.state != Connection.STATE_PROXYING
+        conn.state = Connection.STATE_CLOSED
+        self._proxying.discard(conn)
+        self._buffered.discard(conn)
+        if conn.buffer:
+            try:
+                conn.channel.sendall(conn.buffer)
+            except Exception:
+                pass
+        conn.buffer = conn.deadline = None
+        if self._capture:
+            self._capture.closed(conn.channel)
+        LOGGER.debug('Closing %s', conn)
+        self._disconnect(conn)
+        self._table.pop(conn.channel, None)
+        try:
+            conn.channel.close()
+        except socket.error:
+            pass
+        if opened:
+            self._emit(
+                'channel_closed', domain=conn.domain,
+                bytes_in=conn.bytes_in, bytes_out=conn.bytes_out,
+                seconds=time.monotonic() - conn.opened)
+
+    def _recv(self, conn, r):
+        # NOTE: read what is waiting, up to the budget, so a burst is
+        # forwarded in one write rather than one per pass.
+        chunks, size, eof = [], 0, False
+        while size < self._read_budget:
+            try:
+                data = r.recv(BUFFER_SIZE)
+            except socket.error:
+                LOGGER.exception('Error receiving')
+                self._close(conn)
+                return
+            if len(data) == 0:
+                eof = True
+                break
+            chunks.append(data)
+            size += len(data)
+            if not _readable(r):
+                break
+        if chunks:
+            data = chunks[0] if len(chunks) == 1 else b''.join(chunks)
+            self._send(conn, r, data)
+        if eof:
+            self._close(conn)
+
+    def _send(self, conn, r, data, close=None):
+        """
+        Forward data read from r to the other side of conn.
 
-    def _send(self, r, s, data):
+        If writing fails conn is passed to close, _close() by default.
+        """
+        conn.active = time.monotonic()
+        if r is conn.channel:
+            conn.bytes_in += len(data)
+            if self._capture:
+                self._capture.data(conn.channel, capture.KIND_IN, data)
+            self._write(conn, conn.server, data, close)
+            return
+        conn.bytes_out += len(data)
+        if self._capture:
+            self._capture.data(conn.channel, capture.KIND_OUT, data)
+        if self._coalesce_delay and \
+           (conn.buffer is not None or len(data) < FORWARD_COALESCE_SIZE):
+            if conn.buffer is None:
+                conn.buffer = bytearray()
+                conn.deadline = conn.active + self._coalesce_delay
+                self._buffered.add(conn)
+            conn.buffer += data
+            if len(conn.buffer) < FORWARD_COALESCE_SIZE:
+                return
+            data = self._take(conn)
+        self._write(conn, conn.channel, data)
+
+    def _take(self, conn):
+        data = conn.buffer
+        conn.buffer = conn.deadline = None
+        self._buffered.discard(conn)
+        return data
+
+    def _write(self, conn, s, data, close=None):
         try:
-            s.send(data)
+            s.sendall(data)
         except Exception:
             LOGGER.exception('Error sending')
-            self._close(r, s)
+            (close or self._close)(conn)
             return
-        self._bytes_sent[s] += len(data)
+        self._writes += 1
+        conn.written += len(data)
+
+    def _deliver(self, conn, data):
+        "Forward data from conn's channel, called by the transport thread."
+        if conn.state == Connection.STATE_CLOSED:
+            return
+        # NOTE: closing conn here would wait on the channel from the thread
+        # that services it, if the backend fails it is hung up instead.
+        self._send(conn, conn.channel, data, close=self._hangup)
+        # NOTE: the data was not read through Channel.recv(), which would
+        # have adjusted the window.
+        channel = conn.channel
+        size = channel._check_add_window(len(data))
+        if size <= 0:
+            return
+        if not channel.transport.clear_to_send.is_set():
+            # NOTE: waiting for a key exchange here would block the thread
+            # carrying it out, the forwarder sends it instead.
+            self._windows.append((channel, size))
+            return
+        _adjust_window(channel, size)
+
+    def _hangup(self, conn):
+        """
+        The channel of conn reached EOF or its backend failed, called by the
+        transport thread.
+        """
+        # NOTE: the channel lock is held, so conn is not closed here. The
+        # server reads as closed and the forwarder closes conn.
+        server = conn.server
+        if conn.state == Connection.STATE_CLOSED or server is None:
+            return
+        try:
+            server.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _flush(self):
+        "Write buffers whose delay has passed."
+        now = time.monotonic()
+        for conn in list(self._buffered):
+            if conn.deadline > now:
+                continue
+            self._write(conn, conn.channel, self._take(conn))
 
     def _poll(self):
-        if not self._handles and self._event.wait(1.0):
+        if not self._table and self._event.wait(1.0):
             self._event.clear()
-        for r in select(self._handles, [], [], 0.1)[0]:
+        timeout = 0.1
+        if self._buffered:
+            timeout = max(0.0, min(
+                c.deadline for c in self._buffered) - time.monotonic())
+        for r in select(self._table, [], [], timeout)[0]:
             try:
-                s = self._handles[r]
+                conn = self._table[r]
             except KeyError:
                 continue
-            self._recv(r, s)
+            self._recv(conn, r)
+        self._flush()
+        while self._windows:
+            channel, size = self._windows.popleft()
+            try:
+                _adjust_window(channel, size)
+            except Exception:
+                LOGGER.exception('Error adjusting window')
 
     def _run(self):
         while True:
@@ -121,57 +443,592 @@ class Forwarder:
             except Exception:
                 LOGGER.exception('Error polling')
 
-    def create_handler(self, domain, addr, port):
-        def _handler(channel, *args):
-            # NOTE: Resolve each time we connect. This is done to perform
-            # rr-dns as well as to cope when an IP changes (container restart).
-            server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    def _check(self):
+        while True:
+            time.sleep(balancer.BACKEND_CHECK_INTERVAL)
+            for b in list(self._balancers.values()):
+                # NOTE: a lone backend is used regardless of its health.
+                if len(b.backends) > 1:
+                    b.check(self._connect)
+
+    def connections(self, domain=None):
+        "The open connections, of domain if given."
+        conns = [
+            conn for s, conn in list(self._table.items())
+            if s is conn.server
+        ]
+        conns.extend(list(self._proxying))
+        if domain is not None:
+            conns = [conn for conn in conns if conn.domain == domain]
+        return conns
+
+    def stats(self):
+        conns = self.connections()
+        stats = {
+            'connections': len(conns),
+            'bytes_recv': sum(c.bytes_in + c.bytes_out for c in conns),
+            'bytes_sent': sum(c.written for c in conns),
+            'writes': self._writes,
+        }
+        stats.update(self.cache.stats())
+        stats['backends_unavailable'] = sum(
+            not backend.available
+            for b in list(self._balancers.values()) for backend in b.backends
+        )
+        return stats
+
+    def tunnel_stats(self):
+        "Connection counts and bytes in and out of each tunnel."
+        stats = {}
+        for conn in self.connections():
+            s = stats.setdefault(conn.domain, {
+                'connections': 0, 'bytes_in': 0, 'bytes_out': 0})
+            s['connections'] += 1
+            s['bytes_in'] += conn.bytes_in
+            s['bytes_out'] += conn.bytes_out
+        return stats
+
+    def balancer_for(self, tunnel):
+        "The balancer for tunnel, updated to its current backends."
+        b = self._balancers.get(tunnel.domain)
+        if b is None:
+            b = self._balancers[tunnel.domain] = balancer.Balancer(
+                tunnel.domain)
+        b.update(tunnel.targets, http=tunnel.mode == Tunnel.MODE_HTTP)
+        return b
+
+    def forget(self, domain):
+        """
+        Drop the balancer of domain, so its backends are no longer checked.
+
+        Connections already open keep their backend, a balancer is made again
+        for the next one.
+        """
+        self._balancers.pop(domain, None)
+
+    def _connect(self, backend, timeout=balancer.BACKEND_CONNECT_TIMEOUT):
+        # NOTE: Resolve each time we connect. This is done to perform
+        # rr-dns as well as to cope when an IP changes (container restart).
+        ip = resolve_addr(backend.addr)
+        LOGGER.debug('connecting to %s(%s:%i)', backend.addr, ip, backend.port)
+        server = socket.create_connection((ip, backend.port), timeout=timeout)
+        server.settimeout(None)
+        return server
+
+    def _open(self, tunnel, conn):
+        "Connect conn to a backend of tunnel, trying each until one answers."
+        b, tried = self.balancer_for(tunnel), []
+        while True:
+            backend = b.choose(exclude=tried)
+            if backend is None:
+                LOGGER.error('No backend available for %s', tunnel.domain)
+                return None
             try:
-                ip = resolve_addr(addr)
+                server = self._connect(backend)
+
             except Exception:
-                LOGGER.exception('Could not resolve')
+                LOGGER.exception('Could not connect to %s', backend)
+                backend.failed()
+                tried.append(backend)
+                continue
+            backend.succeeded()
+            backend.acquire()
+            conn.server, conn.backend = server, backend
+            return server
+
+    def _add(self, conn):
+        "Start polling conn."
+        self._proxying.discard(conn)
+        conn.state = Connection.STATE_OPEN
+        self._table[conn.server] = conn
+        sink = getattr(conn.channel, 'in_buffer', None)
+        if isinstance(sink, ChannelSink):
+            sink.start(
+                lambda data: self._deliver(conn, data),
+                lambda: self._hangup(conn))
+        else:
+            self._table[conn.channel] = conn
+        LOGGER.debug('connected, polling')
+        self._event.set()
+        self._emit(
+            'channel_opened', domain=conn.domain,
+            backend=str(conn.backend) if conn.backend else None)
+
+    def _http(self, conn, tunnel, data=b''):
+        self._proxying.add(conn)
+        try:
+            httpcache.HttpProxy(
+                conn.channel, tunnel.domain,
+                lambda: self._open(tunnel, conn), self.cache,
+                lambda channel, server: self._add(conn), data,
+                disconnect=lambda server: self._disconnect(conn, server)
+            ).run()
+
+        finally:
+            if conn.state == Connection.STATE_PROXYING:
+                self._close(conn)
+
+    def _hook(self, channel):
+        "Have channel deliver its data by callback, if enabled."
+        # NOTE: done as the channel opens, in the transport thread, so no
+        # data can be fed to the pipe being replaced.
+        if self._callback and isinstance(channel, paramiko.Channel):
+            channel.in_buffer = ChannelSink()
+
+    def handle(self, channel, tunnel):
+        "Connect a new channel to tunnel's backend."
+        self._hook(channel)
+        conn = Connection(channel, tunnel.domain)
+        if tunnel.mode == Tunnel.MODE_HTTP:
+            # NOTE: requests are parsed in their own thread, the transport
+            # thread must not block.
+            threading.Thread(
+                target=self._http, args=(conn, tunnel), daemon=True).start()
+            return
+        if self._open(tunnel, conn) is None:
+            channel.close()
+            return
+        self._add(conn)
+
+    def channels(self, domain):
+        return [conn.channel for conn in self.connections(domain)]
+
+    def drain(self, domain=None, timeout=SSH_DRAIN_TIMEOUT, transport=None):
+        """
+        Close the channels of domain, or of transport, once timeout expires.
+
+        Only channels open now are closed, so a tunnel re-added meanwhile is
+        not affected.
+        """
+        conns = self.connections(domain)
+        if transport is not None:
+            conns = [
+                conn for conn in conns
+                if conn.channel.get_transport() is transport
+            ]
+        if not conns:
+            return
+        for conn in conns:
+            if conn.state == Connection.STATE_OPEN:
+                conn.state = Connection.STATE_DRAINING
+
+        def _close():
+            for conn in conns:
+                if conn.state == Connection.STATE_CLOSED:
+                    continue
+                LOGGER.info(
+                    'Drain timeout, closing channel for %s', conn.domain)
+                self._close(conn)
+
+        if timeout <= 0:
+            _close()
+            return
+        timer = threading.Timer(timeout, _close)
+        timer.daemon = True
+        timer.start()
+
+    def _demux(self, channel, tunnels):
+        data, name = b'', None
+        channel.settimeout(SSH_PEEK_TIMEOUT)
+        try:
+            while True:
+                name, complete = peek.server_name(data)
+                if complete:
+                    break
+                chunk = channel.recv(BUFFER_SIZE)
+                if not chunk:
+                    break
+                data += chunk
+
+        except socket.timeout:
+            LOGGER.warning('Timeout peeking at channel')
+        channel.settimeout(None)
+        tunnel = tunnels.get(name) if name else None
+        if tunnel is None:
+            LOGGER.warning('No tunnel for: %s', name)
+            channel.close()
+            return
+        conn = Connection(channel, tunnel.domain)
+        if tunnel.mode == Tunnel.MODE_HTTP:
+            self._http(conn, tunnel, data)
+            return
+        if self._open(tunnel, conn) is None:
+            channel.close()
+            return
+        # NOTE: pass on what was peeked before polling, the channel may
+        # already be closed.
+        if data:
+            self._send(conn, channel, data)
+            if conn.state == Connection.STATE_CLOSED:
                 return
-            LOGGER.debug(
-                'connecting to %s(%s:%i) for %s', addr, ip, port, domain)
-            try:
-                server.connect((ip, port))
-            except Exception:
-                LOGGER.exception('Could not connect')
+        self._add(conn)
+
+    def handle_mux(self, channel, tunnels):
+        """
+        Connect a channel from a port forward shared by many tunnels.
+
+        The channel is routed to the tunnel named by its TLS SNI or HTTP Host
+        header, looked up in tunnels (a dict of domain to Tunnel).
+        """
+        # NOTE: called from the transport thread, which must not block while
+        # the client sends its headers.
+        self._hook(channel)
+        threading.Thread(
+            target=self._demux, args=(channel, tunnels), daemon=True).start()
+
+
+class Liveness:
+    """
+    Tracks transport health passively from inbound traffic.
+
+    Every message read from the transport counts as proof of life. When the
+    link has been quiet for `interval` seconds a keepalive requesting a reply
+    is sent. If nothing arrives for `timeout` seconds the transport is closed.
+    """
+    def __init__(self, transport, interval=SSH_KEEPALIVE_INTERVAL,
+                 timeout=SSH_DEAD_PEER_TIMEOUT):
+        self.interval = interval
+        self.timeout = timeout
+        self.last_seen = time.monotonic()
+        # NOTE: replies to global requests are matched only by order, hold
+        # this lock around any global request so they are not confused.
+        self.request_lock = threading.Lock()
+        self._transport = transport
+        self._stop = threading.Event()
+        packetizer = transport.packetizer
+        read_message = packetizer.read_message
+
+        def _read_message():
+            message = read_message()
+            self.last_seen = time.monotonic()
+            return message
+
+        packetizer.read_message = _read_message
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    @property
+    def idle(self):
+        return time.monotonic() - self.last_seen
+
+    @property
+    def alive(self):
+        return self.idle < self.timeout
+
+    def stop(self):
+        self._stop.set()
+
+    def _probe(self):
+        "Send a keepalive, its reply counts as traffic."
+        # NOTE: the reply is what proves life, so one is asked for. The
+        # request returns once it arrives or the transport is closed, which
+        # _run() does timeout seconds after the last traffic.
+        try:
+            with self.request_lock:
+                self._transport.global_request(
+                    'keepalive@openssh.com', wait=True)
+
+        except Exception:
+            LOGGER.exception('Error sending keepalive')
+
+    def _run(self):
+        probe = None
+        while not self._stop.wait(min(self.interval, 1.0)):
+            if not self.alive:
+                LOGGER.warning('No traffic for %.1fs, closing', self.idle)
+                self._transport.close()
                 return
-            self._handles[server] = channel
-            self._handles[channel] = server
-            LOGGER.debug('connected, polling')
-            self._event.set()
-        return _handler
+            if self.idle < self.interval or probe and probe.is_alive():
+                continue
+            # NOTE: waiting for the reply here would stretch detection to
+            # interval + timeout.
+            probe = threading.Thread(target=self._probe, daemon=True)
+            probe.start()
+
+
+def parse_endpoints(hosts, port):
+    "Parse a comma separated list of host[:port] into (host, port) tuples."
+    if isinstance(hosts, str):
+        hosts = hosts.split(',')
+    endpoints = []
+    for host in hosts:
+        if isinstance(host, tuple):
+            endpoints.append(host)
+            continue
+        host = host.strip()
+        if not host:
+            continue
+        if host.startswith('['):
+            # [ipv6]:port
+            host, _, rest = host[1:].partition(']')
+            endpoints.append((host, int(rest[1:]) if rest else port))
+        elif host.count(':') == 1:
+            host, _, rest = host.partition(':')
+            endpoints.append((host, int(rest)))
+        else:
+            endpoints.append((host, port))
+    return endpoints
+
+
+class Endpoints:
+    """
+    The sshd endpoints a manager can connect to.
+
+    Each host is expanded to all of its addresses. Connections are raced
+    happy eyeballs style: attempts start `stagger` seconds apart, fastest
+    known endpoint first, and the first to complete wins. Connect times are
+    recorded as the round trip time of each endpoint.
+    """
+    def __init__(self, hosts, port, timeout=SSH_CONNECT_TIMEOUT,
+                 stagger=SSH_CONNECT_STAGGER):
+        self.hosts = parse_endpoints(hosts, port)
+        self.rtts = {}
+        self._timeout = timeout
+        self._stagger = stagger
+
+    def _rank(self, endpoint):
+        try:
+            rtt = self.rtts[endpoint]
+        except KeyError:
+            return (1, 0)
+        return (2, 0) if rtt is None else (0, rtt)
+
+    def expand(self):
+        "Returns (host, addr, port) for every address, best first."
+        endpoints = []
+        for host, port in self.hosts:
+            try:
+                infos = socket.getaddrinfo(
+                    host, port, type=socket.SOCK_STREAM)
+
+            except socket.gaierror as e:
+                LOGGER.warning('Could not resolve %s: %s', host, e)
+                continue
+            for *_, sockaddr in infos:
+                endpoint = (host, sockaddr[0], sockaddr[1])
+                if endpoint not in endpoints:
+                    endpoints.append(endpoint)
+        return sorted(endpoints, key=self._rank)
+
+    def best(self, endpoints=None):
+        "The healthy endpoint with the lowest round trip time."
+        if endpoints is None:
+            endpoints = self.expand()
+        measured = [e for e in endpoints if self.rtts.get(e) is not None]
+        return min(measured, key=self.rtts.get, default=None)
+
+    def _connect(self, endpoint):
+        start = time.monotonic()
+        sock = socket.create_connection(endpoint[1:], timeout=self._timeout)
+        return sock, time.monotonic() - start
+
+    def _attempt(self, endpoint):
+        try:
+            sock, rtt = self._connect(endpoint)
+
+        except OSError as e:
+            LOGGER.debug('Could not connect to %s: %s', endpoint, e)
+            self.rtts[endpoint] = None
+            return None, e
+        self.rtts[endpoint] = rtt
+        return sock, None
+
+    def race(self, endpoints=None):
+        """
+        Connect to the first endpoint that answers.
+
+        Returns the socket and its endpoint. Connections that complete after
+        the winner are closed, their round trip times are still recorded.
+        """
+        if endpoints is None:
+            endpoints = self.expand()
+        if not endpoints:
+            raise OSError('No sshd endpoints available')
+        results, lock = queue.Queue(), threading.Lock()
+        done = False
+
+        def _attempt(endpoint):
+            sock, error = self._attempt(endpoint)
+            with lock:
+                if done and sock:
+                    sock.close()
+                    return
+                results.put((endpoint, sock, error))
+
+        started, pending, error = 0, 0, None
+        while started < len(endpoints) or pending:
+            if started < len(endpoints):
+                threading.Thread(
+                    target=_attempt, args=(endpoints[started],),
+                    daemon=True).start()
+                started += 1
+                pending += 1
+            try:
+                # NOTE: a failure starts the next attempt right away.
+                endpoint, sock, error = results.get(
+                    timeout=self._stagger
+                    if started < len(endpoints) else None)
+
+            except queue.Empty:
+                continue
+            pending -= 1
+            if sock is None:
+                continue
+            with lock:
+                done = True
+                # Close any that finished while we were busy.
+                while not results.empty():
+                    late = results.get()[1]
+                    if late:
+                        late.close()
+            sock.settimeout(None)
+            return sock, endpoint
+        raise error
+
+    def probe(self):
+        "Measure the round trip time of every endpoint."
+        endpoints = self.expand()
+        threads = []
+        for endpoint in endpoints:
+            def _probe(endpoint=endpoint):
+                sock, _ = self._attempt(endpoint)
+                if sock:
+                    sock.close()
+            thread = threading.Thread(target=_probe, daemon=True)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        return {endpoint: self.rtts.get(endpoint) for endpoint in endpoints}
+
+
+class ControlError(Exception):
+    "sshd refused a command, or only the given domains of it."
+    def __init__(self, reason, domains=None):
+        super().__init__(reason)
+        self.domains = domains
+
+
+class Control:
+    """
+    A long lived session used to register tunnels with sshd.
+
+    Commands are written as `<seq> <command>` lines and acknowledged with
+    `<seq> ok`, `<seq> refused <domain,...>` if sshd opened only some
+    domains of a tunnel command, or `<seq> error <reason>`. Any number of
+    commands may be in flight, send() returns a Future for each
+    acknowledgement.
+    """
+    def __init__(self, transport):
+        self._channel = transport.open_session()
+        try:
+            self._channel.exec_command('control')
+
+        except paramiko.SSHException:
+            self._channel.close()
+            raise
+        self._seq = 0
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    @property
+    def alive(self):
+        return not self._channel.closed and self._thread.is_alive()
+
+    def close(self):
+        self._channel.close()
+
+    def send(self, command):
+        future = Future()
+        with self._lock:
+            self._seq += 1
+            self._pending[self._seq] = future
+            self._channel.sendall(f'{self._seq} {command}\n'.encode())
+        return future
+
+    def _reply(self, line):
+        seq, _, reply = line.decode().partition(' ')
+        status, _, reason = reply.partition(' ')
+        try:
+            future = self._pending.pop(int(seq))
+
+        except (ValueError, KeyError):
+            LOGGER.warning('Unexpected reply: %s', line)
+            return
+        if status == 'ok':
+            future.set_result(True)
+        elif status == 'refused':
+            future.set_exception(ControlError(
+                f'Refused: {reason}', reason.split(',')))
+        else:
+            future.set_exception(ControlError(reason or status))
+
+    def _run(self):
+        buffer = b''
+        try:
+            while True:
+                data = self._channel.recv(BUFFER_SIZE)
+                if not data:
+                    break
+                *lines, buffer = (buffer + data).split(b'\n')
+                for line in lines:
+                    self._reply(line)
+
+        except Exception:
+            LOGGER.exception('Error reading control channel')
+
+        finally:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            for future in pending.values():
+                future.set_exception(ControlError('Control channel closed'))
 
 
 class SSHManager:
-    def __init__(self, host, port, user, key):
-        self._host = host
-        self._port = port
+    def __init__(self, host, port, user, key,
+                 keepalive=SSH_KEEPALIVE_INTERVAL,
+                 timeout=SSH_DEAD_PEER_TIMEOUT,
+                 reevaluate=SSH_REEVALUATE_INTERVAL,
+                 multiplex=SSH_MULTIPLEX, drain=SSH_DRAIN_TIMEOUT):
+        self._endpoints = Endpoints(host, port)
+        self._multiplex = multiplex
+        self._mux_port = None
+        self._control = None
+        # NOTE: paramiko has a single handler for all port forwards, channels
+        # are routed to tunnels by the remote port they arrived on.
+        self._routes = {}
         self._user = user
         self._key = key
+        self._keepalive = keepalive
+        self._timeout = timeout
+        self._reevaluate = reevaluate
+        self._evaluated = 0
+        # NOTE: a Future for the endpoint round trip times while probing.
+        self._probe = None
+        self._drain = drain
+        # NOTE: routes and mux port of each transport replaced by a faster
+        # one, until its channels are drained.
+        self._draining = {}
         self._ssh = None
+        self.endpoint = None
+        self._liveness = None
         self._tunnels = {}
-        self._forwarder = Forwarder()
+        self._forwarder = Forwarder(capture.from_env())
 
     @property
     def connected(self):
         if self._ssh is None:
             return False
 
-        try:
-            if not self.transport.is_alive():
-                raise Exception('Transport not alive')
-            self.transport.send_ignore()
-
-        except Exception:
-            LOGGER.exception('Not connected')
+        if not self.transport.is_alive() or not self._liveness.alive:
+            LOGGER.warning(
+                'Not connected, idle for %.1fs', self._liveness.idle)
             self._disconnect()
             return False
 
-        else:
-            return True
+        return True
 
     @property
     def transport(self):
@@ -181,11 +1038,22 @@ class SSHManager:
     def tunnels(self):
         return self._tunnels
 
-    def connect(self):
-        if self.connected:
-            return
+    @property
+    def listener(self):
+        "Called with (event, data) as tunnels, ports and channels change."
+        return self._forwarder.listener
+
+    @listener.setter
+    def listener(self, listener):
+        self._forwarder.listener = listener
+
+    def _emit(self, event, **data):
+        self._forwarder._emit(event, **data)
+
+    def _handshake(self, sock, endpoint):
+        host, addr, port = endpoint
         LOGGER.debug(
-            'Establishing ssh connection to: %s:%i', self._host, self._port)
+            'Establishing ssh connection to: %s(%s:%i)', host, addr, port)
         self._ssh = paramiko.SSHClient()
         if SSH_HOST_KEYS_FILE:
             self._ssh.load_host_keys(SSH_HOST_KEYS_FILE)
@@ -193,27 +1061,74 @@ class SSHManager:
         else:
             self._ssh.set_missing_host_key_policy(paramiko.WarningPolicy())
         try:
+            # NOTE: host keys are checked against the name, not the address.
             self._ssh.connect(
-                hostname=self._host, port=self._port, username=self._user,
-                pkey=self._key, look_for_keys=False,
+                hostname=host, port=port, username=self._user,
+                pkey=self._key, look_for_keys=False, sock=sock,
                 disabled_algorithms=DISABLED_ALGORITHMS
+                if isinstance(self._key, paramiko.RSAKey) else None
             )
 
-        except paramiko.SSHException:
+        except Exception:
             self._ssh = None
+            sock.close()
             raise
 
+    def connect(self):
+        if self.connected:
+            return
+        endpoints = self._endpoints.expand()
+        while True:
+            sock, endpoint = self._endpoints.race(endpoints)
+            try:
+                self._handshake(sock, endpoint)
+
+            except (paramiko.SSHException, OSError):
+                # Try the next endpoint, if any.
+                self._endpoints.rtts[endpoint] = None
+                endpoints.remove(endpoint)
+                if not endpoints:
+                    raise
+                LOGGER.exception('Error connecting to %s', endpoint)
+                continue
+            break
+
         LOGGER.debug('Established ssh connection')
-        self.transport.set_keepalive(30)
-        self.transport.open_session()
+        self.endpoint = endpoint
+        self._emit(
+            'transport_up', host=endpoint[0], addr=endpoint[1],
+            port=endpoint[2])
+        self._evaluated = time.monotonic()
+        self._liveness = Liveness(
+            self.transport, self._keepalive, self._timeout)
+        self._open_control()
 
-        for tunnel in self._tunnels.values():
+        if self._multiplex:
+            if self._tunnels:
+                self._setup_tunnels(list(self._tunnels.values()))
+            return
+        self._confirm([
             self._setup_tunnel(tunnel)
+            for tunnel in list(self._tunnels.values())
+        ])
 
     def _disconnect(self):
-        LOGGER.info('Disconnecting from: %s:%i', self._host, self._port)
+        LOGGER.info('Disconnecting from: %s(%s:%i)', *self.endpoint)
+        if self._liveness:
+            self._liveness.stop()
+            self._liveness = None
+        if self._control:
+            self._control.close()
+            self._control = None
         self._ssh.close()
         self._ssh = None
+        self._emit(
+            'transport_down', host=self.endpoint[0], addr=self.endpoint[1],
+            port=self.endpoint[2])
+        self.endpoint = None
+        # NOTE: forwards are requested again on connect.
+        self._mux_port = None
+        self._routes.clear()
 
     def disconnect(self):
         if not self.connected:
@@ -226,24 +1141,339 @@ class SSHManager:
             return
         self.connect()
 
+    def _check_endpoint(self):
+        "Move to a substantially faster endpoint if there is one."
+        if not self._ssh:
+            return
+        probe = self._probe
+        if probe is not None:
+            if not probe.done():
+                return
+            self._probe = None
+            best = self._faster(probe.result())
+            if best is not None:
+                LOGGER.info(
+                    'Moving from %s to faster endpoint %s', self.endpoint,
+                    best)
+                self._move()
+            return
+        if time.monotonic() - self._evaluated < self._reevaluate:
+            return
+        self._evaluated = time.monotonic()
+        # NOTE: probing takes up to the connect timeout, commands are not
+        # held up meanwhile.
+        self._probe = Future()
+        threading.Thread(
+            target=self._run_probe, args=(self._probe,), daemon=True).start()
+
+    def _run_probe(self, future):
+        try:
+            future.set_result(self._endpoints.probe())
+
+        except Exception as e:
+            future.set_exception(e)
+
+    def _faster(self, rtts):
+        "The endpoint substantially faster than the current one, if any."
+        if len(rtts) < 2:
+            return None
+        best, current = self._endpoints.best(rtts), rtts.get(self.endpoint)
+        if best is None or best == self.endpoint:
+            return None
+        if current is not None and rtts[best] > current * SSH_SWITCH_RATIO:
+            return None
+        return best
+
+    def _move(self):
+        """
+        Connect again, then drain the current connection.
+
+        Tunnels are registered on the new connection before the old one is
+        given up, channels open on the old one are closed after the drain
+        timeout. If connecting fails the current connection is kept.
+        """
+        old = (self._ssh, self._liveness, self._control, self.endpoint)
+        routes = (self._routes, self._mux_port)
+        transport = self.transport
+        self._draining[transport] = routes
+        self._ssh = self._liveness = self._control = self.endpoint = None
+        self._routes, self._mux_port = {}, None
+        try:
+            self.connect()
+
+        except Exception:
+            LOGGER.exception('Error moving, staying on %s', old[3])
+            if self._ssh is not None:
+                self._disconnect()
+            del self._draining[transport]
+            self._ssh, self._liveness, self._control, self.endpoint = old
+            self._routes, self._mux_port = routes
+            return
+        self._retire(*old)
+
+    def _retire(self, ssh, liveness, control, endpoint):
+        "Close a connection replaced by _move() once it is drained."
+        transport = ssh.get_transport()
+        liveness.stop()
+        if control:
+            control.close()
+        self._forwarder.drain(timeout=self._drain, transport=transport)
+
+        def _close():
+            LOGGER.info('Disconnecting from: %s(%s:%i)', *endpoint)
+            self._draining.pop(transport, None)
+            ssh.close()
+            self._emit(
+                'transport_down', host=endpoint[0], addr=endpoint[1],
+                port=endpoint[2])
+
+        if self._drain <= 0:
+            _close()
+            return
+        timer = threading.Timer(self._drain, _close)
+        timer.daemon = True
+        timer.start()
+
+    def _open_control(self):
+        try:
+            self._control = Control(self.transport)
+
+        except paramiko.SSHException:
+            # NOTE: older sshd only understands one command per exec.
+            LOGGER.warning('Control session refused, using exec')
+            self._control = None
+
+    def _command(self, command):
+        "Send a command to sshd, returns a Future or None."
+        if self._control is None:
+            channel = self.transport.open_session()
+            try:
+                channel.exec_command(command)
+
+            finally:
+                channel.close()
+            return None
+        if not self._control.alive:
+            LOGGER.warning('Control session closed, reopening')
+            self._open_control()
+            return self._command(command)
+        return self._control.send(command)
+
+    def _route(self, channel, origin, dest):
+        port = dest[1]
+        routes, mux_port = self._routes, self._mux_port
+        if self._draining:
+            # NOTE: a transport being drained still routes by its own ports.
+            routes, mux_port = self._draining.get(
+                channel.get_transport(), (routes, mux_port))
+        if self._multiplex and port == mux_port:
+            self._forwarder.handle_mux(channel, self._tunnels)
+            return
+        tunnel = routes.get(port)
+        if tunnel is None:
+            LOGGER.warning('No tunnel for remote port %i', port)
+            channel.close()
+            return
+        self._forwarder.handle(channel, tunnel)
+
+    def _request_forward(self):
+        with self._liveness.request_lock:
+            return self.transport.request_port_forward(
+                '0.0.0.0', 0, self._route)
+
+    def _cancel_forward(self, port):
+        # NOTE: Transport.cancel_port_forward() drops the handler shared by
+        # all forwards, so the request is sent directly.
+        with self._liveness.request_lock:
+            self.transport.global_request(
+                'cancel-tcpip-forward', ('0.0.0.0', port), wait=True)
+
     def _setup_tunnel(self, tunnel):
-        tunnel.remote_port = self.transport.request_port_forward(
-            '0.0.0.0',
-            0,
-            self._forwarder.create_handler(
-                tunnel.domain, tunnel.addr, tunnel.port),
-        )
+        """
+        Request a port forward for tunnel and register it with sshd.
+
+        Returns (tunnel, Future or None), pass it to _confirm().
+        """
+        tunnel.remote_port = self._request_forward()
+        self._routes[tunnel.remote_port] = tunnel
         try:
-            self._ssh.exec_command(
+            future = self._command(
                 f'tunnel {tunnel.domain} {tunnel.remote_port}')
 
         except Exception:
             LOGGER.exception('error adding tunnel')
+            self._drop(tunnel)
             raise
 
+        return tunnel, future
+
+    def _confirm(self, pending, timeout=SSH_CONTROL_TIMEOUT):
+        """
+        Wait for sshd to acknowledge tunnels from _setup_tunnel().
+
+        Acknowledged tunnels are added, refused ones are dropped and
+        returned.
+        """
+        refused = []
+        deadline = time.monotonic() + timeout
+        for tunnel, future in pending:
+            try:
+                if future is not None:
+                    future.result(max(0, deadline - time.monotonic()))
+
+            except ControlError as e:
+                LOGGER.error('Tunnel refused: %s, %s', tunnel.domain, e)
+                self._drop(tunnel)
+                refused.append(tunnel)
+                continue
+
+            except FutureTimeoutError:
+                LOGGER.warning('Command not acknowledged')
+            self._added(tunnel)
+        return refused
+
+    def _drop(self, tunnel):
+        "Undo _setup_tunnel() for a tunnel sshd would not register."
+        self._routes.pop(tunnel.remote_port, None)
+        try:
+            self._cancel_forward(tunnel.remote_port)
+
+        except Exception:
+            LOGGER.exception('Error cancelling port forward')
+        # NOTE: a tunnel registered before may be refused when it is
+        # registered again on connect.
+        if self._tunnels.get(tunnel.domain) is tunnel:
+            del self._tunnels[tunnel.domain]
+            self._forwarder.forget(tunnel.domain)
+            self._emit('tunnel_removed', domain=tunnel.domain)
+
+    def _added(self, tunnel):
+        "Record tunnel as registered on its remote port."
+        # NOTE: tunnels are registered again on each connect, only the
+        # first time is an addition.
+        added = tunnel.domain not in self._tunnels
         self._tunnels[tunnel.domain] = tunnel
+        if added:
+            self._emit('tunnel_added', domain=tunnel.domain, tunnel=tunnel)
+        self._emit(
+            'port_assigned', domain=tunnel.domain,
+            remote_port=tunnel.remote_port)
+
+    def _command_batched(self, command, domains):
+        """
+        Send `command <domain,...> <port>` in as few commands as possible.
+
+        Returns a (Future or None, domains) pair per command.
+        """
+        futures, batch, size = [], [], 0
+        for domain in domains + [None]:
+            if domain is None or size + len(domain) > EXEC_LIMIT:
+                if batch:
+                    futures.append((self._command(
+                        f'{command} {",".join(batch)} {self._mux_port}'),
+                        batch))
+                batch, size = [], 0
+            if domain is not None:
+                batch.append(domain)
+                size += len(domain) + 1
+        return futures
+
+    def _refused(self, batches, timeout=SSH_CONTROL_TIMEOUT):
+        "Wait for batched commands, returns the domains sshd refused."
+        refused = set()
+        deadline = time.monotonic() + timeout
+        for future, domains in batches:
+            if future is None:
+                continue
+            try:
+                future.result(max(0, deadline - time.monotonic()))
+
+            except ControlError as e:
+                LOGGER.warning('Command failed: %s', e)
+                refused.update(e.domains or domains)
+
+            except FutureTimeoutError:
+                LOGGER.warning('Command not acknowledged')
+        return refused
+
+    def _setup_tunnels(self, tunnels):
+        """
+        Register tunnels on the shared port forward.
+
+        Returns the domains sshd refused, they are dropped.
+        """
+        if self._mux_port is None:
+            self._mux_port = self._request_forward()
+        try:
+            batches = self._command_batched(
+                'tunnel', [t.domain for t in tunnels])
+
+        except Exception:
+            LOGGER.exception('error adding tunnels')
+            raise
+
+        refused = self._refused(batches)
+        for tunnel in tunnels:
+            if tunnel.domain in refused:
+                LOGGER.error('Tunnel refused: %s', tunnel.domain)
+                # NOTE: a tunnel registered before may be refused when it
+                # is registered again on connect.
+                if self._tunnels.pop(tunnel.domain, None) is not None:
+                    self._emit('tunnel_removed', domain=tunnel.domain)
+                continue
+            tunnel.remote_port = self._mux_port
+            self._added(tunnel)
+        if not self._tunnels:
+            self._cancel_forward(self._mux_port)
+            self._mux_port = None
+        return refused
+
+    def add_tunnels(self, tunnels):
+        "Add many tunnels, registrations are pipelined."
+        if not self._multiplex:
+            pending = [self._add_tunnel(tunnel) for tunnel in tunnels]
+            refused = self._confirm([p for p in pending if p is not None])
+            if refused:
+                domains = [t.domain for t in refused]
+                raise ControlError(f'Refused: {",".join(domains)}', domains)
+            return
+        added = []
+        for tunnel in {t.domain: t for t in tunnels}.values():
+            existing = self._tunnels.get(tunnel.domain)
+            if existing is None:
+                added.append(tunnel)
+            elif existing != tunnel:
+                # NOTE: the backend is looked up per connection, so only the
+                # local entry needs replacing.
+                self._retarget(existing, tunnel)
+        if not added:
+            return
+        # NOTE: Connection must be up in order to add tunnel.
+        self._check_connection(connect=True)
+        refused = self._setup_tunnels(added)
+        if refused:
+            raise ControlError(
+                f'Refused: {",".join(sorted(refused))}', sorted(refused))
 
     def add_tunnel(self, tunnel):
+        self.add_tunnels([tunnel])
+
+    def _retarget(self, existing, tunnel):
+        """
+        Send new channels for existing to tunnel's backends instead.
+
+        The remote port is kept, channels already open stay on the old
+        backends until they finish.
+        """
+        LOGGER.info('Retargeting: %s', tunnel)
+        tunnel.remote_port = existing.remote_port
+        self._tunnels[tunnel.domain] = tunnel
+        if self._routes.get(tunnel.remote_port) is existing:
+            self._routes[tunnel.remote_port] = tunnel
+        self._forwarder.forget(tunnel.domain)
+        self._emit('tunnel_changed', domain=tunnel.domain, tunnel=tunnel)
+
+    def _add_tunnel(self, tunnel):
         # Check if there is an existing tunnel for this domain.
         existing = self._tunnels.get(tunnel.domain)
         if existing:
@@ -253,42 +1483,122 @@ class SSHManager:
             )
             if existing == tunnel:
                 LOGGER.debug('Matched, leaving')
-                return
-            self.del_tunnel(tunnel)
+                return None
+            self._retarget(existing, tunnel)
+            # NOTE: connecting registers every tunnel, this one included.
+            self._check_connection(connect=True)
+            return None
         # NOTE: Connection must be up in order to add tunnel.
         self._check_connection(connect=True)
-        self._setup_tunnel(tunnel)
+        return self._setup_tunnel(tunnel)
+
+    def del_tunnel(self, tunnel, drain=SSH_DRAIN_TIMEOUT):
+        """
+        Remove a tunnel.
 
-    def del_tunnel(self, tunnel):
+        No new channels are accepted, open ones are closed after drain
+        seconds, immediately if drain is 0.
+        """
         try:
             tunnel = self._tunnels.pop(tunnel.domain)
         except KeyError:
             return
-        self.transport.cancel_port_forward('0.0.0.0', tunnel.remote_port)
+        self._emit('tunnel_removed', domain=tunnel.domain)
+        self._forwarder.drain(tunnel.domain, drain)
+        self._forwarder.forget(tunnel.domain)
+        if not self._multiplex:
+            self._routes.pop(tunnel.remote_port, None)
+        if not self.connected:
+            return
+        if self._multiplex:
+            self._refused(self._command_batched('untunnel', [tunnel.domain]))
+            if self._tunnels:
+                return
+            self._mux_port = None
+        self._cancel_forward(tunnel.remote_port)
 
     def list_tunnels(self):
         return self._tunnels.values()
 
+    def tunnel_stats(self):
+        return self._forwarder.tunnel_stats()
+
+    def stats(self):
+        stats = self._forwarder.stats()
+        stats.update({
+            'connected': self.connected,
+            'tunnels': len(self._tunnels),
+        })
+        stats['cache_hit_ratio'] = httpcache.hit_ratio(stats)
+        return stats
+
     def poll(self):
         try:
             self._check_connection()
+            self._check_endpoint()
 
         except Exception:
             LOGGER.exception('Error polling')
             return
 
 
-def load_key(path=SSH_KEY_FILE):
+def _generate_ed25519():
+    # NOTE: paramiko can neither generate nor save ed25519 keys, so
+    # cryptography is used and the key is stored in OpenSSH format.
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import ed25519
+
+    data = ed25519.Ed25519PrivateKey.generate().private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.OpenSSH,
+        serialization.NoEncryption(),
+    ).decode()
+    return paramiko.Ed25519Key(file_obj=StringIO(data)), data
+
+
+def generate_key(key_type=SSH_KEY_TYPE):
+    """
+    Generate a new private key.
+
+    Returns the key and its OpenSSH / PEM encoded private key.
+    """
+    if key_type == 'ed25519':
+        return _generate_ed25519()
+    if key_type == 'ecdsa':
+        key = paramiko.ECDSAKey.generate(bits=256)
+    elif key_type == 'rsa':
+        key = paramiko.RSAKey.generate(2048)
+    else:
+        raise ValueError(f'Invalid key type: {key_type}')
+    data = StringIO()
+    key.write_private_key(data)
+    return key, data.getvalue()
+
+
+def read_key(path):
+    "Load a private key of any supported type."
+    for klass in (paramiko.Ed25519Key, paramiko.ECDSAKey, paramiko.RSAKey):
+        try:
+            return klass.from_private_key_file(path)
+
+        except paramiko.SSHException:
+            continue
+    raise paramiko.SSHException(f'Unsupported key type: {path}')
+
+
+def load_key(path=SSH_KEY_FILE, key_type=SSH_KEY_TYPE):
     "Generate a client key for use with the library."
     if path is not None:
         if isfile(path):
             LOGGER.debug('Loading key from: %s', path)
-            return paramiko.RSAKey.from_private_key_file(path)
-    LOGGER.info('Generating new private key')
-    key = paramiko.RSAKey.generate(2048)
+            return read_key(path)
+    LOGGER.info('Generating new %s private key', key_type)
+    key, data = generate_key(key_type)
     if path is not None:
         LOGGER.debug('Saving new to key: %s', path)
-        key.write_private_key_file(path)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
     return key
 
 
@@ -306,9 +1616,10 @@ def save_host_keys(keys, path=SSH_HOST_KEYS_FILE):
         f.write('\n'.join(keys.difference(existing)))
 
 
-def create_manager(host=SSH_HOST, port=SSH_PORT, user=SSH_USER, key=None):
+def create_manager(host=SSH_HOST, port=SSH_PORT, user=SSH_USER, key=None,
+                   key_type=SSH_KEY_TYPE):
     if key is None:
         key = SSH_KEY_FILE
     if isinstance(key, str):
-        key = load_key(key)
+        key = load_key(key, key_type)
     return SSHManager(host, port, user, key=key)
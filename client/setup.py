@@ -14,7 +14,9 @@ with open(readme) as readme_file:
 setup(
     name = package_name,
     version = version,
-    install_requires=['paramiko', 'python-ddns'],
+    install_requires=[
+        'paramiko', 'python-ddns', 'dnspython', 'requests', 'pyyaml',
+    ],
     description = "Client for homeland social's coduit.",
     long_description = long_description,
     author = 'Ben Timby',
@@ -1,2 +1,10 @@
 from tests.test_ssh import *
 from tests.test_server import *
+from tests.test_shard import *
+from tests.test_dns import *
+from tests.test_profiler import *
+from tests.test_httpcache import *
+from tests.test_balancer import *
+from tests.test_capture import *
+from tests.test_daemon import *
+from tests.test_wan import *
@@ -0,0 +1,149 @@
+import socket
+import threading
+import unittest
+import logging
+
+from conduit_client import balancer
+from conduit_client.balancer import Balancer
+from conduit_client.ssh import Connection, Forwarder, Tunnel
+
+
+LOGGER = logging.getLogger()
+LOGGER.setLevel(logging.ERROR)
+LOGGER.addHandler(logging.NullHandler())
+
+
+def _closed_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+class Listener:
+    "Accepts connections, answering each with response if given."
+    def __init__(self, response=None):
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.bind(('127.0.0.1', 0))
+        self._socket.listen(10)
+        self.port = self._socket.getsockname()[1]
+        self._response = response
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                client, _ = self._socket.accept()
+
+            except OSError:
+                return
+            if self._response:
+                client.recv(1024)
+                client.sendall(self._response)
+            client.close()
+
+    def close(self):
+        self._socket.close()
+
+
+def _connect(backend, timeout):
+    return socket.create_connection((backend.addr, backend.port), timeout)
+
+
+class BalancerTestCase(unittest.TestCase):
+    def test_least_conn(self):
+        b = Balancer('foo.com', [('a', 1), ('b', 1), ('c', 1, 2)])
+        a, b_, c = b.backends
+        a.active, b_.active, c.active = 1, 0, 2
+        self.assertIs(b_, b.choose())
+        # Weighted, c can take twice the connections.
+        b_.active = 2
+        self.assertIs(c, b.choose())
+
+    def _spread(self, strategy):
+        b = Balancer('foo.com', [('a', 1), ('b', 1), ('c', 1)], strategy)
+        for _ in range(30):
+            b.choose().acquire()
+        return [backend.active for backend in b.backends]
+
+    def test_even(self):
+        self.assertEqual([10, 10, 10], self._spread('least_conn'))
+        # Two random choices keep the spread small, though not exact.
+        spread = self._spread('p2c')
+        self.assertLessEqual(max(spread) - min(spread), 4)
+
+    def test_eject(self):
+        b = Balancer('foo.com', [('a', 1), ('b', 1)])
+        a, b_ = b.backends
+        for _ in range(balancer.BACKEND_EJECT_FAILURES):
+            a.failed()
+        self.assertTrue(a.ejected)
+        self.assertTrue(all(b.choose() is b_ for _ in range(10)))
+        # When nothing is available everything is tried.
+        b_.healthy = False
+        self.assertIsNotNone(b.choose())
+        self.assertIsNone(b.choose(exclude=[a, b_]))
+
+    def test_update(self):
+        b = Balancer('foo.com', [('a', 1), ('b', 1)])
+        a = b.backends[0]
+        a.acquire()
+        b.update([('a', 1, 3), ('c', 1)])
+        self.assertIs(a, b.backends[0])
+        self.assertEqual((1, 3), (a.active, a.weight))
+        self.assertEqual(['a', 'c'], [backend.addr for backend in b.backends])
+
+    def test_check_tcp(self):
+        listener = Listener()
+        try:
+            b = Balancer('foo.com', [
+                ('127.0.0.1', listener.port), ('127.0.0.1', _closed_port())])
+            b.check(_connect)
+            self.assertEqual(
+                [True, False], [backend.healthy for backend in b.backends])
+        finally:
+            listener.close()
+
+    def test_check_http(self):
+        ok = Listener(b'HTTP/1.1 200 OK\r\n\r\n')
+        error = Listener(b'HTTP/1.1 503 Unavailable\r\n\r\n')
+        try:
+            b = Balancer('foo.com', [
+                ('127.0.0.1', ok.port), ('127.0.0.1', error.port)], http=True)
+            b.check(_connect)
+            self.assertEqual(
+                [True, False], [backend.healthy for backend in b.backends])
+        finally:
+            ok.close()
+            error.close()
+
+
+class ForwarderBalanceTestCase(unittest.TestCase):
+    def test_failover(self):
+        listener = Listener()
+        try:
+            forwarder = Forwarder()
+            # The dead backend is heavily weighted, so it is tried first.
+            tunnel = Tunnel('foo.com', backends=[
+                ('127.0.0.1', _closed_port(), 100),
+                ('127.0.0.1', listener.port),
+            ])
+            dead, live = forwarder.balancer_for(tunnel).backends
+            conn = Connection(None, 'foo.com')
+            server = forwarder._open(tunnel, conn)
+            self.assertIsNotNone(server)
+            self.assertEqual((1, 1), (dead.failures, live.active))
+            self.assertIs(live, conn.backend)
+            forwarder._disconnect(conn)
+            self.assertEqual(0, live.active)
+        finally:
+            listener.close()
+
+    def test_pickle_compat(self):
+        tunnel = Tunnel('foo.com', '127.0.0.1', 80)
+        self.assertNotIn('backends', vars(tunnel))
+        self.assertEqual([('127.0.0.1', 80)], tunnel.targets)
+        balanced = Tunnel('foo.com', '127.0.0.1', 80, backends=[
+            ('127.0.0.1', 80), ('127.0.0.1', 81)])
+        self.assertNotEqual(tunnel, balanced)
@@ -0,0 +1,135 @@
+import os
+import socket
+import tempfile
+import threading
+import time
+import unittest
+import logging
+import warnings
+
+from conduit_client import capture, replay
+from conduit_client.capture import Capture
+from conduit_client.ssh import Forwarder, Tunnel
+
+
+LOGGER = logging.getLogger()
+LOGGER.setLevel(logging.ERROR)
+LOGGER.addHandler(logging.NullHandler())
+
+
+class Echo:
+    "Echoes back whatever is received."
+    def __init__(self):
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.bind(('127.0.0.1', 0))
+        self._socket.listen(10)
+        self.port = self._socket.getsockname()[1]
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        client, _ = self._socket.accept()
+        with client:
+            while True:
+                data = client.recv(1024)
+                if not data:
+                    return
+                client.sendall(data)
+
+    def close(self):
+        self._socket.close()
+
+
+class CaptureTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mktemp()
+
+    def tearDown(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def test_read_write(self):
+        c = Capture(self.path, payload=True)
+        a, b = object(), object()
+        c.data(a, capture.KIND_IN, b'hello')
+        c.data(b, capture.KIND_OUT, b'world!')
+        c.closed(a)
+        c.close()
+        _, records = capture.read(self.path)
+        self.assertEqual([
+            (0, capture.KIND_IN, 5, b'hello'),
+            (1, capture.KIND_OUT, 6, b'world!'),
+            (0, capture.KIND_CLOSE, 0, None),
+        ], [(r.conn, r.kind, r.size, r.payload) for r in records])
+
+    def test_sizes_only(self):
+        c = Capture(self.path)
+        c.data(object(), capture.KIND_IN, b'hello')
+        c.close()
+        _, records = capture.read(self.path)
+        self.assertEqual((5, None), (records[0].size, records[0].payload))
+
+    def test_unclosed(self):
+        c = Capture(self.path)
+        c.data(object(), capture.KIND_IN, b'hello')
+        # Records are on disk without closing, as when the manager is killed.
+        _, records = capture.read(self.path)
+        self.assertEqual(1, len(records))
+        c.close()
+
+    def test_limit(self):
+        limit = capture.HEADER.size + capture.RECORD.size * 2
+        c = Capture(self.path, limit=limit)
+        for _ in range(5):
+            c.data(object(), capture.KIND_IN, b'x')
+        c.close()
+        self.assertTrue(c.full)
+        self.assertEqual(limit, os.path.getsize(self.path))
+
+    def test_forwarder(self):
+        echo = Echo()
+        c = Capture(self.path, payload=True)
+        forwarder = Forwarder(capture=c)
+        client, channel = socket.socketpair()
+        try:
+            forwarder.handle(
+                channel, Tunnel('foo.com', '127.0.0.1', echo.port))
+            client.sendall(b'ping')
+            client.settimeout(2)
+            self.assertEqual(b'ping', client.recv(4))
+        finally:
+            client.close()
+            echo.close()
+        # Wait for the forwarder to notice the close.
+        deadline = time.monotonic() + 2
+        while forwarder.stats()['connections'] and \
+                time.monotonic() < deadline:
+            time.sleep(0.01)
+        c.close()
+        _, records = capture.read(self.path)
+        self.assertEqual([
+            (capture.KIND_IN, b'ping'),
+            (capture.KIND_OUT, b'ping'),
+            (capture.KIND_CLOSE, None),
+        ], [(r.kind, r.payload) for r in records])
+        self.assertEqual({0}, {r.conn for r in records})
+
+
+class ReplayTestCase(unittest.TestCase):
+    def test_replay(self):
+        records = [
+            capture.Record(0.0, 0, capture.KIND_IN, 100, None),
+            capture.Record(0.1, 1, capture.KIND_IN, 5, b'hello'),
+            capture.Record(0.2, 0, capture.KIND_OUT, 20000, None),
+            capture.Record(0.3, 1, capture.KIND_OUT, 5, b'world'),
+            capture.Record(0.4, 0, capture.KIND_CLOSE, 0, None),
+        ]
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            report = replay.Replay(records, speed=10).run()
+        self.assertEqual(2, report['connections'])
+        self.assertEqual(0, report['failed'])
+        self.assertEqual(
+            (105, 20005), (report['bytes_in'], report['bytes_out']))
+        self.assertGreater(report['latency_out_p50'], 0)
@@ -0,0 +1,159 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import logging
+
+from conduit_client import daemon
+from conduit_client.daemon import Daemon, Watcher
+from conduit_client.ssh import Tunnel
+
+
+LOGGER = logging.getLogger()
+LOGGER.setLevel(logging.CRITICAL)
+LOGGER.addHandler(logging.NullHandler())
+
+CONFIG = '''
+tunnels:
+  - domain: Foo.com
+    addr: 127.0.0.1
+    port: 8080
+  - domain: bar.com
+    mode: http
+    backends: [[10.0.0.1, 80], [10.0.0.2, 80, 2]]
+'''
+
+
+class FakeManager:
+    def __init__(self, tunnels=()):
+        self.tunnels = {t.domain: t for t in tunnels}
+        self.calls = []
+        self.failing = set()
+
+    def list_tunnels(self):
+        return list(self.tunnels.values())
+
+    def add_tunnel(self, tunnel):
+        self.calls.append(('add', tunnel.domain))
+        if tunnel.domain in self.failing:
+            raise RuntimeError('Refused')
+        self.tunnels[tunnel.domain] = tunnel
+
+    def del_tunnel(self, tunnel):
+        self.calls.append(('del', tunnel.domain))
+        del self.tunnels[tunnel.domain]
+
+
+class ParseTestCase(unittest.TestCase):
+    def test_yaml(self):
+        tunnels = daemon.parse(CONFIG, 'tunnels.yml')
+        self.assertEqual(['foo.com', 'bar.com'], list(tunnels))
+        self.assertEqual(
+            Tunnel('foo.com', '127.0.0.1', 8080), tunnels['foo.com'])
+        self.assertEqual(Tunnel.MODE_HTTP, tunnels['bar.com'].mode)
+        self.assertEqual(
+            [('10.0.0.1', 80), ('10.0.0.2', 80, 2)],
+            tunnels['bar.com'].targets)
+
+    def test_json(self):
+        tunnels = daemon.parse(json.dumps([
+            {'domain': 'foo.com', 'addr': 'web', 'port': '80'},
+        ]), 'tunnels.json')
+        self.assertEqual(80, tunnels['foo.com'].port)
+
+    def test_invalid(self):
+        for config in (
+                [{'addr': 'web', 'port': 80}],
+                [{'domain': 'foo.com'}],
+                [{'domain': 'foo.com', 'addr': 'web', 'port': 80,
+                  'mode': 'udp'}],
+                [{'domain': 'foo.com', 'addr': 'web', 'port': 80,
+                  'prot': 80}],
+                [{'domain': 'foo.com', 'addr': 'web', 'port': 80}] * 2,
+                {'tunnels': 'foo.com'}):
+            with self.assertRaises(ValueError):
+                daemon.parse(json.dumps(config))
+
+    def test_diff(self):
+        live = {
+            'a.com': Tunnel('a.com', 'web', 80, remote_port=1234),
+            'b.com': Tunnel('b.com', 'web', 80),
+            'c.com': Tunnel('c.com', 'web', 80),
+        }
+        desired = {
+            'a.com': Tunnel('a.com', 'web', 80),
+            'b.com': Tunnel('b.com', 'web', 81),
+            'd.com': Tunnel('d.com', 'web', 80),
+        }
+        add, remove = daemon.diff(desired, live)
+        self.assertEqual(['b.com', 'd.com'], [t.domain for t in add])
+        self.assertEqual(['c.com'], [t.domain for t in remove])
+
+
+class DaemonTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'tunnels.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _write(self, tunnels, path=None):
+        with open(path or self.path, 'w') as f:
+            json.dump({'tunnels': [
+                {'domain': domain, 'addr': 'web', 'port': port}
+                for domain, port in tunnels
+            ]}, f)
+
+    def test_reconcile(self):
+        manager = FakeManager([
+            Tunnel('a.com', 'web', 80), Tunnel('b.com', 'web', 80)])
+        d = Daemon(self.path, manager)
+        self._write([('a.com', 80), ('c.com', 80)])
+        self.assertEqual(2, d.reconcile())
+        self.assertEqual(
+            [('add', 'c.com'), ('del', 'b.com')], sorted(manager.calls))
+        # Tunnels already running are not applied again.
+        self.assertEqual(0, d.reconcile())
+        self.assertEqual(2, len(manager.calls))
+
+    def test_retry(self):
+        manager = FakeManager()
+        manager.failing.add('b.com')
+        d = Daemon(self.path, manager)
+        self._write([('a.com', 80), ('b.com', 80)])
+        self.assertEqual(1, d.reconcile())
+        self.assertEqual(['a.com'], list(manager.tunnels))
+        # The file is unchanged, the failed tunnel is tried again.
+        manager.failing.clear()
+        self.assertEqual(1, d.reconcile())
+        self.assertEqual(['a.com', 'b.com'], sorted(manager.tunnels))
+        # Tunnels removed behind the daemon's back come back too.
+        del manager.tunnels['a.com']
+        self.assertEqual(1, d.reconcile())
+        self.assertIn('a.com', manager.tunnels)
+
+    def test_invalid(self):
+        manager = FakeManager([Tunnel('a.com', 'web', 80)])
+        d = Daemon(self.path, manager)
+        with open(self.path, 'w') as f:
+            f.write('{"tunnels": [')
+        self.assertEqual(0, d.reconcile())
+        self.assertEqual(['a.com'], list(manager.tunnels))
+
+    def test_watch(self):
+        self._write([('a.com', 80)])
+        watcher = Watcher(self.path)
+        try:
+            self.assertFalse(watcher.wait(0.1))
+            # Replaced by rename, as editors do.
+            tmp = os.path.join(self.dir, 'tunnels.tmp')
+            self._write([('b.com', 80)], tmp)
+            os.rename(tmp, self.path)
+            self.assertTrue(watcher.wait(2))
+            # Other files are ignored.
+            self._write([], os.path.join(self.dir, 'other.json'))
+            self.assertFalse(watcher.wait(0.3))
+        finally:
+            watcher.close()
@@ -0,0 +1,737 @@
+import os
+import time
+import json
+import socket
+import tempfile
+import functools
+import threading
+import unittest
+import logging
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from conduit_client import dns
+
+
+LOGGER = logging.getLogger()
+LOGGER.setLevel(logging.ERROR)
+LOGGER.addHandler(logging.NullHandler())
+dns.LOGGER.setLevel(logging.CRITICAL)
+
+
+class FakeProvider:
+    delay = 0.0
+    calls = []
+    instances = 0
+    active = 0
+    max_active = 0
+    lock = threading.Lock()
+
+    def __init__(self, config, version):
+        self.config = config
+        self.__class__.instances += 1
+
+    def main(self, ip, ipv6):
+        cls = self.__class__
+        with cls.lock:
+            cls.active += 1
+            cls.max_active = max(cls.max_active, cls.active)
+        try:
+            time.sleep(cls.delay)
+            options = next(iter(self.config.values()))
+            if options.get('fail'):
+                raise ValueError('Provider error')
+            cls.calls.append((options['Name'], ip))
+        finally:
+            with cls.lock:
+                cls.active -= 1
+
+
+def _provider(delay=0.0):
+    return type('Provider', (FakeProvider, ), {
+        'delay': delay, 'calls': [], 'active': 0, 'max_active': 0,
+        'instances': 0,
+        'lock': threading.Lock(),
+    })
+
+
+def _domain(name, provider='fake', **options):
+    return {'name': name, 'provider': provider, 'options': options}
+
+
+class DNSTestCase(unittest.TestCase):
+    def setUp(self):
+        self._saved = (
+            dns.PROVIDERS, dns.fetch_domains, dns.IP_CACHE,
+            dns.UPDATE_TIMEOUT)
+        self.domains = []
+        self.changed = True
+        dns.PROVIDERS = {}
+        dns.fetch_domains = lambda: (self.domains, self.changed)
+        self.cache_path = tempfile.mktemp()
+        dns.IP_CACHE = dns.IpCache(self.cache_path)
+        dns._LAST_ROUND = None
+        dns._CLIENTS.clear()
+
+    def tearDown(self):
+        (dns.PROVIDERS, dns.fetch_domains, dns.IP_CACHE,
+         dns.UPDATE_TIMEOUT) = self._saved
+        if os.path.exists(self.cache_path):
+            os.remove(self.cache_path)
+
+    def add_provider(self, name, delay=0.0):
+        provider = _provider(delay)
+        dns.PROVIDERS[name] = (name, provider)
+        return provider
+
+
+class UpdateTestCase(DNSTestCase):
+    def test_update(self):
+        provider = self.add_provider('fake')
+        self.domains = [_domain('foo.com'), _domain('bar.com', fail=True)]
+        results = dns.update_dns('1.2.3.4')
+        self.assertEqual(dns.RESULT_UPDATED, results['foo.com'][0])
+        self.assertEqual(dns.RESULT_FAILED, results['bar.com'][0])
+        self.assertIsInstance(results['bar.com'][1], ValueError)
+        self.assertEqual([('foo.com', '1.2.3.4')], provider.calls)
+        self.assertEqual('1.2.3.4', dns.IP_CACHE.get('foo.com'))
+        self.assertNotIn('bar.com', dns.IP_CACHE)
+        # Cache is persisted as soon as the update succeeds.
+        self.assertEqual(
+            '1.2.3.4', dns.IpCache(self.cache_path).get('foo.com'))
+
+        results = dns.update_dns('1.2.3.4')
+        self.assertEqual(dns.RESULT_SKIPPED, results['foo.com'][0])
+        self.assertEqual(1, len(provider.calls))
+
+    def test_reuse(self):
+        provider = self.add_provider('fake')
+        self.domains = [_domain('foo.com'), _domain('bar.com')]
+        dns.update_dns('1.2.3.4')
+        dns.update_dns('4.3.2.1')
+        self.assertEqual(4, len(provider.calls))
+        self.assertEqual(2, provider.instances)
+
+    def test_prune(self):
+        provider = self.add_provider('fake')
+        self.domains = [_domain('foo.com'), _domain('bar.com')]
+        dns.update_dns('1.2.3.4')
+        self.assertEqual(2, len(dns._CLIENTS))
+        self.domains = [_domain('foo.com')]
+        dns.update_dns('4.3.2.1')
+        self.assertEqual(1, len(dns._CLIENTS))
+        # The remaining record keeps its client.
+        self.assertEqual(2, provider.instances)
+
+    def test_invalid(self):
+        self.domains = [_domain('foo.com', provider='missing')]
+        results = dns.update_dns('1.2.3.4')
+        self.assertEqual(dns.RESULT_FAILED, results['foo.com'][0])
+
+    def test_concurrent(self):
+        slow = self.add_provider('slow', delay=0.3)
+        fast = self.add_provider('fast', delay=0.3)
+        self.domains = [
+            _domain(f'{i}.{name}.com', provider=name)
+            for i in range(2) for name in ('slow', 'fast')
+        ]
+        start = time.monotonic()
+        results = dns.update_dns('1.2.3.4')
+        elapsed = time.monotonic() - start
+        self.assertEqual(4, len(results))
+        self.assertLess(elapsed, 0.6)
+        self.assertEqual(4, len(slow.calls) + len(fast.calls))
+
+    def test_provider_limit(self):
+        provider = self.add_provider('fake', delay=0.1)
+        self.domains = [_domain(f'{i}.com') for i in range(6)]
+        dns.update_dns('1.2.3.4')
+        self.assertEqual(6, len(provider.calls))
+        self.assertLessEqual(provider.max_active, dns.PROVIDER_CONCURRENCY)
+
+    def test_timeout(self):
+        dns.UPDATE_TIMEOUT = 0.2
+        self.add_provider('slow', delay=1.0)
+        self.add_provider('fast')
+        self.domains = [
+            _domain('slow.com', provider='slow'),
+            _domain('fast.com', provider='fast'),
+        ]
+        start = time.monotonic()
+        results = dns.update_dns('1.2.3.4')
+        self.assertLess(time.monotonic() - start, 0.9)
+        self.assertEqual(dns.RESULT_TIMEOUT, results['slow.com'][0])
+        self.assertEqual(dns.RESULT_UPDATED, results['fast.com'][0])
+        self.assertNotIn('slow.com', dns.IP_CACHE)
+        # Cached once it succeeds in the background.
+        time.sleep(1.0)
+        self.assertEqual('1.2.3.4', dns.IP_CACHE.get('slow.com'))
+
+    def test_unchanged(self):
+        provider = self.add_provider('fake')
+        self.domains = [_domain('foo.com')]
+        dns.update_dns('1.2.3.4')
+        self.changed = False
+        self.assertEqual({}, dns.update_dns('1.2.3.4'))
+        results = dns.update_dns('4.3.2.1')
+        self.assertEqual(dns.RESULT_UPDATED, results['foo.com'][0])
+        self.assertEqual(2, len(provider.calls))
+
+    def test_unchanged_failed(self):
+        self.add_provider('fake')
+        self.domains = [_domain('foo.com', fail=True)]
+        dns.update_dns('1.2.3.4')
+        self.changed = False
+        results = dns.update_dns('1.2.3.4')
+        self.assertEqual(dns.RESULT_FAILED, results['foo.com'][0])
+
+
+class DNSStandIn:
+    "Answers A queries from a dict over udp."
+    def __init__(self, records):
+        self.records = records
+        self.queries = []
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.bind(('127.0.0.1', 0))
+        self.port = self._sock.getsockname()[1]
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        import dns.message
+        import dns.rcode
+        import dns.rrset
+
+        while True:
+            try:
+                data, addr = self._sock.recvfrom(4096)
+            except OSError:
+                return
+            query = dns.message.from_wire(data)
+            name = query.question[0].name.to_text().rstrip('.')
+            self.queries.append(name)
+            response = dns.message.make_response(query)
+            if name in self.records:
+                response.answer.append(dns.rrset.from_text(
+                    name + '.', 60, 'IN', 'A', self.records[name]))
+            else:
+                response.set_rcode(dns.rcode.NXDOMAIN)
+            self._sock.sendto(response.to_wire(), addr)
+
+    def resolver(self):
+        resolver = dns._resolver(['127.0.0.1'], timeout=2.0)
+        resolver.port = self.port
+        return resolver
+
+    def stop(self):
+        self._sock.close()
+
+
+class PrecheckTestCase(DNSTestCase):
+    def setUp(self):
+        super().setUp()
+        self.stand_in = DNSStandIn({
+            'current.com': '1.2.3.4',
+            'stale.com': '4.3.2.1',
+            'static.com': '5.5.5.5',
+        })
+
+    def tearDown(self):
+        super().tearDown()
+        self.stand_in.stop()
+
+    def test_precheck(self):
+        provider = self.add_provider('fake')
+        self.domains = [
+            _domain('current.com'), _domain('stale.com'),
+            _domain('missing.com'),
+            _domain('static.com', **{'ip address': '5.5.5.5'}),
+        ]
+        results = dns.update_dns('1.2.3.4', self.stand_in.resolver())
+        self.assertEqual(dns.RESULT_CURRENT, results['current.com'][0])
+        self.assertEqual(dns.RESULT_CURRENT, results['static.com'][0])
+        self.assertEqual(dns.RESULT_UPDATED, results['stale.com'][0])
+        self.assertEqual(dns.RESULT_UPDATED, results['missing.com'][0])
+        self.assertEqual(
+            ['missing.com', 'stale.com'],
+            sorted(name for name, _ in provider.calls))
+        # Cache was filled from the precheck.
+        self.assertEqual('1.2.3.4', dns.IP_CACHE.get('current.com'))
+
+    def test_precheck_cached(self):
+        self.add_provider('fake')
+        self.domains = [_domain('current.com')]
+        dns.IP_CACHE.set('current.com', '1.2.3.4')
+        results = dns.update_dns('1.2.3.4', self.stand_in.resolver())
+        self.assertEqual(dns.RESULT_SKIPPED, results['current.com'][0])
+        self.assertEqual([], self.stand_in.queries)
+
+
+class CloudflareHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, output):
+        body = json.dumps(output).encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(('GET', self.path))
+        server.connections.add(self.client_address)
+        self._reply({'success': True, 'result': [
+            {'id': record_id, 'name': name}
+            for name, record_id in server.records.items()
+        ], 'result_info': {'total_pages': 1}})
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers['Content-Length'])
+        body = json.loads(self.rfile.read(length))
+        server.requests.append(('POST', self.path, body))
+        server.connections.add(self.client_address)
+        posts = []
+        for record in body['posts']:
+            record_id = server.records[record['name']] = f'id-{record["name"]}'
+            posts.append({'id': record_id, 'name': record['name']})
+        self._reply({'success': True, 'result': {'posts': posts}})
+
+
+class CloudflareServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, records):
+        super().__init__(('127.0.0.1', 0), CloudflareHandler)
+        self.records = records
+        self.requests = []
+        self.connections = set()
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class CloudflareTestCase(DNSTestCase):
+    OPTIONS = {'Zone': 'zone', 'API_Token': 'token', 'Email': 'a@b.com'}
+
+    def setUp(self):
+        super().setUp()
+        self.server = CloudflareServer({'foo.example.com': 'id-foo'})
+        self._batch = dns.BATCH_PROVIDERS
+        dns.PROVIDERS['cloudflare'] = self._saved[0]['cloudflare']
+        dns.BATCH_PROVIDERS = {
+            'cloudflare': functools.partial(
+                dns.CloudflareClient, api_url=self.server.url),
+        }
+
+    def tearDown(self):
+        super().tearDown()
+        dns.BATCH_PROVIDERS = self._batch
+        self.server.stop()
+
+    def test_batch(self):
+        client = dns.CloudflareClient(self.OPTIONS, api_url=self.server.url)
+        client.update({
+            'foo.example.com': '1.2.3.4', 'bar.example.com': '1.2.3.4',
+        })
+        self.assertEqual(2, len(self.server.requests))
+        method, path, body = self.server.requests[1]
+        self.assertEqual('/zones/zone/dns_records/batch', path)
+        self.assertEqual(
+            [{'id': 'id-foo', 'content': '1.2.3.4'}], body['patches'])
+        self.assertEqual(['bar.example.com'], [
+            r['name'] for r in body['posts']])
+
+        # Record ids are cached, including created records.
+        client.update({'bar.example.com': '4.3.2.1'})
+        self.assertEqual(3, len(self.server.requests))
+        _, _, body = self.server.requests[2]
+        self.assertEqual(
+            [{'id': 'id-bar.example.com', 'content': '4.3.2.1'}],
+            body['patches'])
+        self.assertEqual(1, len(self.server.connections))
+        client.close()
+
+    def test_grouped(self):
+        self.domains = [
+            _domain('foo.example.com', provider='cloudflare', **self.OPTIONS),
+            _domain('bar.example.com', provider='cloudflare', **self.OPTIONS),
+        ]
+        results = dns.update_dns('1.2.3.4')
+        self.assertEqual(dns.RESULT_UPDATED, results['foo.example.com'][0])
+        self.assertEqual(dns.RESULT_UPDATED, results['bar.example.com'][0])
+        self.assertEqual(1, len([
+            r for r in self.server.requests if r[0] == 'POST']))
+
+        results = dns.update_dns('4.3.2.1')
+        self.assertEqual(3, len(self.server.requests))
+        self.assertEqual(1, len(self.server.connections))
+        self.assertEqual(1, len(dns._CLIENTS))
+
+        # The client of the account is dropped with its last record.
+        self.domains = []
+        dns.update_dns('4.3.2.1')
+        self.assertEqual({}, dns._CLIENTS)
+
+
+class IpCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mktemp()
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def test_persist(self):
+        cache = dns.IpCache(self.path)
+        self.assertIsNone(cache.get('foo.com'))
+        cache.set('foo.com', '1.2.3.4')
+        cache = dns.IpCache(self.path)
+        self.assertEqual('1.2.3.4', cache.get('foo.com'))
+        self.assertLess(cache.age('foo.com'), 5.0)
+        self.assertFalse(os.path.exists(f'{self.path}.tmp'))
+
+    def test_discard(self):
+        cache = dns.IpCache(self.path)
+        cache.update(['foo.com', 'bar.com'], '1.2.3.4')
+        cache.discard(['foo.com', 'baz.com'])
+        self.assertNotIn('foo.com', dns.IpCache(self.path))
+        self.assertIn('bar.com', dns.IpCache(self.path))
+
+    def test_update(self):
+        cache = dns.IpCache(self.path)
+        saves = []
+        save, cache.save = cache.save, lambda: saves.append(save())
+        cache.update(['foo.com', 'bar.com'], '1.2.3.4')
+        self.assertEqual(1, len(saves))
+        cache = dns.IpCache(self.path)
+        self.assertEqual('1.2.3.4', cache.get('bar.com'))
+
+    def test_max_age(self):
+        cache = dns.IpCache(self.path)
+        cache.set('foo.com', '1.2.3.4')
+        cache._records['foo.com']['updated'] -= 100
+        self.assertEqual('1.2.3.4', cache.get('foo.com', max_age=200))
+        self.assertIsNone(cache.get('foo.com', max_age=50))
+
+    def test_legacy(self):
+        with open(self.path, 'w') as f:
+            json.dump({'foo.com': '1.2.3.4'}, f)
+        cache = dns.IpCache(self.path)
+        self.assertEqual('1.2.3.4', cache.get('foo.com'))
+        self.assertIsNone(cache.get('foo.com', max_age=60))
+
+    def test_corrupt(self):
+        with open(self.path, 'w') as f:
+            f.write('{"foo.com": ')
+        cache = dns.IpCache(self.path)
+        self.assertEqual(0, len(cache))
+        cache.set('foo.com', '1.2.3.4')
+        self.assertEqual('1.2.3.4', dns.IpCache(self.path).get('foo.com'))
+
+
+class ConsoleHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+        server.connections.add(self.client_address)
+        if self.headers.get('If-None-Match') == server.etag:
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = json.dumps({'objects': server.objects}).encode()
+        self.send_response(200)
+        self.send_header('ETag', server.etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class ConsoleServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), ConsoleHandler)
+        self.objects = [_domain('foo.com')]
+        self.etag = '"1"'
+        self.requests = []
+        self.connections = set()
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class ConsoleTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = ConsoleServer()
+        self.console = dns.ConsoleClient(self.server.url, 'token')
+
+    def tearDown(self):
+        self.console.close()
+        self.server.stop()
+
+    def test_conditional(self):
+        objects, changed = self.console.get('/api/domains/')
+        self.assertTrue(changed)
+        self.assertEqual(self.server.objects, objects)
+        objects, changed = self.console.get('/api/domains/')
+        self.assertFalse(changed)
+        self.assertEqual(self.server.objects, objects)
+        self.assertEqual('"1"', self.server.requests[-1]['If-None-Match'])
+        self.assertEqual(
+            'Bearer token', self.server.requests[-1]['Authorization'])
+
+        self.server.objects = [_domain('bar.com')]
+        self.server.etag = '"2"'
+        objects, changed = self.console.get('/api/domains/')
+        self.assertTrue(changed)
+        self.assertEqual('bar.com', objects[0]['name'])
+
+    def test_keepalive(self):
+        for _ in range(5):
+            self.console.get('/api/domains/')
+        self.assertEqual(1, len(self.server.connections))
+
+    def test_reconnect(self):
+        self.console.get('/api/domains/')
+        # Simulate the server dropping the idle connection.
+        self.console._conn.sock.close()
+        objects, changed = self.console.get('/api/domains/')
+        self.assertFalse(changed)
+        self.assertEqual(2, len(self.server.connections))
+
+
+class IpHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        time.sleep(self.server.delay)
+        body = self.server.ip.encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class IpServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, ip, delay=0.0):
+        super().__init__(('127.0.0.1', 0), IpHandler)
+        self.ip = ip
+        self.delay = delay
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}/'
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class IpDetectTestCase(unittest.TestCase):
+    def setUp(self):
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+
+    def server(self, ip, delay=0.0):
+        server = IpServer(ip, delay)
+        self.servers.append(server)
+        return server
+
+    def test_race(self):
+        sources = [
+            self.server('1.1.1.1', delay=1.0).url,
+            self.server('invalid').url,
+            self.server('2.2.2.2', delay=0.1).url,
+        ]
+        start = time.monotonic()
+        self.assertEqual('2.2.2.2', dns.get_ip(sources, timeout=2.0))
+        self.assertLess(time.monotonic() - start, 0.8)
+
+    def test_race_failed(self):
+        sources = [self.server('invalid').url, 'http://127.0.0.1:1/']
+        with self.assertRaises(ValueError):
+            dns.get_ip(sources, timeout=1.0)
+
+    def test_watcher(self):
+        netlink, stand_in = socket.socketpair()
+        watcher = dns.NetlinkWatcher(sock=netlink, settle=0.05)
+        try:
+            self.assertFalse(watcher.wait(0.05))
+            stand_in.send(b'change')
+            stand_in.send(b'change')
+            self.assertTrue(watcher.wait(1.0))
+            # The burst was drained.
+            self.assertFalse(watcher.wait(0.05))
+        finally:
+            watcher.close()
+            stand_in.close()
+
+    def test_detect(self):
+        server = self.server('1.1.1.1')
+        netlink, stand_in = socket.socketpair()
+        detector = dns.IpDetector(
+            interval=30.0, sources=[server.url],
+            watcher=dns.NetlinkWatcher(sock=netlink, settle=0.05),
+            rechecks=(0.1, ))
+        try:
+            self.assertEqual('1.1.1.1', detector.refresh())
+            server.ip = '2.2.2.2'
+            threading.Timer(0.1, stand_in.send, (b'change', )).start()
+            start = time.monotonic()
+            self.assertEqual('2.2.2.2', detector.wait())
+            self.assertLess(time.monotonic() - start, 2.0)
+        finally:
+            netlink.close()
+            stand_in.close()
+
+    def test_detect_lagging(self):
+        server = self.server('1.1.1.1')
+        netlink, stand_in = socket.socketpair()
+        detector = dns.IpDetector(
+            interval=30.0, sources=[server.url],
+            watcher=dns.NetlinkWatcher(sock=netlink, settle=0.05),
+            rechecks=(0.2, 0.2))
+        try:
+            detector.refresh()
+            stand_in.send(b'change')
+            # Public ip changes after the local change is seen.
+            threading.Timer(0.3, setattr, (server, 'ip', '2.2.2.2')).start()
+            self.assertEqual('2.2.2.2', detector.wait())
+        finally:
+            netlink.close()
+            stand_in.close()
+
+
+class SchedulerTestCase(unittest.TestCase):
+    def scheduler(self, **kwargs):
+        kwargs.setdefault('interval', 60.0)
+        kwargs.setdefault('spread', 0)
+        kwargs.setdefault('provider_intervals', {})
+        return dns.Scheduler(**kwargs)
+
+    def names(self, domains):
+        return sorted(domain['name'] for domain in domains)
+
+    def test_new_domains(self):
+        scheduler = self.scheduler()
+        scheduler.set_domains([_domain('foo.com'), _domain('bar.com')])
+        self.assertEqual(
+            ['bar.com', 'foo.com'], self.names(scheduler.wait(0.1)))
+        self.assertEqual([], scheduler.wait(0.05))
+
+    def test_removed(self):
+        scheduler = self.scheduler()
+        scheduler.set_domains([_domain('foo.com'), _domain('bar.com')])
+        scheduler.set_domains([_domain('foo.com')])
+        self.assertEqual(['foo.com'], self.names(scheduler.wait(0.1)))
+        self.assertEqual(1, len(scheduler))
+
+    def test_changed(self):
+        scheduler = self.scheduler(provider_intervals={'fake': 30.0})
+        scheduler.set_domains([_domain('foo.com'), _domain('bar.com')])
+        scheduler.wait(0)
+        scheduler.done({
+            'foo.com': (dns.RESULT_UPDATED, None),
+            'bar.com': (dns.RESULT_FAILED, None),
+        })
+        self.assertEqual([], scheduler.set_domains(
+            [_domain('foo.com'), _domain('bar.com')]))
+        changed = scheduler.set_domains([
+            _domain('foo.com', provider='other'),
+            _domain('bar.com', **{'ip address': '1.2.3.4'}),
+        ])
+        self.assertEqual(['bar.com', 'foo.com'], sorted(changed))
+        # Due now, the provider interval of foo.com's old provider is void.
+        self.assertEqual(
+            ['bar.com', 'foo.com'], self.names(scheduler.wait(0.1)))
+
+    def test_spread(self):
+        scheduler = self.scheduler(spread=10.0)
+        scheduler.set_domains([_domain(f'{i}.com') for i in range(50)])
+        dues = sorted(scheduler.due(f'{i}.com') for i in range(50))
+        self.assertGreater(dues[-1] - dues[0], 5.0)
+
+    def test_interval(self):
+        scheduler = self.scheduler(interval=0.2)
+        scheduler.set_domains([_domain('foo.com')])
+        scheduler.wait(0.1)
+        scheduler.done({'foo.com': (dns.RESULT_UPDATED, None)})
+        self.assertEqual([], scheduler.wait(0.1))
+        self.assertEqual(['foo.com'], self.names(scheduler.wait(0.5)))
+
+    def test_backoff(self):
+        scheduler = self.scheduler(retry=10.0, max_retry=25.0)
+        scheduler.set_domains([_domain('foo.com')])
+        delays = []
+        for _ in range(4):
+            scheduler.wait(0)
+            now = time.monotonic()
+            scheduler.done({'foo.com': (dns.RESULT_FAILED, None)})
+            delays.append(scheduler.due('foo.com') - now)
+            scheduler.wake(['foo.com'])
+        self.assertTrue(5.0 <= delays[0] <= 10.0)
+        self.assertTrue(10.0 <= delays[1] <= 20.0)
+        self.assertTrue(12.5 <= delays[3] <= 25.0)
+        # Success resets the backoff.
+        scheduler.wait(0)
+        scheduler.done({'foo.com': (dns.RESULT_SKIPPED, None)})
+        self.assertGreater(scheduler.due('foo.com') - time.monotonic(), 50.0)
+
+    def test_wake(self):
+        scheduler = self.scheduler()
+        scheduler.set_domains([_domain('foo.com')])
+        scheduler.wait(0)
+        scheduler.done({'foo.com': (dns.RESULT_SKIPPED, None)})
+        threading.Timer(0.1, scheduler.wake).start()
+        start = time.monotonic()
+        self.assertEqual(['foo.com'], self.names(scheduler.wait(5.0)))
+        self.assertLess(time.monotonic() - start, 1.0)
+
+    def test_wake_while_updating(self):
+        scheduler = self.scheduler()
+        scheduler.set_domains([_domain('foo.com')])
+        scheduler.wait(0)
+        scheduler.wake()
+        scheduler.done({'foo.com': (dns.RESULT_SKIPPED, None)})
+        self.assertEqual(['foo.com'], self.names(scheduler.wait(0.1)))
+
+    def test_provider_interval(self):
+        scheduler = self.scheduler(provider_intervals={'fake': 30.0})
+        scheduler.set_domains([_domain('foo.com')])
+        scheduler.wait(0)
+        scheduler.done({'foo.com': (dns.RESULT_UPDATED, None)})
+        scheduler.wake()
+        self.assertEqual([], scheduler.wait(0.1))
+        self.assertGreater(scheduler.due('foo.com') - time.monotonic(), 25.0)
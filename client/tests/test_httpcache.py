@@ -0,0 +1,171 @@
+import socket
+import threading
+import unittest
+import logging
+from http.client import HTTPResponse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from conduit_client import httpcache
+from conduit_client.httpcache import HttpCache, HttpProxy, Message
+
+
+LOGGER = logging.getLogger()
+LOGGER.setLevel(logging.ERROR)
+LOGGER.addHandler(logging.NullHandler())
+
+RESPONSES = {
+    '/static': (200, {'Cache-Control': 'max-age=60'}, b'static'),
+    '/etag': (200, {'Cache-Control': 'no-cache', 'ETag': '"v1"'}, b'etag'),
+    '/private': (200, {'Cache-Control': 'private, max-age=60'}, b'private'),
+    '/chunked': (200, {'Cache-Control': 'max-age=60'}, [b'chu', b'nked']),
+}
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests.append(
+            (self.command, self.path, self.headers.get('If-None-Match')))
+        status, headers, body = RESPONSES[self.path]
+        etag = headers.get('ETag')
+        if etag and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if isinstance(body, list):
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for chunk in body + [b'']:
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+            return
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.requests.append((self.command, self.path, body))
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class HttpProxyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.backend = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.backend.requests = []
+        threading.Thread(
+            target=self.backend.serve_forever, daemon=True).start()
+        self.cache = HttpCache()
+        self.client, channel = socket.socketpair()
+        proxy = HttpProxy(
+            channel, 'foo.com', self._connect, self.cache)
+        self.thread = threading.Thread(target=proxy.run, daemon=True)
+        self.thread.start()
+
+    def tearDown(self):
+        self.client.close()
+        self.thread.join(2)
+        self.backend.shutdown()
+        self.backend.server_close()
+
+    def _connect(self):
+        return socket.create_connection(self.backend.server_address)
+
+    def request(self, path, method='GET', headers=None, body=b''):
+        lines = [f'{method} {path} HTTP/1.1', 'Host: foo.com']
+        lines.extend(f'{k}: {v}' for k, v in (headers or {}).items())
+        if body:
+            lines.append(f'Content-Length: {len(body)}')
+        self.client.sendall(
+            ('\r\n'.join(lines) + '\r\n\r\n').encode() + body)
+        response = HTTPResponse(self.client, method=method)
+        response.begin()
+        return response, response.read()
+
+    def test_hit(self):
+        response, body = self.request('/static')
+        self.assertEqual((200, b'static'), (response.status, body))
+        self.assertEqual('MISS', response.getheader('X-Cache'))
+        response, body = self.request('/static')
+        self.assertEqual((200, b'static'), (response.status, body))
+        self.assertEqual('HIT', response.getheader('X-Cache'))
+        self.assertEqual(1, len(self.backend.requests))
+        self.assertEqual((1, 1), (self.cache.hits, self.cache.misses))
+
+    def test_conditional_hit(self):
+        self.request('/etag')
+        response, body = self.request(
+            '/etag', headers={'If-None-Match': '"v1"'})
+        # Revalidated with the backend, then answered from cache.
+        self.assertEqual((304, b''), (response.status, body))
+        self.assertEqual(
+            ('GET', '/etag', '"v1"'), self.backend.requests[-1])
+
+    def test_revalidate(self):
+        self.request('/etag')
+        response, body = self.request('/etag')
+        self.assertEqual((200, b'etag'), (response.status, body))
+        self.assertEqual('REVALIDATED', response.getheader('X-Cache'))
+        self.assertEqual(
+            [('GET', '/etag', None), ('GET', '/etag', '"v1"')],
+            self.backend.requests)
+        self.assertEqual(1, self.cache.revalidated)
+
+    def test_uncacheable(self):
+        self.request('/private')
+        self.request('/private')
+        response, body = self.request('/post', 'POST', body=b'data')
+        self.assertEqual(b'data', body)
+        self.assertEqual(3, len(self.backend.requests))
+        self.assertEqual(0, len(self.cache))
+
+    def test_chunked(self):
+        response, body = self.request('/chunked')
+        self.assertEqual(b'chunked', body)
+        response, body = self.request('/chunked')
+        self.assertEqual(b'chunked', body)
+        self.assertEqual('HIT', response.getheader('X-Cache'))
+        self.assertEqual(1, len(self.backend.requests))
+
+
+class HttpCacheTestCase(unittest.TestCase):
+    def _message(self, *start, **headers):
+        return Message(list(start), list(headers.items()))
+
+    def test_lru(self):
+        cache = HttpCache(size=400)
+        request = self._message('GET', '/', 'HTTP/1.1')
+        response = self._message('HTTP/1.1', '200', 'OK')
+        for key in 'abc':
+            cache.put(key, request, response, b'x' * 100)
+        cache.get('a', request)
+        cache.put('d', request, response, b'x' * 100)
+        self.assertIsNone(cache.get('b', request))
+        self.assertIsNotNone(cache.get('a', request))
+        self.assertLessEqual(cache.size, 400)
+
+    def test_vary(self):
+        cache = HttpCache()
+        request = self._message(
+            'GET', '/', 'HTTP/1.1', **{'Accept-Encoding': 'gzip'})
+        response = self._message(
+            'HTTP/1.1', '200', 'OK', Vary='Accept-Encoding')
+        cache.put('a', request, response, b'')
+        self.assertIsNotNone(cache.get('a', request))
+        self.assertIsNone(
+            cache.get('a', self._message('GET', '/', 'HTTP/1.1')))
+
+    def test_hit_ratio(self):
+        self.assertEqual(0.0, httpcache.hit_ratio({}))
+        self.assertEqual(0.75, httpcache.hit_ratio({
+            'cache_hits': 2, 'cache_revalidated': 1, 'cache_misses': 1}))
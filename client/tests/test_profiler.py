@@ -0,0 +1,62 @@
+import os
+import time
+import tempfile
+import threading
+import unittest
+import logging
+
+from conduit_client import profiler
+
+
+LOGGER = logging.getLogger()
+LOGGER.setLevel(logging.ERROR)
+LOGGER.addHandler(logging.NullHandler())
+
+
+def _busy(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+class SamplerTestCase(unittest.TestCase):
+    def test_profile(self):
+        stop = threading.Event()
+        thread = threading.Thread(target=_busy, args=(stop, ), daemon=True)
+        thread.start()
+        path = tempfile.mktemp()
+        try:
+            report = profiler.profile(0.2, path)
+        finally:
+            stop.set()
+            thread.join()
+        self.assertIn('_busy', report)
+        with open(path) as f:
+            self.assertIn('_busy', f.read())
+        os.remove(path)
+
+    def test_truncate(self):
+        text = profiler._truncate('x' * 100, limit=10)
+        self.assertTrue(text.startswith('x' * 10))
+        self.assertTrue(text.endswith('truncated'))
+        # The limit is in bytes, characters may take several.
+        text = profiler._truncate('\u00e9' * 100, limit=11)
+        self.assertTrue(text.startswith('\u00e9' * 5 + '\n'))
+
+
+class MemoryTestCase(unittest.TestCase):
+    def test_snapshot(self):
+        tracker = profiler.MemoryTracker()
+        with self.assertRaises(RuntimeError):
+            tracker.snapshot()
+        tracker.start()
+        try:
+            self.assertTrue(tracker.tracing)
+            tracker.snapshot()
+            data = [bytearray(1024) for _ in range(100)]
+            report = tracker.snapshot()
+            self.assertIn('change since last snapshot', report)
+            self.assertIn('test_profiler.py', report)
+            del data
+        finally:
+            tracker.stop()
+        self.assertFalse(tracker.tracing)
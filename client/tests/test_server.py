@@ -1,14 +1,18 @@
 import os
+import time
 import tempfile
 import socket
+import threading
 import unittest
 import logging
 from io import BytesIO
 
 from conduit_client.server import (
-    SSHManagerClient, SSHManagerServer, Command, DomainCommand, TunnelCommand,
+    SSHManagerClient, SSHManagerServer, ControlClient, Command, DomainCommand,
+    TunnelCommand, ProfileCommand, Peer, SSH_EVENT_QUEUE,
 )
 from conduit_client.ssh import Tunnel
+from conduit_client import profiler
 
 
 LOGGER = logging.getLogger()
@@ -79,6 +83,28 @@ class CommandTestCase(unittest.TestCase):
             }
         )
 
+    def test_pack_report(self):
+        report = profiler._truncate('\u00e9' * profiler.REPORT_LIMIT)
+        packed = ProfileCommand(Command.COMMAND_PROFILE, result=report).pack()
+        self.assertEqual(report, Command.unpack(BytesSocket(packed)).result)
+
+
+class FakeManager:
+    def __init__(self):
+        self.calls = []
+
+    def add_tunnels(self, tunnels):
+        self.calls.append(('add', [t.domain for t in tunnels]))
+
+    def del_tunnel(self, tunnel):
+        self.calls.append(('del', tunnel.domain))
+
+    def list_tunnels(self):
+        return [Tunnel('a.com')]
+
+    def poll(self):
+        pass
+
 
 class ServerTestCase(unittest.TestCase):
     def test_shutdown(self):
@@ -94,10 +120,206 @@ class ServerTestCase(unittest.TestCase):
             finally:
                 client.close()
 
+    def test_ready(self):
+        path = tempfile.mktemp()
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.bind(path)
+            sock.listen()
+            SSHManagerServer(path)
+            client, _ = sock.accept()
+            try:
+                command = Command.unpack(client, timeout=10.0)
+                self.assertEqual(Command.COMMAND_READY, command.command)
+                self.assertFalse(command.connected)
+            finally:
+                client.close()
+
 
 class ClientTestCase(unittest.TestCase):
+    def test_env(self):
+        os.environ['SSH_DEAD_PEER_TIMEOUT'] = '5'
+        try:
+            client = SSHManagerClient()
+        finally:
+            del os.environ['SSH_DEAD_PEER_TIMEOUT']
+        self.assertEqual('5', client._env['SSH_DEAD_PEER_TIMEOUT'])
+        self.assertNotIn('SSH_DRAIN_TIMEOUT', client._env)
+
+    def test_capture(self):
+        client = SSHManagerClient(capture='/tmp/capture.bin')
+        self.assertEqual('/tmp/capture.bin', client._env['CAPTURE_FILE'])
+
+    def test_callback(self):
+        client = SSHManagerClient(callback=True)
+        self.assertEqual('True', client._env['FORWARD_CALLBACK'])
+
     def test_start(self):
         client = SSHManagerClient()
         client.ping()
         client.disconnect()
         self.assertIsNone(client._server)
+
+    def test_eager(self):
+        client = SSHManagerClient(eager=True)
+        try:
+            client.ping()
+            self.assertTrue(client.alive)
+        finally:
+            client.disconnect()
+
+    def test_profile(self):
+        client = SSHManagerClient()
+        try:
+            report = client.profile(0.2)
+            self.assertIn('samples', report)
+            self.assertIn('start', client.memory('start'))
+            report = client.memory('snapshot')
+            self.assertIn('current=', report)
+            client.memory('stop')
+            with self.assertRaises(RuntimeError):
+                client.memory('snapshot')
+        finally:
+            client.disconnect()
+
+    def test_spare(self):
+        client = SSHManagerClient(spare=True)
+        try:
+            client.ping()
+            spare = client._spare
+            self.assertIsNotNone(spare)
+            client._server.popen.kill()
+            client._server.popen.wait()
+            client.ping()
+            self.assertIs(spare, client._server)
+            self.assertEqual(1, client.restarts)
+        finally:
+            client.disconnect()
+
+    def test_batch(self):
+        path = tempfile.mktemp()
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.bind(path)
+            sock.listen()
+            s = SSHManagerServer(path)
+            client, _ = sock.accept()
+            try:
+                Command.unpack(client, timeout=10.0)
+                s._manager = manager = FakeManager()
+                s._apply([
+                    TunnelCommand(Command.COMMAND_ADD, Tunnel('a.com')),
+                    TunnelCommand(Command.COMMAND_ADD, Tunnel('b.com')),
+                    TunnelCommand(Command.COMMAND_DEL, Tunnel('a.com')),
+                    TunnelCommand(Command.COMMAND_ADD, Tunnel('c.com')),
+                ])
+                self.assertEqual([
+                    ('add', ['a.com', 'b.com']),
+                    ('del', 'a.com'),
+                    ('add', ['c.com']),
+                ], manager.calls)
+            finally:
+                client.close()
+
+
+class ControlTestCase(unittest.TestCase):
+    def test_clients(self):
+        path = tempfile.mktemp()
+        client = SSHManagerClient(control=path)
+        try:
+            client.ping()
+            controls = [ControlClient(path), ControlClient(path)]
+            for control in controls:
+                control.ping()
+            self.assertEqual(0, controls[0].stats()['tunnels'])
+            self.assertEqual([], controls[1].list_tunnels())
+            # NOTE: stopping a control client leaves the manager running.
+            controls[0].disconnect()
+            client.ping()
+            controls[1].close()
+        finally:
+            client.disconnect()
+
+    def test_subscribe(self):
+        path, control = tempfile.mktemp(), tempfile.mktemp()
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.bind(path)
+            sock.listen()
+            s = SSHManagerServer(path)
+            parent, _ = sock.accept()
+            try:
+                Command.unpack(parent, timeout=10.0)
+                s._manager = FakeManager()
+                s.listen(control)
+                client = ControlClient(control)
+                tunnels = client.subscribe()
+                self.assertEqual(['a.com'], [t.domain for t in tunnels])
+                s._publish('tunnel_removed', {'domain': 'a.com'})
+                # Replies and events can be mixed on one connection.
+                client.ping()
+                event = next(client.events(timeout=5.0))
+                self.assertEqual('tunnel_removed', event.event)
+                self.assertEqual({'domain': 'a.com'}, event.data)
+                self.assertEqual([], list(client.events(timeout=0.1)))
+                client.close()
+            finally:
+                parent.close()
+
+    def test_profile(self):
+        path = tempfile.mktemp()
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.bind(path)
+            sock.listen()
+            s = SSHManagerServer(path)
+            parent, _ = sock.accept()
+            try:
+                Command.unpack(parent, timeout=10.0)
+                s._manager = FakeManager()
+                ProfileCommand(Command.COMMAND_PROFILE, 1.0).send(parent)
+                Command(Command.COMMAND_NOOP).send(parent)
+                # The noop is answered while the profile is running.
+                command = Command.unpack(parent, timeout=0.5)
+                self.assertEqual(Command.COMMAND_NOOP, command.command)
+                command = Command.unpack(parent, timeout=5.0)
+                self.assertEqual(Command.COMMAND_PROFILE, command.command)
+                self.assertIn('samples', command.result)
+                command = Command.unpack(parent, timeout=1.0)
+                self.assertEqual(Command.COMMAND_NOOP, command.command)
+            finally:
+                parent.close()
+
+    def test_slow_parent(self):
+        path = tempfile.mktemp()
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.bind(path)
+            sock.listen()
+            s = SSHManagerServer(path)
+            parent, _ = sock.accept()
+            try:
+                Command.unpack(parent, timeout=10.0)
+                s._manager = FakeManager()
+                thread = threading.Thread(target=s.run_forever, daemon=True)
+                thread.start()
+                Command(Command.COMMAND_SUBSCRIBE).send(parent)
+                while not s._subscribers:
+                    time.sleep(0.01)
+                # NOTE: the parent reads nothing, so once the socket buffer
+                # is full the queue overflows.
+                data = {'padding': 'x' * 8192}
+                for _ in range(SSH_EVENT_QUEUE + 256):
+                    s._publish('tunnel_changed', data)
+                # The process exits, so the client starts a new one.
+                thread.join(5)
+                self.assertFalse(thread.is_alive())
+            finally:
+                parent.close()
+
+    def test_slow_subscriber(self):
+        a, b = socket.socketpair()
+        peer = Peer(a)
+        peer.subscribe(1)
+        # NOTE: not started, so events stay queued.
+        peer.publish(b'1')
+        peer.publish(b'2')
+        b.settimeout(2)
+        self.assertEqual(b'', b.recv(1))
+        peer.close()
+        b.close()
@@ -0,0 +1,59 @@
+import unittest
+import logging
+
+from conduit_client.shard import HashRing, ShardedSSHManagerClient
+
+
+LOGGER = logging.getLogger()
+LOGGER.setLevel(logging.ERROR)
+LOGGER.addHandler(logging.NullHandler())
+
+DOMAINS = [f'host{i}.example.com' for i in range(1000)]
+
+
+class HashRingTestCase(unittest.TestCase):
+    def test_stable(self):
+        one, two = HashRing(range(4)), HashRing(range(4))
+        for domain in DOMAINS:
+            self.assertEqual(one.get(domain), two.get(domain))
+
+    def test_distribution(self):
+        ring = HashRing(range(4))
+        counts = [0] * 4
+        for domain in DOMAINS:
+            counts[ring.get(domain)] += 1
+        for count in counts:
+            self.assertGreater(count, 100)
+
+    def test_add_node(self):
+        ring = HashRing(range(4))
+        before = {domain: ring.get(domain) for domain in DOMAINS}
+        ring.add(4)
+        moved = [d for d in DOMAINS if ring.get(d) != before[d]]
+        # Only keys claimed by the new node should move.
+        self.assertTrue(all(ring.get(d) == 4 for d in moved))
+        self.assertLess(len(moved), len(DOMAINS) / 2)
+
+    def test_empty(self):
+        with self.assertRaises(KeyError):
+            HashRing([]).get('foo.com')
+
+
+class ShardedClientTestCase(unittest.TestCase):
+    def test_restart(self):
+        client = ShardedSSHManagerClient(shards=2, check_interval=60.0)
+        try:
+            client.ping()
+            self.assertEqual(2, client.stats()['shards'])
+            dead, other = client._shards
+            pid = other._server.popen.pid
+            dead._server.popen.kill()
+            dead._server.popen.wait()
+            client.check()
+            self.assertTrue(dead.alive)
+            self.assertEqual(1, dead.restarts)
+            self.assertEqual(pid, other._server.popen.pid)
+            self.assertEqual(1, client.stats()['restarts'])
+
+        finally:
+            client.disconnect()
@@ -1,3 +1,4 @@
+import os
 import unittest
 import uuid
 import logging
@@ -5,7 +6,11 @@ import socket
 import time
 import threading
 import tempfile
+import ssl
+import struct
+import queue
 import shutil
+import warnings
 from io import StringIO
 from contextlib import contextmanager
 
@@ -13,8 +18,9 @@ import paramiko
 from paramiko.py3compat import decodebytes
 from stopit import async_raise
 
-from conduit_client import ssh
-from conduit_client.ssh import Tunnel
+from conduit_client import ssh, peek, replay
+from conduit_client.ssh import Tunnel, Liveness
+from tests.wan import Link, WanProxy
 
 
 HOST_KEY_DATA = StringIO(
@@ -65,7 +71,37 @@ class SSHServer(paramiko.ServerInterface):
         LOGGER.debug('port forward request')
         return 1234
 
+    def _control(self, channel):
+        buffer = b''
+        while True:
+            data = channel.recv(1024)
+            if not data:
+                return
+            *lines, buffer = (buffer + data).split(b'\n')
+            for line in lines:
+                seq, _, command = line.decode().partition(' ')
+                self._test_server.commands.append(command)
+                self._test_server.exec_request.set()
+                domains = command.split(' ')[1].split(',')
+                refused = [
+                    d for d in domains if d in self._test_server.refused]
+                if not refused:
+                    reply = 'ok'
+                elif len(refused) == len(domains):
+                    reply = 'error Invalid domain'
+                else:
+                    reply = f'refused {",".join(refused)}'
+                channel.sendall(f'{seq} {reply}\n'.encode())
+
     def check_channel_exec_request(self, channel, command):
+        self._test_server.execs.append(command.decode())
+        if command == b'control':
+            if not self._test_server.control:
+                return False
+            threading.Thread(
+                target=self._control, args=(channel,), daemon=True).start()
+            return True
+        self._test_server.commands.append(command.decode())
         self._test_server.exec_request.set()
         LOGGER.debug('exec request')
         return True
@@ -76,8 +112,14 @@ class SSHServer(paramiko.ServerInterface):
 
 
 class TestServer:
-    def __init__(self, port=0):
+    def __init__(self, port=0, payload='Hello world.', control=True):
         self._port = port
+        self.control = control
+        self.execs = []
+        self._payload = payload
+        self.commands = []
+        # NOTE: domains the control session refuses.
+        self.refused = set()
         self._socket = None
         self._thread = None
         self.started = threading.Event()
@@ -106,15 +148,17 @@ class TestServer:
                 t.add_server_key(HOST_KEY)
                 t.start_server(server=SSHServer(self))
                 LOGGER.debug('accepting')
-                t.accept()
+                # NOTE: hold a reference, an unreferenced channel is closed.
+                channel = t.accept()
 
                 self.exec_request.wait()
                 self.port_forward.wait()
 
                 c = t.open_forwarded_tcpip_channel(
                     ('127.0.0.1', 4321), ('127.0.0.1', 1234))
-                c.send('Hello world.')
+                c.send(self._payload)
                 self.data_sent.set()
+                channel.close()
 
             finally:
                 t.close()
@@ -148,6 +192,8 @@ class TestServer:
         self._thread.start()
 
     def stop(self):
+        if not self._thread.is_alive():
+            return
         async_raise(self._thread.ident, CancelError)
         self._thread.join()
 
@@ -239,3 +285,705 @@ class SSHTestCase(SSHServerTestCase):
         self.assertData(b'Hello world.')
         tunnels = manager.list_tunnels()
         self.assertEqual(1, len(tunnels))
+
+
+def _closed_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+class SlowEndpoints(ssh.Endpoints):
+    "Endpoints that take a fixed time to connect, None to refuse."
+    def __init__(self, delays, **kwargs):
+        super().__init__(','.join(delays), 22, **kwargs)
+        self._delays = delays
+
+    def _connect(self, endpoint):
+        delay = self._delays[endpoint[0]]
+        if delay is None:
+            raise ConnectionRefusedError()
+        time.sleep(delay)
+        return socket.socket(), delay
+
+
+class EndpointsTestCase(unittest.TestCase):
+    def test_parse(self):
+        self.assertEqual(
+            [('a.com', 22), ('b.com', 2222), ('::1', 22), ('::1', 23)],
+            ssh.parse_endpoints('a.com, b.com:2222,[::1],[::1]:23', 22))
+
+    def test_expand(self):
+        endpoints = ssh.Endpoints('127.0.0.1,localhost:23', 22)
+        expanded = endpoints.expand()
+        self.assertIn(('127.0.0.1', '127.0.0.1', 22), expanded)
+        self.assertIn(('localhost', '127.0.0.1', 23), expanded)
+
+    def test_race(self):
+        endpoints = SlowEndpoints(
+            {'127.0.0.1': 0.5, '127.0.0.2': None, '127.0.0.3': 0.05},
+            stagger=0.1)
+        sock, endpoint = endpoints.race()
+        sock.close()
+        self.assertEqual('127.0.0.3', endpoint[0])
+        self.assertIsNone(endpoints.rtts[('127.0.0.2', '127.0.0.2', 22)])
+        # The loser is measured once it completes, and tried first next time.
+        time.sleep(0.6)
+        self.assertEqual(endpoints.best(), endpoint)
+        self.assertEqual(endpoint, endpoints.expand()[0])
+
+    def test_race_fail(self):
+        endpoints = SlowEndpoints({'127.0.0.1': None, '127.0.0.2': None})
+        with self.assertRaises(ConnectionRefusedError):
+            endpoints.race()
+
+
+class FailoverTestCase(SSHServerTestCase):
+    def test_skip_dead(self):
+        manager = ssh.create_manager(
+            host=f'127.0.0.1:{_closed_port()},127.0.0.1:{self.server.port}',
+            key=HOST_KEY)
+        manager.add_tunnel(Tunnel('foo.com', '127.0.0.1', self.local.port))
+        self.assertConnection()
+        self.assertExecRequest()
+        self.assertEqual(self.server.port, manager.endpoint[2])
+
+    def test_failover(self):
+        backup = TestServer()
+        try:
+            manager = ssh.create_manager(
+                host=f'127.0.0.1:{self.server.port},127.0.0.1:{backup.port}',
+                key=HOST_KEY)
+            manager.add_tunnel(
+                Tunnel('foo.com', '127.0.0.1', self.local.port))
+            self.assertData(b'Hello world.')
+            self.assertEqual(self.server.port, manager.endpoint[2])
+            self.server.stop()
+            time.sleep(0.1)
+            manager.poll()
+            # Tunnels are restored on the backup.
+            if not backup.port_forward.wait(2):
+                self.fail('Tunnel not restored')
+            self.assertEqual(backup.port, manager.endpoint[2])
+        finally:
+            backup.stop()
+
+
+def _client_hello(server_hostname):
+    context = ssl.create_default_context()
+    incoming, outgoing = ssl.MemoryBIO(), ssl.MemoryBIO()
+    tls = context.wrap_bio(incoming, outgoing, server_hostname=server_hostname)
+    try:
+        tls.do_handshake()
+    except ssl.SSLWantReadError:
+        pass
+    return outgoing.read()
+
+
+class PeekTestCase(unittest.TestCase):
+    def test_tls(self):
+        data = _client_hello('Foo.com')
+        self.assertEqual(('foo.com', True), peek.server_name(data))
+        self.assertEqual((None, False), peek.server_name(data[:20]))
+
+    def test_tls_no_sni(self):
+        data = _client_hello(None)
+        self.assertEqual((None, True), peek.server_name(data))
+
+    def test_http(self):
+        data = b'GET / HTTP/1.1\r\nHost: foo.com:8080\r\n\r\n'
+        self.assertEqual(('foo.com', True), peek.server_name(data))
+        self.assertEqual((None, False), peek.server_name(data[:20]))
+        self.assertEqual(
+            (None, True), peek.server_name(b'GET / HTTP/1.0\r\n\r\n'))
+
+
+class MultiplexTestCase(SSHServerTestCase):
+    def setUp(self):
+        self.server = TestServer(
+            payload='GET / HTTP/1.1\r\nHost: bar.com\r\n\r\n')
+        self.server.started.wait()
+        self.local = LocalHost()
+
+    def test_multiplex(self):
+        manager = ssh.SSHManager(
+            '127.0.0.1', self.server.port, 'default', HOST_KEY,
+            multiplex=True)
+        manager.add_tunnels([
+            Tunnel('foo.com', '127.0.0.1', _closed_port()),
+            Tunnel('bar.com', '127.0.0.1', self.local.port),
+        ])
+        self.assertPortForward()
+        self.assertData(b'GET / HTTP/1')
+        self.assertEqual(
+            ['tunnel foo.com,bar.com 1234'], self.server.commands)
+        self.assertEqual(
+            [1234, 1234], [t.remote_port for t in manager.list_tunnels()])
+
+    def test_refused(self):
+        self.server.refused = {'foo.com'}
+        manager = ssh.SSHManager(
+            '127.0.0.1', self.server.port, 'default', HOST_KEY,
+            multiplex=True)
+        with self.assertRaises(ssh.ControlError) as cm:
+            manager.add_tunnels([
+                Tunnel('foo.com', '127.0.0.1', _closed_port()),
+                Tunnel('bar.com', '127.0.0.1', self.local.port),
+            ])
+        self.assertEqual(['foo.com'], cm.exception.domains)
+        self.assertEqual(
+            ['bar.com'], [t.domain for t in manager.list_tunnels()])
+        self.assertData(b'GET / HTTP/1')
+
+
+class FakeChannel:
+    def __init__(self):
+        self.closed = False
+        self.sent = []
+        self.replies = queue.Queue()
+
+    def exec_command(self, command):
+        self.command = command
+
+    def sendall(self, data):
+        self.sent.append(data)
+
+    def recv(self, size):
+        return self.replies.get()
+
+    def close(self):
+        self.closed = True
+        self.replies.put(b'')
+
+
+class FakeSessionTransport:
+    def __init__(self):
+        self.channel = FakeChannel()
+
+    def open_session(self):
+        return self.channel
+
+
+class ControlTestCase(unittest.TestCase):
+    def test_pipeline(self):
+        transport = FakeSessionTransport()
+        control = ssh.Control(transport)
+        one, two = control.send('tunnel a.com 1'), control.send('tunnel b')
+        self.assertEqual('control', transport.channel.command)
+        self.assertEqual(
+            [b'1 tunnel a.com 1\n', b'2 tunnel b\n'], transport.channel.sent)
+        # Replies may arrive in any order, and in pieces.
+        transport.channel.replies.put(b'2 error Invalid comm')
+        transport.channel.replies.put(b'and\n1 ok\n')
+        self.assertTrue(one.result(1))
+        with self.assertRaisesRegex(ssh.ControlError, 'Invalid command'):
+            two.result(1)
+
+    def test_refused(self):
+        transport = FakeSessionTransport()
+        control = ssh.Control(transport)
+        future = control.send('tunnel a.com,b.com,c.com 1')
+        transport.channel.replies.put(b'1 refused a.com,c.com\n')
+        with self.assertRaises(ssh.ControlError) as cm:
+            future.result(1)
+        self.assertEqual(['a.com', 'c.com'], cm.exception.domains)
+
+    def test_closed(self):
+        transport = FakeSessionTransport()
+        control = ssh.Control(transport)
+        future = control.send('tunnel a.com 1')
+        control.close()
+        with self.assertRaises(ssh.ControlError):
+            future.result(1)
+        self.assertFalse(control.alive)
+
+
+class ControlSessionTestCase(SSHServerTestCase):
+    def test_control(self):
+        manager = ssh.create_manager(
+            host='127.0.0.1', port=self.server.port, key=HOST_KEY)
+        manager.add_tunnel(Tunnel('foo.com', '127.0.0.1', self.local.port))
+        self.assertData(b'Hello world.')
+        self.assertEqual(['tunnel foo.com 1234'], self.server.commands)
+        self.assertEqual(['control'], self.server.execs)
+
+    def test_refused(self):
+        self.server.refused = {'foo.com'}
+        manager = ssh.create_manager(
+            host='127.0.0.1', port=self.server.port, key=HOST_KEY)
+        events = []
+        manager.listener = lambda event, data: events.append(event)
+        with self.assertRaises(ssh.ControlError) as cm:
+            manager.add_tunnel(
+                Tunnel('foo.com', '127.0.0.1', self.local.port))
+        self.assertEqual(['foo.com'], cm.exception.domains)
+        self.assertEqual({}, manager.tunnels)
+        self.assertEqual({}, manager._routes)
+        self.assertNotIn('tunnel_added', events)
+
+    def test_exec_fallback(self):
+        self.server.control = False
+        manager = ssh.create_manager(
+            host='127.0.0.1', port=self.server.port, key=HOST_KEY)
+        manager.add_tunnel(Tunnel('foo.com', '127.0.0.1', self.local.port))
+        self.assertData(b'Hello world.')
+        self.assertIsNone(manager._control)
+        self.assertEqual(['tunnel foo.com 1234'], self.server.commands)
+
+
+class RetargetTestCase(unittest.TestCase):
+    def setUp(self):
+        self.manager = ssh.SSHManager(
+            '127.0.0.1', _closed_port(), 'default', HOST_KEY)
+        # NOTE: pretend to be connected, only routing is under test.
+        self.manager.connect = lambda: None
+        self.tunnel = Tunnel('foo.com', '127.0.0.1', _closed_port(), 1234)
+        self.manager._tunnels['foo.com'] = self.tunnel
+        self.manager._routes[1234] = self.tunnel
+        self.local = LocalHost()
+
+    def tearDown(self):
+        self.local.stop()
+
+    def _route(self, port=1234):
+        client, channel = socket.socketpair()
+        self.manager._route(channel, ('127.0.0.1', 4321), ('127.0.0.1', port))
+        return client
+
+    def test_retarget(self):
+        self.manager.add_tunnel(
+            Tunnel('foo.com', '127.0.0.1', self.local.port))
+        tunnel = self.manager.tunnels['foo.com']
+        self.assertEqual(
+            (self.local.port, 1234), (tunnel.port, tunnel.remote_port))
+        self.assertIs(tunnel, self.manager._routes[1234])
+        client = self._route()
+        try:
+            client.sendall(b'Hello world.')
+            if not self.local.data_recv.wait(5):
+                self.fail('Data not received')
+        finally:
+            client.close()
+
+    def test_unknown_port(self):
+        client = self._route(4321)
+        try:
+            self.assertEqual(b'', client.recv(1))
+        finally:
+            client.close()
+
+    def test_drain(self):
+        self.manager._tunnels['foo.com'] = self.manager._routes[1234] = \
+            Tunnel('foo.com', '127.0.0.1', self.local.port, 1234)
+        client = self._route()
+        try:
+            self.manager.del_tunnel(self.tunnel, drain=0.2)
+            self.assertNotIn(1234, self.manager._routes)
+            # Open channels are left alone until the deadline.
+            channels = self.manager._forwarder.channels
+            self.assertEqual(1, len(channels('foo.com')))
+            client.settimeout(2)
+            self.assertEqual(b'', client.recv(1))
+            self.assertEqual([], channels('foo.com'))
+        finally:
+            client.close()
+
+    def test_forget(self):
+        balancers = self.manager._forwarder._balancers
+        self.manager._forwarder.balancer_for(self.tunnel)
+        self.manager.add_tunnel(
+            Tunnel('foo.com', '127.0.0.1', self.local.port))
+        self.assertNotIn('foo.com', balancers)
+        self.manager._forwarder.balancer_for(self.manager.tunnels['foo.com'])
+        self.manager.del_tunnel(self.tunnel, drain=0)
+        self.assertNotIn('foo.com', balancers)
+        self.assertEqual(0, self.manager.stats()['backends_unavailable'])
+
+    def test_events(self):
+        events = []
+        self.manager.listener = lambda event, data: events.append(event)
+        self.manager.add_tunnel(
+            Tunnel('foo.com', '127.0.0.1', self.local.port))
+        client = self._route()
+        try:
+            self.manager.del_tunnel(self.tunnel, drain=0)
+            self.assertEqual([
+                'tunnel_changed', 'channel_opened', 'tunnel_removed',
+                'channel_closed',
+            ], events)
+        finally:
+            client.close()
+
+
+class ForwarderTestCase(unittest.TestCase):
+    def _forwarder(self, **kwargs):
+        forwarder = ssh.Forwarder(**kwargs)
+        self.client, channel = socket.socketpair()
+        self.backend, server = socket.socketpair()
+        conn = ssh.Connection(channel, 'foo.com')
+        conn.server = server
+        self.addCleanup(self.client.close)
+        self.addCleanup(self.backend.close)
+        return forwarder, conn
+
+    def _read(self, size):
+        self.client.settimeout(2)
+        data = b''
+        while len(data) < size:
+            chunk = self.client.recv(size)
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+    def test_batch(self):
+        forwarder, conn = self._forwarder(coalesce_delay=0)
+        for _ in range(10):
+            self.backend.sendall(b'x' * 100)
+        forwarder._add(conn)
+        self.assertEqual(1000, len(self._read(1000)))
+        self.assertEqual(1, forwarder.stats()['writes'])
+
+    def test_coalesce(self):
+        forwarder, conn = self._forwarder(coalesce_delay=0.2)
+        forwarder._add(conn)
+        for _ in range(5):
+            self.backend.sendall(b'x' * 100)
+            time.sleep(0.005)
+        self.assertEqual(500, len(self._read(500)))
+        self.assertEqual(1, forwarder.stats()['writes'])
+
+    def test_full_buffer(self):
+        forwarder, conn = self._forwarder(coalesce_delay=10)
+        forwarder._add(conn)
+        self.backend.sendall(b'x' * ssh.FORWARD_COALESCE_SIZE)
+        # Sent at once, without waiting out the delay.
+        data = self._read(ssh.FORWARD_COALESCE_SIZE)
+        self.assertEqual(ssh.FORWARD_COALESCE_SIZE, len(data))
+
+    def test_table(self):
+        forwarder, conn = self._forwarder(coalesce_delay=0)
+        forwarder._add(conn)
+        self.assertIs(conn, forwarder._table[conn.server])
+        self.client.sendall(b'ping')
+        self.backend.settimeout(2)
+        self.assertEqual(b'ping', self.backend.recv(4))
+        self.backend.sendall(b'pong!')
+        self._read(5)
+        self.assertEqual(
+            {'foo.com': {'connections': 1, 'bytes_in': 4, 'bytes_out': 5}},
+            forwarder.tunnel_stats())
+        self.client.close()
+        deadline = time.monotonic() + 2
+        while conn.state != ssh.Connection.STATE_CLOSED and \
+                time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual({}, forwarder._table)
+        self.assertEqual({}, forwarder.tunnel_stats())
+
+    def test_close(self):
+        forwarder, conn = self._forwarder(coalesce_delay=10)
+        forwarder._add(conn)
+        self.backend.sendall(b'bye')
+        self.backend.close()
+        # Buffered data is written before closing.
+        self.assertEqual(b'bye', self._read(4))
+
+
+class WanTestCase(SSHServerTestCase):
+    def test_slow_link(self):
+        link = Link(rtt=0.05, jitter=0.01, loss=0.02, seed=1)
+        uplink = WanProxy(('127.0.0.1', self.server.port), link)
+        backend = WanProxy(('127.0.0.1', self.local.port), Link(rtt=0.02))
+        try:
+            manager = ssh.create_manager(
+                host='127.0.0.1', port=uplink.port, key=HOST_KEY)
+            start = time.monotonic()
+            manager.add_tunnel(Tunnel('foo.com', '127.0.0.1', backend.port))
+            # Connecting takes several round trips.
+            self.assertGreater(time.monotonic() - start, 4 * link.rtt)
+            self.assertData(b'Hello world.')
+        finally:
+            uplink.close()
+            backend.close()
+
+
+class CallbackTestCase(unittest.TestCase):
+    def setUp(self):
+        self.gateway, self.backend = replay.Gateway(), replay.Backend()
+        self.manager = ssh.SSHManager(
+            '127.0.0.1', self.gateway.port, 'default', HOST_KEY)
+        self.manager._forwarder._callback = True
+        with warnings.catch_warnings():
+            # NOTE: the stand-in server's key is new each run.
+            warnings.simplefilter('ignore')
+            self.manager.add_tunnel(
+                Tunnel('foo.com', '127.0.0.1', self.backend.port))
+
+    def tearDown(self):
+        self.manager.disconnect()
+        self.gateway.close()
+        self.backend.close()
+
+    def test_sink(self):
+        received, closed = [], []
+        sink = ssh.ChannelSink()
+        sink.feed(b'a')
+        sink.feed(b'b')
+        self.assertEqual(b'a', sink.read(1))
+        sink.start(received.append, lambda: closed.append(True))
+        sink.feed(b'c')
+        sink.close()
+        self.assertEqual([b'b', b'c'], received)
+        self.assertEqual([True], closed)
+
+    def test_forward(self):
+        # NOTE: more than the channel window, which must be adjusted.
+        payload = os.urandom(4 * 1024 * 1024)
+        channel = self.gateway.open()
+        server = self.backend.accepted.get(timeout=5)
+        server.settimeout(5)
+        sender = threading.Thread(target=channel.sendall, args=(payload,))
+        sender.start()
+        data = bytearray()
+        while len(data) < len(payload):
+            chunk = server.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+        sender.join()
+        self.assertEqual(payload, bytes(data))
+
+        conn, = self.manager._forwarder.connections()
+        self.assertIsInstance(conn.channel.in_buffer, ssh.ChannelSink)
+        # The channel was never polled, so paramiko made no pipe for it.
+        self.assertIsNone(conn.channel._pipe)
+        self.assertEqual(len(payload), conn.bytes_in)
+
+        server.sendall(b'pong')
+        channel.settimeout(5)
+        self.assertEqual(b'pong', channel.recv(4))
+        channel.close()
+        self.assertEqual(b'', server.recv(1))
+        server.close()
+
+    def test_backend_reset(self):
+        forwarder = self.manager._forwarder
+        forwarder._coalesce_delay = 30.0
+        hangups = queue.Queue()
+        hangup = forwarder._hangup
+        forwarder._hangup = lambda conn: (hangups.put(conn), hangup(conn))
+        channel = self.gateway.open()
+        channel.settimeout(5)
+        server = self.backend.accepted.get(timeout=5)
+        while not forwarder.connections():
+            time.sleep(0.01)
+        conn, = forwarder.connections()
+        server.sendall(b'pong')
+        while not conn.buffer:
+            time.sleep(0.01)
+        # NOTE: hidden from the forwarder, so only the transport thread
+        # notices the reset.
+        del forwarder._table[conn.server]
+        server.setsockopt(
+            socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        server.close()
+        channel.sendall(b'ping')
+        self.assertIs(conn, hangups.get(timeout=5))
+        # The transport thread leaves closing conn to the forwarder.
+        self.assertEqual(b'pong', bytes(conn.buffer))
+        self.assertNotEqual(ssh.Connection.STATE_CLOSED, conn.state)
+        forwarder._table[conn.server] = conn
+        self.assertEqual(b'pong', channel.recv(4))
+        self.assertEqual(b'', channel.recv(1))
+        channel.close()
+
+
+class MoveTestCase(unittest.TestCase):
+    def setUp(self):
+        self.old, self.new = replay.Gateway(), replay.Gateway()
+        self.backend = replay.Backend()
+        self.endpoints = [
+            ('127.0.0.1', '127.0.0.1', g.port) for g in (self.old, self.new)]
+        self.manager = ssh.SSHManager(
+            f'127.0.0.1:{self.old.port},127.0.0.1:{self.new.port}', 22,
+            'default', HOST_KEY, drain=0.5)
+        self.manager._endpoints.rtts[self.endpoints[0]] = 0.01
+        with warnings.catch_warnings():
+            # NOTE: the stand-in servers' keys are new each run.
+            warnings.simplefilter('ignore')
+            self.manager.add_tunnel(
+                Tunnel('foo.com', '127.0.0.1', self.backend.port))
+
+    def tearDown(self):
+        self.manager.disconnect()
+        self.old.close()
+        self.new.close()
+        self.backend.close()
+
+    def _probe(self):
+        self.manager._endpoints.rtts.update({
+            self.endpoints[0]: 0.1, self.endpoints[1]: 0.01})
+        return dict(self.manager._endpoints.rtts)
+
+    def test_move(self):
+        events = []
+        self.manager.listener = lambda event, data: events.append(event)
+        self.assertEqual(self.old.port, self.manager.endpoint[2])
+        channel = self.old.open()
+        channel.settimeout(5)
+        server = self.backend.accepted.get(timeout=5)
+        server.settimeout(5)
+        transport = self.manager.transport
+        self.manager._endpoints.probe = self._probe
+        self.manager._evaluated = 0
+        # The probe runs in the background, the move happens on a later poll.
+        self.manager.poll()
+        self.manager._probe.result(5)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            self.manager.poll()
+        self.assertEqual(self.new.port, self.manager.endpoint[2])
+        # The open channel carries on over the old transport.
+        channel.sendall(b'ping')
+        self.assertEqual(b'ping', server.recv(4))
+        server.sendall(b'pong')
+        self.assertEqual(b'pong', channel.recv(4))
+        self.assertNotIn('transport_down', events)
+        # New channels arrive over the new one.
+        self.new.open().close()
+        self.backend.accepted.get(timeout=5).close()
+        # The old transport is closed once drained.
+        self.assertEqual(b'', channel.recv(1))
+        deadline = time.monotonic() + 5
+        while transport.is_alive() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertFalse(transport.is_alive())
+        self.assertIn('transport_down', events)
+        self.assertTrue(self.manager.connected)
+        server.close()
+
+
+class KeyTypeTestCase(SSHServerTestCase):
+    def test_ed25519(self):
+        key, _ = ssh.generate_key('ed25519')
+        manager = ssh.create_manager(
+            host='127.0.0.1', port=self.server.port, key=key)
+        manager.add_tunnel(Tunnel('foo.com', '127.0.0.1', self.local.port))
+        self.assertConnection()
+        self.assertExecRequest()
+        self.assertData(b'Hello world.')
+
+
+class KeyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mktemp()
+
+    def tearDown(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def test_default(self):
+        self.assertIsInstance(ssh.load_key(self.path), paramiko.Ed25519Key)
+
+    def test_detect(self):
+        classes = {
+            'ed25519': paramiko.Ed25519Key,
+            'ecdsa': paramiko.ECDSAKey,
+            'rsa': paramiko.RSAKey,
+        }
+        for key_type, klass in classes.items():
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            key = ssh.load_key(self.path, key_type)
+            self.assertIsInstance(key, klass)
+            # Existing key is loaded regardless of the requested type.
+            loaded = ssh.load_key(self.path, 'ed25519')
+            self.assertIsInstance(loaded, klass)
+            self.assertEqual(key.get_fingerprint(), loaded.get_fingerprint())
+            self.assertEqual(0o600, os.stat(self.path).st_mode & 0o777)
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            ssh.load_key(self.path, 'dsa')
+
+
+class FakePacketizer:
+    def read_message(self):
+        return None
+
+
+class FakeTransport:
+    def __init__(self, live=True):
+        self.packetizer = FakePacketizer()
+        self.live = live
+        self.sent = []
+        self.closed = threading.Event()
+
+    def global_request(self, kind, data=None, wait=True):
+        self.sent.append(kind)
+        if self.live:
+            # Reply immediately, as a live peer would.
+            self.packetizer.read_message()
+            return None
+        # NOTE: paramiko waits until the transport is closed.
+        self.closed.wait()
+        return None
+
+    def close(self):
+        self.closed.set()
+
+
+class LivenessTestCase(unittest.TestCase):
+    def test_inbound(self):
+        transport = FakeTransport()
+        liveness = Liveness(transport, interval=10.0, timeout=10.0)
+        try:
+            liveness.last_seen -= 5.0
+            transport.packetizer.read_message()
+            self.assertLess(liveness.idle, 1.0)
+            self.assertTrue(liveness.alive)
+        finally:
+            liveness.stop()
+
+    def test_keepalive(self):
+        transport = FakeTransport()
+        liveness = Liveness(transport, interval=0.1, timeout=10.0)
+        try:
+            liveness.last_seen -= 1.0
+            time.sleep(0.5)
+            self.assertTrue(transport.sent)
+            self.assertLess(liveness.idle, 1.0)
+            self.assertFalse(transport.closed.is_set())
+        finally:
+            liveness.stop()
+
+    def test_dead_peer(self):
+        transport = FakeTransport(live=False)
+        liveness = Liveness(transport, interval=0.1, timeout=0.3)
+        try:
+            if not transport.closed.wait(2.0):
+                self.fail('Dead peer not detected')
+            self.assertFalse(liveness.alive)
+            # The unanswered keepalive gives up the lock once closed.
+            self.assertTrue(liveness.request_lock.acquire(timeout=1.0))
+            liveness.request_lock.release()
+        finally:
+            liveness.stop()
+
+    def test_timeout(self):
+        transport = FakeTransport(live=False)
+        liveness = Liveness(transport, interval=0.4, timeout=0.5)
+        try:
+            start = time.monotonic()
+            if not transport.closed.wait(3.0):
+                self.fail('Dead peer not detected')
+            # Bounded by the timeout, not interval + timeout.
+            self.assertLess(time.monotonic() - start, 1.1)
+            self.assertEqual(['keepalive@openssh.com'], transport.sent)
+        finally:
+            liveness.stop()
@@ -0,0 +1,111 @@
+import os
+import time
+import socket
+import threading
+import unittest
+import logging
+
+from tests.wan import Link, WanProxy
+
+
+LOGGER = logging.getLogger()
+LOGGER.setLevel(logging.ERROR)
+LOGGER.addHandler(logging.NullHandler())
+
+
+class Sink:
+    "Echoes back whatever is received, on every connection."
+    def __init__(self):
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.bind(('127.0.0.1', 0))
+        self._socket.listen(10)
+        self.address = self._socket.getsockname()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                client, _ = self._socket.accept()
+
+            except OSError:
+                return
+            threading.Thread(
+                target=self._echo, args=(client,), daemon=True).start()
+
+    def _echo(self, client):
+        with client:
+            while True:
+                data = client.recv(65536)
+                if not data:
+                    return
+                client.sendall(data)
+
+    def close(self):
+        self._socket.close()
+
+
+def _exchange(port, data):
+    with socket.create_connection(('127.0.0.1', port)) as s:
+        start = time.monotonic()
+        threading.Thread(target=s.sendall, args=(data,), daemon=True).start()
+        received = b''
+        s.settimeout(10)
+        while len(received) < len(data):
+            chunk = s.recv(65536)
+            if not chunk:
+                break
+            received += chunk
+        return received, time.monotonic() - start
+
+
+class WanProxyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.sink = Sink()
+
+    def tearDown(self):
+        self.sink.close()
+
+    def test_rtt(self):
+        proxy = WanProxy(self.sink.address, Link(rtt=0.1))
+        try:
+            received, elapsed = _exchange(proxy.port, b'ping')
+            self.assertEqual(b'ping', received)
+            self.assertGreaterEqual(elapsed, 0.1)
+            self.assertLess(elapsed, 0.5)
+        finally:
+            proxy.close()
+
+    def test_bandwidth(self):
+        # Limited one way only, 100K takes at least 0.2s.
+        proxy = WanProxy(
+            self.sink.address, Link(bandwidth=5e5), Link())
+        try:
+            received, elapsed = _exchange(proxy.port, bytes(100000))
+            self.assertEqual(100000, len(received))
+            self.assertGreaterEqual(elapsed, 0.2)
+        finally:
+            proxy.close()
+
+    def test_loss(self):
+        # Data arrives late, but intact and in order.
+        link = Link(rtt=0.01, jitter=0.005, loss=0.1, reorder=0.1, rto=0.02,
+                    seed=1)
+        proxy = WanProxy(self.sink.address, link)
+        try:
+            data = os.urandom(200000)
+            received, _ = _exchange(proxy.port, data)
+            self.assertEqual(data, received)
+        finally:
+            proxy.close()
+
+    def test_cut(self):
+        proxy = WanProxy(self.sink.address)
+        try:
+            with socket.create_connection(('127.0.0.1', proxy.port)) as s:
+                s.sendall(b'ping')
+                s.settimeout(2)
+                self.assertEqual(b'ping', s.recv(4))
+                proxy.cut()
+                self.assertEqual(b'', s.recv(4))
+        finally:
+            proxy.close()
@@ -0,0 +1,252 @@
+"""
+Userspace WAN emulation for tests and benchmarks.
+
+WanProxy listens locally and forwards each connection to a target,
+delaying data as a slow, lossy link would. It can sit between an
+SSHManager and the test sshd, or between the Forwarder and a backend.
+
+This works on top of TCP, so nothing is really lost or reordered. A lost
+segment is delivered after a retransmit timeout and a reordered one after
+an extra delay. Either way the data behind it waits too, which is the
+head of line blocking TCP shows on a real link.
+"""
+import copy
+import time
+import heapq
+import random
+import socket
+import threading
+import logging
+
+
+# NOTE: data is shaped in segments of about one ethernet MSS.
+MSS = 1460
+# NOTE: bytes held in flight per direction before reads stop, like the
+# buffers of a modem.
+BUFFER = 256 * 1024
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+
+class Link:
+    """
+    One direction of a link.
+
+    rtt and jitter are in seconds, half the rtt is spent in each
+    direction. bandwidth is in bytes per second, None for no limit, and is
+    shared by every connection over the link. loss and reorder are the
+    chance of each segment being lost or reordered.
+    """
+    def __init__(self, rtt=0.0, jitter=0.0, bandwidth=None, loss=0.0,
+                 reorder=0.0, rto=0.2, seed=None):
+        self.rtt = rtt
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.loss = loss
+        self.reorder = reorder
+        self.rto = rto
+        self._random = random.Random(seed)
+        self._sent = 0.0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def profile(cls, name, **kwargs):
+        "A link like one in PROFILES, kwargs override its settings."
+        return cls(**dict(PROFILES[name], **kwargs))
+
+    def __repr__(self):
+        return (f'Link(rtt={self.rtt}, jitter={self.jitter}, '
+                f'bandwidth={self.bandwidth}, loss={self.loss}, '
+                f'reorder={self.reorder})')
+
+    def delay(self):
+        "The one way delay of a segment."
+        delay = self.rtt / 2
+        if self.jitter:
+            delay += self._random.uniform(-self.jitter, self.jitter)
+        if self.loss and self._random.random() < self.loss:
+            delay += max(self.rto, self.rtt)
+        elif self.reorder and self._random.random() < self.reorder:
+            delay += self.rtt / 2
+        return max(0.0, delay)
+
+    def transmit(self, size):
+        "When size bytes queued now will have been sent."
+        with self._lock:
+            self._sent = max(time.monotonic(), self._sent)
+            if self.bandwidth:
+                self._sent += size / self.bandwidth
+            return self._sent
+
+
+# NOTE: rough figures for typical uplinks, as seen from the client.
+PROFILES = {
+    'lan': dict(rtt=0.001),
+    'cable': dict(rtt=0.03, jitter=0.005, bandwidth=2.5e6, loss=0.001),
+    'dsl': dict(rtt=0.05, jitter=0.01, bandwidth=1e5, loss=0.005),
+    'lte': dict(rtt=0.08, jitter=0.03, bandwidth=1.5e6, loss=0.01,
+                reorder=0.01),
+    'satellite': dict(rtt=0.6, jitter=0.05, bandwidth=6e5, loss=0.02),
+}
+
+
+class _Pipe:
+    "Carries one direction of a connection over a Link."
+    def __init__(self, link, r, w, closed):
+        self._link = link
+        self._r = r
+        self._w = w
+        self._closed = closed
+        self._queue = []
+        self._seq = 0
+        self._size = 0
+        self._delivered = 0.0
+        self._eof = False
+        self._cond = threading.Condition()
+        self.bytes = 0
+
+    def start(self):
+        for target in (self._read, self._write):
+            threading.Thread(target=target, daemon=True).start()
+
+    def _schedule(self, segment):
+        link = self._link
+        # NOTE: segments queue behind each other for the bandwidth, then
+        # arrive in order, as TCP would deliver them.
+        sent = link.transmit(len(segment))
+        self._delivered = max(self._delivered, sent + link.delay())
+        heapq.heappush(self._queue, (self._delivered, self._seq, segment))
+        self._seq += 1
+        self._size += len(segment)
+
+    def _read(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._size < BUFFER)
+            try:
+                data = self._r.recv(MSS * 4)
+
+            except OSError:
+                data = b''
+            with self._cond:
+                if not data:
+                    self._eof = True
+                    self._cond.notify_all()
+                    return
+                for i in range(0, len(data), MSS):
+                    self._schedule(data[i:i + MSS])
+                self._cond.notify_all()
+
+    def _write(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._queue or self._eof)
+                if not self._queue:
+                    break
+                at, _, segment = self._queue[0]
+                delay = at - time.monotonic()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                heapq.heappop(self._queue)
+                self._size -= len(segment)
+                self._cond.notify_all()
+            try:
+                self._w.sendall(segment)
+
+            except OSError:
+                break
+            self.bytes += len(segment)
+        try:
+            self._w.shutdown(socket.SHUT_WR)
+
+        except OSError:
+            pass
+        self._closed()
+
+
+class _Connection:
+    def __init__(self, client, server, up, down):
+        self._sockets = (client, server)
+        self._open = 2
+        self._lock = threading.Lock()
+        self.up = _Pipe(up, client, server, self._pipe_closed)
+        self.down = _Pipe(down, server, client, self._pipe_closed)
+
+    def start(self):
+        self.up.start()
+        self.down.start()
+
+    def _pipe_closed(self):
+        with self._lock:
+            self._open -= 1
+            if self._open:
+                return
+        self.close()
+
+    def close(self):
+        for sock in self._sockets:
+            try:
+                # NOTE: wakes the threads blocked reading.
+                sock.shutdown(socket.SHUT_RDWR)
+                sock.close()
+
+            except OSError:
+                pass
+
+
+class WanProxy:
+    """
+    Forwards connections to target over emulated links.
+
+    up shapes data from the client to target, down the replies, it
+    defaults to a link like up.
+    """
+    def __init__(self, target, up=None, down=None):
+        self.target = target
+        self.up = up or Link()
+        # NOTE: a copy, each direction has its own bandwidth.
+        self.down = down or copy.copy(self.up)
+        self.connections = []
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.bind(('127.0.0.1', 0))
+        self._socket.listen(100)
+        self.port = self._socket.getsockname()[1]
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                client, _ = self._socket.accept()
+
+            except OSError:
+                return
+            threading.Thread(
+                target=self._connect, args=(client,), daemon=True).start()
+
+    def _connect(self, client):
+        # NOTE: the handshake crosses the link too.
+        time.sleep(self.up.rtt)
+        try:
+            server = socket.create_connection(self.target)
+
+        except OSError:
+            LOGGER.exception('Could not connect to %s', self.target)
+            client.close()
+            return
+        for sock in (client, server):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connection = _Connection(client, server, self.up, self.down)
+        self.connections.append(connection)
+        connection.start()
+
+    def cut(self):
+        "Drop every connection, as when the link goes down."
+        connections, self.connections = self.connections, []
+        for connection in connections:
+            connection.close()
+
+    def close(self):
+        self._socket.close()
+        self.cut()
@@ -5,9 +5,8 @@ import sys
 import time
 import logging
 
-import paramiko
-
-from conduit_client.server import SSHManagerClient
+from conduit_client.ssh import Tunnel
+from conduit_client import daemon
 
 
 LOG_LEVEL = os.getenv('LOG_LEVEL', 'DEBUG').upper()
@@ -31,10 +30,14 @@ def _parse_args(args):
 
 
 def main(tunnels):
-    manager = SSHManagerClient()
+    manager = daemon.create_manager()
+
+    # NOTE: without tunnels on the command line, follow the tunnels file.
+    if not tunnels:
+        daemon.Daemon(daemon.TUNNELS_FILE, manager).run_forever()
 
     for hostname, addr, port in tunnels:
-        manager.add_tunnel(hostname, addr, port)
+        manager.add_tunnel(Tunnel(hostname, addr, port))
 
     while True:
         time.sleep(10)
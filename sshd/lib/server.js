@@ -54,6 +54,31 @@ function clientAuthenticationHandler(ctx, clientInfo) {
   }
 }
 
+function openTunnel(emitter, tunnelInfo, domain) {
+  if (tunnelInfo.domains.includes(domain)) {
+    return;
+  }
+  tunnelInfo.domains.push(domain);
+  emitter.emit('tunnel:open', { ...tunnelInfo, domain });
+}
+
+function closeTunnel(emitter, tunnelInfo, domains) {
+  // A tunnel carries one or more domains, close each of them.
+  for (const domain of domains || [...tunnelInfo.domains]) {
+    const i = tunnelInfo.domains.indexOf(domain);
+    if (i === -1) {
+      // eslint-disable-next-line no-continue
+      continue;
+    }
+    tunnelInfo.domains.splice(i, 1);
+    try {
+      emitter.emit('tunnel:close', { ...tunnelInfo, domain });
+    } catch (e) {
+      DEBUG('Error in tunnel:close handler: %O', e);
+    }
+  }
+}
+
 function clientPortRequestHandler(ctx, emitter, clientInfo) {
   DEBUG('Received request: %s, %O', ctx.name, ctx.info);
 
@@ -70,7 +95,7 @@ function clientPortRequestHandler(ctx, emitter, clientInfo) {
       bindAddr: info.bindAddr,
       bindPort,
       client: ctx.client,
-      domain: null,
+      domains: [],
     });
 
     ctx.accept(bindPort);
@@ -84,7 +109,7 @@ function clientPortRequestHandler(ctx, emitter, clientInfo) {
       return;
     }
     const tunnelInfo = clientInfo.tunnels.splice(i, 1)[0];
-    emitter.emit('tunnel:close', tunnelInfo);
+    closeTunnel(emitter, tunnelInfo);
     ctx.accept();
   } else {
     DEBUG('Request %s rejected, bindPort: %i', ctx.name, bindPort);
@@ -92,49 +117,109 @@ function clientPortRequestHandler(ctx, emitter, clientInfo) {
   }
 }
 
-function clientSessionHandler(accept, reject, emitter, clientInfo) {
-  DEBUG('Accepting session');
-  const session = accept();
+async function runCommand(command, emitter, clientInfo, atomic = false) {
+  // tunnel <domain>[,<domain>...] <bindPort>
+  // untunnel <domain>[,<domain>...] <bindPort>
+  const cmdParts = command.split(' ');
 
-  session.on('error', (e) => DEBUG('Error in session: %O', e));
-  session.on('exec', (acceptCommand, rejectCommand, info) => {
-    const cmdParts = info.command.split(' ');
+  if (!['tunnel', 'untunnel'].includes(cmdParts[0]) || cmdParts.length !== 3) {
+    throw new Error('Invalid command');
+  }
+
+  const bindPort = parseInt(cmdParts[2], 10);
+  DEBUG('Looking up tunnel with bindPort: %i', bindPort);
+  const tunnelInfo = clientInfo.tunnels.find((o) => o.bindPort === bindPort);
 
-    if (!cmdParts[0] === 'tunnel') {
-      DEBUG('Rejecting command %s', info.command);
-      rejectCommand();
+  if (!tunnelInfo) {
+    throw new Error('Invalid port, no tunnel');
+  }
+
+  const domains = cmdParts[1].split(',').filter((d) => d);
+  if (cmdParts[0] === 'untunnel') {
+    closeTunnel(emitter, tunnelInfo, domains);
+    return [];
+  }
+
+  // Domains are verified individually, the ones that pass are opened and
+  // the ones that fail are returned.
+  const results = await Promise.allSettled(
+    domains.map((domain) => verifyDomain(clientInfo.username, domain)),
+  );
+  const refused = [];
+  const accepted = [];
+  results.forEach((result, i) => {
+    if (result.status !== 'fulfilled') {
+      DEBUG('Invalid domain: %s, %s', clientInfo.username, domains[i]);
+      DEBUG('%O', result.reason);
+      refused.push(domains[i]);
       return;
     }
+    accepted.push(domains[i]);
+  });
+  if (!accepted.length) {
+    throw new Error('Invalid domain');
+  }
+  // An atomic command opens all of its domains or none of them.
+  if (atomic && refused.length) {
+    throw new Error(`Refused: ${refused.join(',')}`);
+  }
+  accepted.forEach((domain) => openTunnel(emitter, tunnelInfo, domain));
+  return refused;
+}
 
-    let bindPort;
-    let tunnelInfo;
-    try {
-      bindPort = parseInt(cmdParts[2], 10);
-      DEBUG('Looking up tunnel with bindPort: %i', bindPort);
-      tunnelInfo = clientInfo.tunnels.find((o) => o.bindPort === bindPort);
-    } catch (e) {
-      DEBUG('Command format error: %O', e);
-      rejectCommand();
-      return;
+function controlHandler(stream, emitter, clientInfo) {
+  // Commands arrive as "<seq> <command>" lines, each is answered with
+  // "<seq> ok", "<seq> refused <domain>[,<domain>...]" when only some
+  // domains of a tunnel command were opened, or "<seq> error <reason>".
+  // They are run in order so that an untunnel never overtakes the tunnel
+  // before it.
+  let buffer = '';
+  let queue = Promise.resolve();
+
+  stream.on('data', (chunk) => {
+    buffer += chunk.toString();
+    const lines = buffer.split('\n');
+    buffer = lines.pop();
+
+    for (const line of lines) {
+      const i = line.indexOf(' ');
+      const seq = line.slice(0, i);
+      const command = line.slice(i + 1);
+      DEBUG('Control command %s: %s', seq, command);
+      queue = queue
+        .then(() => runCommand(command, emitter, clientInfo))
+        .then((refused) => stream.write(refused.length
+          ? `${seq} refused ${refused.join(',')}\n`
+          : `${seq} ok\n`))
+        .catch((e) => {
+          DEBUG('Control command %s failed: %O', seq, e);
+          stream.write(`${seq} error ${e.message}\n`);
+        });
     }
+  });
+}
+
+function clientSessionHandler(accept, reject, emitter, clientInfo) {
+  DEBUG('Accepting session');
+  const session = accept();
 
-    if (!tunnelInfo) {
-      DEBUG('Invalid port, no tunnel');
-      rejectCommand();
+  session.on('error', (e) => DEBUG('Error in session: %O', e));
+  session.on('exec', (acceptCommand, rejectCommand, info) => {
+    if (info.command === 'control') {
+      DEBUG('Accepting control session');
+      controlHandler(acceptCommand(), emitter, clientInfo);
       return;
     }
 
-    const domain = cmdParts[1];
-    verifyDomain(clientInfo.username, domain)
+    // An exec can only succeed or fail, so its domains are all opened or
+    // none are.
+    runCommand(info.command, emitter, clientInfo, true)
       .then(() => {
         DEBUG('Accepting command %s', info.command);
-        tunnelInfo.domain = domain;
-        emitter.emit('tunnel:open', tunnelInfo);
         acceptCommand();
       })
       .catch((e) => {
-        DEBUG('Invalid domain: %s, %s', clientInfo.username, domain);
-        DEBUG('%O', e);
+        DEBUG('Rejecting command %s: %O', info.command, e);
         rejectCommand();
       });
   });
@@ -146,11 +231,7 @@ function clientEndHandler(emitter, clientInfo) {
   }
 
   for (const tunnelInfo of clientInfo.tunnels) {
-    try {
-      emitter.emit('tunnel:close', tunnelInfo);
-    } catch (e) {
-      DEBUG('Error in tunnel:close handler: %O', e);
-    }
+    closeTunnel(emitter, tunnelInfo);
   }
 }
 